@@ -0,0 +1,140 @@
+"""
+Benchmark of radius_auth and ldap_auth against local stand-in servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+
+Run with 'python -m benchmarks.bench_auth' from the top of the repository, and '--help' for the options. For each
+protocol, failure scenario and schedule it starts three stand-in servers (see benchmarks.standins) and a new client,
+makes requests from several threads at once, and reports requests per second, the 50th and 99th percentile latency,
+and the number of requests that failed altogether.
+"""
+from benchmarks.standins import StandInLdapServer, StandInRadiusServer, RIGHT_PASSWORD
+from client_of_redundant_servers.client_of_redundant_ad_ldap_servers import ClientOfRedundantAdLdapServers
+from client_of_redundant_servers.client_of_redundant_radius_servers import ClientOfRedundantRadiusServers
+from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
+from collections import OrderedDict
+import argparse
+import itertools
+import logging
+import threading
+import time
+
+logging.disable(logging.CRITICAL)
+
+SECRET = b'benchmark'
+
+# The faults injected into each of the three servers, by scenario.
+SCENARIOS = OrderedDict([
+    ('healthy', [{}, {}, {}]),
+    ('one slow', [{'latency': 0.02}, {}, {}]),
+    ('lossy', [{'loss': 0.05}, {'loss': 0.05}, {'loss': 0.05}]),
+    ('one dead', [{'dead': True}, {}, {}]),
+    ('two dead', [{'dead': True}, {'dead': True}, {}]),
+])
+
+SCHEDULES = ('round-robin', 'random', 'fixed', 'ewma', 'least-outstanding', 'power-of-two', 'weighted')
+
+
+def percentile(sorted_values: list, q: float):
+    """Return the value below which a fraction 'q' of the sorted values fall, by the nearest rank."""
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def start_servers(protocol, faults, latency):
+    """Start a stand-in server for each entry of 'faults', each on its own loopback address. Returns the servers
+       and the server_dict of a client of them."""
+    servers = []
+    server_dict = OrderedDict()
+    for i, server_faults in enumerate(faults):
+        host = '127.0.0.' + str(i + 1)
+        server_faults = dict(server_faults, latency=server_faults.get('latency', 0.0) + latency)
+        if protocol == 'radius':
+            server = StandInRadiusServer(host, SECRET, **server_faults)
+            server_dict[host] = {'auth_port': server.port, 'secret': SECRET}
+        else:
+            server = StandInLdapServer(host, **server_faults)
+            server_dict[host] = {'port': server.port, 'ssl': False, 'validate': False}
+        servers.append(server)
+    return servers, server_dict
+
+
+def make_client(protocol, server_dict, schedule, args):
+    if protocol == 'radius':
+        client = ClientOfRedundantRadiusServers(server_dict, 'benchmark', schedule=schedule,
+                                                server_timeout=args.timeout, server_retries=2,
+                                                pipelined=args.pipelined, adaptive_timeout=args.adaptive_timeout)
+        return client, client.radius_auth
+    # ldap3 only takes whole seconds for its timeouts.
+    client = ClientOfRedundantAdLdapServers(server_dict, 'dc=example,dc=com', schedule=schedule,
+                                            pool_size=args.pool_size, connect_timeout=1, receive_timeout=1)
+    return client, client.ldap_auth
+
+
+def run(auth, requests, concurrency):
+    """Make 'requests' requests with 'concurrency' threads. Returns the time taken, the sorted latencies of the
+       requests, and the number that failed."""
+    tickets = itertools.count()
+    latencies = []
+    failures = []
+
+    def worker():
+        my_latencies = []
+        my_failures = 0
+        while next(tickets) < requests:
+            started = time.perf_counter()
+            try:
+                auth('user', RIGHT_PASSWORD)
+            except AllAvailableServersFailed:
+                my_failures += 1
+            my_latencies.append(time.perf_counter() - started)
+        latencies.extend(my_latencies)
+        failures.append(my_failures)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sorted(latencies), sum(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--protocol', choices=('radius', 'ldap', 'both'), default='both')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help="a failure scenario to run (may be repeated; default: all)")
+    parser.add_argument('--schedule', action='append', choices=SCHEDULES,
+                        help="a schedule to run (may be repeated; default: all)")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per run")
+    parser.add_argument('--concurrency', type=int, default=8, help="threads making requests")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every reply of every server")
+    parser.add_argument('--timeout', type=float, default=0.1, help="RADIUS server_timeout")
+    parser.add_argument('--pipelined', action='store_true', help="use the pipelined RADIUS transport")
+    parser.add_argument('--adaptive-timeout', action='store_true', help="use adaptive RADIUS timeouts")
+    parser.add_argument('--pool-size', type=int, default=8, help="LDAP pool_size (0 for no pooling)")
+    args = parser.parse_args()
+
+    protocols = ('radius', 'ldap') if args.protocol == 'both' else (args.protocol,)
+    print("{:<8} {:<10} {:<18} {:>10} {:>10} {:>10} {:>8}".format('protocol', 'scenario', 'schedule', 'req/s',
+                                                                   'p50 ms', 'p99 ms', 'failed'))
+    for protocol in protocols:
+        for scenario in args.scenario or SCENARIOS:
+            for schedule in args.schedule or SCHEDULES:
+                servers, server_dict = start_servers(protocol, SCENARIOS[scenario], args.latency)
+                client, auth = make_client(protocol, server_dict, schedule, args)
+                try:
+                    seconds, latencies, failed = run(auth, args.requests, args.concurrency)
+                finally:
+                    client.close()
+                    for server in servers:
+                        server.close()
+                print("{:<8} {:<10} {:<18} {:>10.0f} {:>10.2f} {:>10.2f} {:>8}".format(
+                    protocol, scenario, schedule, args.requests / seconds, percentile(latencies, 0.5) * 1000,
+                    percentile(latencies, 0.99) * 1000, failed))
+
+
+if __name__ == '__main__':
+    main()
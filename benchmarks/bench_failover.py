@@ -0,0 +1,48 @@
+"""
+Microbenchmark of the failover loop in ClientOfRedundantServers.request.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+
+Run with 'python -m benchmarks.bench_failover' from the top of the repository. For each schedule and server count it
+reports requests per second when every server is healthy, and when every server but the last one fails.
+"""
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed
+from collections import OrderedDict
+import logging
+import timeit
+
+logging.disable(logging.CRITICAL)
+
+
+def healthy_func(server):
+    return True
+
+
+def make_failing_func(good_server):
+    def failing_func(server):
+        if server != good_server:
+            raise CurrentServerFailed
+        return True
+    return failing_func
+
+
+def bench(schedule, server_count, number):
+    server_dict = OrderedDict(('server' + str(i), None) for i in range(server_count))
+    # Quarantine is disabled so that every request walks the full failover path.
+    client = ClientOfRedundantServers(server_dict, schedule, failure_threshold=None)
+    healthy = timeit.timeit(lambda: client.request(healthy_func), number=number)
+    failing_func = make_failing_func('server' + str(server_count - 1))
+    failing = timeit.timeit(lambda: client.request(failing_func), number=number // server_count or 1)
+    return number / healthy, (number // server_count or 1) / failing
+
+
+def main():
+    print("{:<12} {:>8} {:>16} {:>16}".format('schedule', 'servers', 'healthy req/s', 'failover req/s'))
+    for schedule in ('round-robin', 'random', 'fixed', 'ewma', 'least-outstanding', 'power-of-two'):
+        for server_count in (2, 4, 16, 64):
+            healthy, failing = bench(schedule, server_count, 100000)
+            print("{:<12} {:>8} {:>16.0f} {:>16.0f}".format(schedule, server_count, healthy, failing))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Microbenchmark of the cost of logging server failures during an outage.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+
+Run with 'python -m benchmarks.bench_logging' from the top of the repository. Every server but the last one fails, so
+each request logs a failure for all the others, as during an outage. It reports requests per second and the number of
+lines logged with logging disabled, with every failure logged, and with failure logs rate limited.
+"""
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed
+from collections import OrderedDict
+import io
+import logging
+import timeit
+
+
+def make_failing_func(good_server):
+    def failing_func(server):
+        if server != good_server:
+            raise CurrentServerFailed
+        return True
+    return failing_func
+
+
+def bench(server_count, failure_log_interval, number):
+    server_dict = OrderedDict(('server' + str(i), None) for i in range(server_count))
+    # Quarantine is disabled so that every request fails over, as it would until the breakers open.
+    client = ClientOfRedundantServers(server_dict, 'round-robin', failure_threshold=None,
+                                      failure_log_interval=failure_log_interval)
+    failing_func = make_failing_func('server' + str(server_count - 1))
+    seconds = timeit.timeit(lambda: client.request(failing_func), number=number)
+    return number / seconds
+
+
+def main():
+    # Log to memory rather than the terminal, so the terminal's speed does not count, but formatting and the
+    # handler do.
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print("{:<24} {:>8} {:>16} {:>12}".format('logging', 'servers', 'outage req/s', 'lines'))
+    for server_count in (2, 4, 16):
+        for label, failure_log_interval, disabled in (('disabled', 0, True),
+                                                       ('every failure', 0, False),
+                                                       ('rate limited (10s)', 10, False)):
+            logging.disable(logging.CRITICAL if disabled else logging.NOTSET)
+            stream.seek(0)
+            stream.truncate()
+            rate = bench(server_count, failure_log_interval, 20000)
+            print("{:<24} {:>8} {:>16.0f} {:>12}".format(label, server_count, rate, stream.getvalue().count('\n')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Benchmark of starting many clients of redundant RADIUS servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+
+Run with 'python -m benchmarks.bench_radius_startup' from the top of the repository. For each number of clients it
+reports how long it takes to create them all and load their dictionaries, when every client parses the dictionary
+itself (as each client did before the dictionary cache), and when they share the cached one.
+"""
+from client_of_redundant_servers.client_of_redundant_radius_servers import ClientOfRedundantRadiusServers,\
+                                                                           clear_dictionary_cache
+from collections import OrderedDict
+import logging
+import time
+
+logging.disable(logging.CRITICAL)
+
+SERVER_DICT = OrderedDict([('radius0.example.com', {'auth_port': 1812, 'secret': b'xxxx'}),
+                           ('radius1.example.com', {'auth_port': 1812, 'secret': b'yyyy'})])
+
+
+def cold_start(client_count, shared):
+    clear_dictionary_cache()
+    started = time.perf_counter()
+    clients = []
+    for i in range(client_count):
+        if not shared:
+            clear_dictionary_cache()
+        client = ClientOfRedundantRadiusServers(SERVER_DICT, 'tenant' + str(i))
+        # The dictionary is loaded the first time it is used, so use it.
+        client.dictionary
+        clients.append(client)
+    return time.perf_counter() - started, len(set(id(client.dictionary) for client in clients))
+
+
+def main():
+    print("{:>8} {:>18} {:>18} {:>14}".format('clients', 'parsed each (ms)', 'shared (ms)', 'dictionaries'))
+    for client_count in (1, 10, 100, 1000):
+        unshared, _ = cold_start(client_count, False)
+        shared, dictionaries = cold_start(client_count, True)
+        print("{:>8} {:>18.1f} {:>18.1f} {:>14}".format(client_count, unshared * 1000, shared * 1000, dictionaries))
+
+
+if __name__ == '__main__':
+    main()
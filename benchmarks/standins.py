@@ -0,0 +1,272 @@
+"""
+Local stand-ins for RADIUS and LDAP servers, for benchmarks.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+
+Each stand-in runs in threads of its own, on a loopback address, and accepts any user whose password is 'right'.
+Faults can be injected: 'latency' seconds are added to every reply, a fraction 'loss' of requests are lost, and a
+'dead' server takes requests but never answers them. Every stand-in of a benchmark needs its own address, as the
+clients tell servers apart by host name, so they are given 127.0.0.1, 127.0.0.2 and so on, which Linux routes to the
+loopback interface. (On other systems, add the extra addresses to the loopback interface first.)
+"""
+from client_of_redundant_servers.client_of_redundant_radius_servers import default_dictionary, load_dictionary
+import heapq
+import random
+import socket
+import threading
+import time
+import pyrad.packet
+
+# The password that the stand-ins accept, for any user.
+RIGHT_PASSWORD = 'right'
+
+# How long a lost LDAP request takes to arrive, in seconds. LDAP runs over TCP, so a lost segment is not really lost,
+# it is retransmitted, after at least TCP's minimum retransmission timeout.
+TCP_RETRANSMIT_DELAY = 0.2
+
+
+class StandInServer(object):
+    """Base class for stand-in servers, which holds the injected faults, and the threads to stop on close()."""
+    def __init__(self, host, latency=0.0, loss=0.0, dead=False):
+        self.host = host
+        self.latency = latency
+        self.loss = loss
+        self.dead = dead
+        self._closed = False
+        self._threads = []
+
+    def _start(self, target, *args):
+        """More private method used to run 'target' in a daemon thread of the stand-in."""
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _lost(self):
+        """More private method used to decide whether a request is lost."""
+        return self.loss > 0 and random.random() < self.loss
+
+    def close(self):
+        """Public method used to stop the stand-in."""
+        self._closed = True
+        for thread in self._threads:
+            thread.join()
+
+
+class StandInRadiusServer(StandInServer):
+    """A RADIUS server on UDP, which answers Access-Request and Status-Server. Replies held back by 'latency' are
+       sent by a thread of their own, so a slow server still answers many requests at once, like a real one."""
+    def __init__(self, host, secret: bytes, latency=0.0, loss=0.0, dead=False, dict_file=default_dictionary):
+        super().__init__(host, latency, loss, dead)
+        self.secret = secret
+        self.dictionary = load_dictionary(dict_file)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, 0))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        # '_delayed' is a heap of the replies held back by 'latency', as tuples of when to send each, a sequence
+        # number to keep the order of replies due at once, the reply and its address.
+        self._delayed = []
+        self._delayed_ready = threading.Condition()
+        self._sequence = 0
+        self._start(self._serve)
+        if latency:
+            self._start(self._send_delayed)
+
+    def _serve(self):
+        """More private method, run by the receiving thread, used to answer requests until the stand-in is closed."""
+        while not self._closed:
+            try:
+                data, addr = self.socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            if self.dead or self._lost():
+                continue
+            try:
+                request = pyrad.packet.AuthPacket(packet=data, secret=self.secret, dict=self.dictionary)
+            except pyrad.packet.PacketError:
+                continue
+            reply = request.CreateReply()
+            if request.code == pyrad.packet.StatusServer:
+                reply.code = pyrad.packet.AccessAccept
+            elif request.PwDecrypt(request[2][0]) == RIGHT_PASSWORD:
+                reply.code = pyrad.packet.AccessAccept
+            else:
+                reply.code = pyrad.packet.AccessReject
+            if not self.latency:
+                self.socket.sendto(reply.ReplyPacket(), addr)
+                continue
+            with self._delayed_ready:
+                self._sequence += 1
+                heapq.heappush(self._delayed, (time.monotonic() + self.latency, self._sequence, reply.ReplyPacket(),
+                                               addr))
+                self._delayed_ready.notify()
+
+    def _send_delayed(self):
+        """More private method, run by the sending thread, used to send each held back reply when it is due."""
+        while not self._closed:
+            with self._delayed_ready:
+                if not self._delayed:
+                    self._delayed_ready.wait(0.1)
+                    continue
+                wait = self._delayed[0][0] - time.monotonic()
+                if wait > 0:
+                    self._delayed_ready.wait(wait)
+                    continue
+                _, _, raw_reply, addr = heapq.heappop(self._delayed)
+            self.socket.sendto(raw_reply, addr)
+
+    def close(self):
+        super().close()
+        self.socket.close()
+
+
+# The BER tags of the LDAP messages (RFC 4511) the LDAP stand-in reads and writes.
+BER_SEQUENCE = 0x30
+BER_INTEGER = 0x02
+BER_OCTET_STRING = 0x04
+BER_ENUMERATED = 0x0a
+LDAP_BIND_REQUEST = 0x60
+LDAP_BIND_RESPONSE = 0x61
+LDAP_UNBIND_REQUEST = 0x42
+LDAP_SEARCH_REQUEST = 0x63
+LDAP_SEARCH_RESULT_ENTRY = 0x64
+LDAP_SEARCH_RESULT_DONE = 0x65
+LDAP_SIMPLE_AUTHENTICATION = 0x80
+
+LDAP_SUCCESS = 0
+LDAP_INVALID_CREDENTIALS = 49
+
+
+def ber_read(data: bytes, offset: int):
+    """Public function used to read a BER tag, length and value starting at 'offset'. Returns the tag, the value and
+       the offset just after it, or None if 'data' does not hold all of it yet."""
+    if len(data) < offset + 2:
+        return None
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        length_octets = length & 0x7f
+        if len(data) < offset + length_octets:
+            return None
+        length = int.from_bytes(data[offset:offset + length_octets], 'big')
+        offset += length_octets
+    if len(data) < offset + length:
+        return None
+    return tag, data[offset:offset + length], offset + length
+
+
+def ber_write(tag: int, value: bytes):
+    """Public function used to encode a BER tag and value."""
+    length = len(value)
+    if length < 0x80:
+        return bytes((tag, length)) + value
+    length_octets = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((tag, 0x80 | len(length_octets))) + length_octets + value
+
+
+def ldap_message(message_id: int, op_tag: int, *fields):
+    """Public function used to encode an LDAP message with the given operation and fields, which are encoded
+       already."""
+    encoded_id = ber_write(BER_INTEGER, message_id.to_bytes((message_id.bit_length() + 8) // 8, 'big'))
+    return ber_write(BER_SEQUENCE, encoded_id + ber_write(op_tag, b''.join(fields)))
+
+
+def ldap_result(message_id: int, op_tag: int, result_code: int):
+    """Public function used to encode an LDAPResult, such as a BindResponse."""
+    return ldap_message(message_id, op_tag, ber_write(BER_ENUMERATED, bytes((result_code,))),
+                        ber_write(BER_OCTET_STRING, b''), ber_write(BER_OCTET_STRING, b''))
+
+
+class StandInLdapServer(StandInServer):
+    """An LDAP server on TCP, which understands just enough of LDAP for the client: a simple bind, which succeeds
+       anonymously or with the right password, and a search, which finds a single entry with no attributes once
+       the connection is bound. Each connection is served by a thread of its own. A lost request is answered after
+       TCP_RETRANSMIT_DELAY more seconds, and a dead server accepts connections but never answers."""
+    def __init__(self, host, latency=0.0, loss=0.0, dead=False):
+        super().__init__(host, latency, loss, dead)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, 0))
+        self.socket.listen(128)
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self._start(self._accept)
+
+    def _accept(self):
+        """More private method, run by the listening thread, used to accept connections until the stand-in is
+           closed."""
+        while not self._closed:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(0.1)
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        """More private method, run by the thread of a connection, used to answer its requests."""
+        buffer = b''
+        bound = False
+        try:
+            while not self._closed:
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    return
+                buffer += data
+                while True:
+                    message = ber_read(buffer, 0)
+                    if message is None:
+                        break
+                    buffer = buffer[message[2]:]
+                    if self.dead:
+                        continue
+                    delay = self.latency + (TCP_RETRANSMIT_DELAY if self._lost() else 0.0)
+                    if delay:
+                        time.sleep(delay)
+                    reply, bound = self._answer(message[1], bound)
+                    if reply is None:
+                        return
+                    conn.sendall(reply)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _answer(message: bytes, bound: bool):
+        """More private method used to answer an LDAP message. Returns the reply, or None to close the connection,
+           and whether the connection is now bound as a user."""
+        _, message_id, offset = ber_read(message, 0)
+        message_id = int.from_bytes(message_id, 'big')
+        op_tag, op, _ = ber_read(message, offset)
+        if op_tag == LDAP_BIND_REQUEST:
+            _, _, offset = ber_read(op, 0)
+            _, name, offset = ber_read(op, offset)
+            auth_tag, password, _ = ber_read(op, offset)
+            if auth_tag == LDAP_SIMPLE_AUTHENTICATION and (not name or password == RIGHT_PASSWORD.encode()):
+                return ldap_result(message_id, LDAP_BIND_RESPONSE, LDAP_SUCCESS), bool(name)
+            return ldap_result(message_id, LDAP_BIND_RESPONSE, LDAP_INVALID_CREDENTIALS), False
+        if op_tag == LDAP_SEARCH_REQUEST:
+            _, base, _ = ber_read(op, 0)
+            reply = b''
+            # The rootDSE can be read by anybody, anything else only once bound.
+            if not base or bound:
+                reply = ldap_message(message_id, LDAP_SEARCH_RESULT_ENTRY,
+                                     ber_write(BER_OCTET_STRING, b'cn=user,' + base if base else b''),
+                                     ber_write(BER_SEQUENCE, b''))
+            return reply + ldap_result(message_id, LDAP_SEARCH_RESULT_DONE, LDAP_SUCCESS), bound
+        if op_tag == LDAP_UNBIND_REQUEST:
+            return None, False
+        # Nothing else is needed by the client, so anything else is refused.
+        return ldap_result(message_id, op_tag + 1, 53), bound
+
+    def close(self):
+        super().close()
+        self.socket.close()
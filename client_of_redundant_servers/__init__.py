@@ -1,2 +1,8 @@
-__all__ = ['ClientOfRedundantServers', 'CurrentServerFailed', 'AllAvailableServersFailed']
+__all__ = ['ClientOfRedundantServers', 'CurrentServerFailed', 'CurrentServerTimedOut', 'AllAvailableServersFailed',
+           'ServerDescriptor', 'load_server_file']
 from client_of_redundant_servers.client_of_redundant_servers import *
+
+import logging
+
+# The library logs to the 'client_of_redundant_servers' loggers but leaves configuring logging to the application.
+logging.getLogger(__name__).addHandler(logging.NullHandler())
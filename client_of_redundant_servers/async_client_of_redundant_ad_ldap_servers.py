@@ -0,0 +1,47 @@
+"""
+Asyncio client of redundant Active Directory LDAP servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+import asyncio
+import functools
+from client_of_redundant_servers.async_client_of_redundant_servers import AsyncClientOfRedundantServers
+from client_of_redundant_servers.client_of_redundant_ad_ldap_servers import ClientOfRedundantAdLdapServers
+
+
+class AsyncClientOfRedundantAdLdapServers(ClientOfRedundantAdLdapServers, AsyncClientOfRedundantServers):
+    """Stores information about how to query (Active Directory) LDAP servers, and provides a simple asyncio interface
+       for requests. ldap3 has no asyncio support, so each bind and search runs in an executor and the event loop
+       only waits for the result."""
+    def __init__(self, *args, executor=None, **kwargs):
+        # 'executor' is the concurrent.futures.Executor used to run LDAP requests, or None to use the default
+        # executor of the event loop. Its number of workers bounds the number of LDAP requests in flight.
+        self.executor = executor
+        super().__init__(*args, **kwargs)
+
+    async def _async_ldap_auth_func(self, server, **kwargs):
+        """More private coroutine used to authenticate a user and password against the current LDAP server. Returns
+           False if the user is rejected, True if the user is accepted. Raises CurrentServerFailed if there was an
+           error with the request (such as a timeout)."""
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(self._ldap_auth_func, server, **kwargs))
+
+    async def _health_check_func(self, server):
+        """More private coroutine used by the health checks to check an LDAP server, with a bind and a rootDSE read
+           in the executor."""
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(self._ldap_status_func, server))
+
+    async def ldap_auth(self, ldap_uid: str, ldap_pass: str):
+        """Public coroutine used to authenticate a user and password against any available LDAP server. Returns
+           False if the user is rejected, True if the user is accepted. Raises AllAvailableServersFailed if no LDAP
+           server responded to a request in a useful way."""
+        return await self.request(self._async_ldap_auth_func, ldap_uid=ldap_uid, ldap_pass=ldap_pass)
+
+    def ldap_auth_many(self, credentials, concurrency=8):
+        """Public method used to authenticate many users, up to 'concurrency' at a time, spread over the available
+           LDAP servers. The argument credentials is an iterable of (user, password) tuples. Returns an iterator of
+           awaitables in the same order, which give True if the user is accepted, False if the user is rejected, or
+           an AllAvailableServersFailed instance if no server responded in a useful way."""
+        kwargs_iterable = ({'ldap_uid': ldap_uid, 'ldap_pass': ldap_pass} for ldap_uid, ldap_pass in credentials)
+        return self.request_many(self._async_ldap_auth_func, kwargs_iterable, concurrency)
@@ -0,0 +1,194 @@
+"""
+Asyncio client of redundant RADIUS servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+import asyncio
+import pyrad.client
+import pyrad.packet
+from client_of_redundant_servers.async_client_of_redundant_servers import AsyncClientOfRedundantServers
+from client_of_redundant_servers.client_of_redundant_radius_servers import ClientOfRedundantRadiusServers,\
+                                                                           MAX_OUTSTANDING
+import time
+from client_of_redundant_servers.client_of_redundant_servers import CurrentServerFailed, CurrentServerTimedOut
+
+
+class RadiusDatagramProtocol(asyncio.DatagramProtocol):
+    """A UDP socket connected to a single RADIUS server, which can have many requests outstanding at once. Replies
+       are matched to requests by packet identifier, and checked against the request authenticator."""
+    def __init__(self):
+        self.transport = None
+        # '_pending' maps the identifier of each outstanding request to a tuple of the request and its future.
+        self._pending = {}
+        self._next_id = 0
+        self._slots = asyncio.Semaphore(MAX_OUTSTANDING)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 20:
+            return
+        pending = self._pending.get(data[1])
+        if pending is None:
+            # A late reply to a request we already gave up on.
+            return
+        request, future = pending
+        try:
+            reply = request.CreateReply(packet=data)
+        except pyrad.packet.PacketError:
+            return
+        if request.VerifyReply(reply, data) and not future.done():
+            future.set_result(reply)
+
+    def error_received(self, exc):
+        # Usually an ICMP port unreachable, so every outstanding request to this server has failed.
+        self._fail_pending(exc)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._fail_pending(exc or ConnectionError("Connection lost"))
+
+    def _fail_pending(self, exc):
+        for _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def _allocate_id(self):
+        """More private method used to find a packet identifier that is not in use by an outstanding request."""
+        while self._next_id in self._pending:
+            self._next_id = (self._next_id + 1) % MAX_OUTSTANDING
+        packet_id = self._next_id
+        self._next_id = (self._next_id + 1) % MAX_OUTSTANDING
+        return packet_id
+
+    async def send_packet(self, create_packet, timeouts, rtt_estimator=None):
+        """Public coroutine used to send a request and wait for the matching reply. The argument create_packet is
+           called with a free packet identifier and must return the request packet. The request is sent unchanged
+           once for each entry of 'timeouts', waiting that many seconds for a reply each time. If an RttEstimator is
+           given, it is kept up to date. Raises pyrad.client.Timeout if there is no reply."""
+        async with self._slots:
+            packet_id = self._allocate_id()
+            request = create_packet(packet_id)
+            future = asyncio.get_event_loop().create_future()
+            self._pending[packet_id] = (request, future)
+            try:
+                raw_request = request.RequestPacket()
+                for attempt, timeout in enumerate(timeouts):
+                    if self.transport is None:
+                        raise ConnectionError("Connection lost")
+                    sent = time.monotonic()
+                    self.transport.sendto(raw_request)
+                    try:
+                        reply = await asyncio.wait_for(asyncio.shield(future), timeout)
+                    except asyncio.TimeoutError:
+                        if rtt_estimator is not None:
+                            rtt_estimator.backoff()
+                        continue
+                    if rtt_estimator is not None and attempt == 0:
+                        rtt_estimator.sample(time.monotonic() - sent)
+                    return reply
+                raise pyrad.client.Timeout
+            finally:
+                del self._pending[packet_id]
+
+
+class AsyncClientOfRedundantRadiusServers(ClientOfRedundantRadiusServers, AsyncClientOfRedundantServers):
+    """Stores information about how to query RADIUS servers, and provides a simple asyncio interface for requests.
+       One UDP socket is opened per server on first use, and is shared by every request to that server."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # '_protocols' holds the RadiusDatagramProtocol for each server that we have talked to so far.
+        self._protocols = {}
+
+    async def _get_protocol(self, server):
+        """More private coroutine used to get the RadiusDatagramProtocol for a server, opening its socket if
+           needed."""
+        protocol = self._protocols.get(server)
+        if protocol is not None and protocol.transport is not None:
+            return protocol
+
+        local_addr = None
+        if self.client_bind_ip is not None:
+            # Binding to port 0 is the official way to bind to a OS-assigned random port.
+            local_addr = (self.client_bind_ip, 0)
+        _, new_protocol = await asyncio.get_event_loop().create_datagram_endpoint(
+            RadiusDatagramProtocol,
+            remote_addr=(server.host(), server.auth_port),
+            local_addr=local_addr)
+
+        protocol = self._protocols.get(server)
+        if protocol is not None and protocol.transport is not None:
+            # Somebody else opened a socket while we were waiting, so use theirs.
+            new_protocol.transport.close()
+            return protocol
+        self._protocols[server] = new_protocol
+        return new_protocol
+
+    async def _async_radius_auth_func(self, server, **kwargs):
+        """More private coroutine used to authenticate a user and password against the current RADIUS server.
+           Returns False if the user is rejected, True if the user is accepted. Raises CurrentServerFailed if there
+           was an error with the request (such as a timeout)."""
+        reply = await self._async_send_packet(
+            server, pyrad.packet.AccessRequest,
+            lambda req: self._add_credentials(req, kwargs['user'], kwargs['password']), kwargs)
+        if reply.code == pyrad.packet.AccessAccept:
+            return True
+        else:
+            return False
+
+    async def _async_radius_status_func(self, server):
+        """More private coroutine used to check that the current RADIUS server is up, with a Status-Server request
+           (RFC 5997). Returns True if the server answered. Raises CurrentServerFailed if it did not."""
+        await self._async_send_packet(server, pyrad.packet.StatusServer, self._add_message_authenticator, {})
+        return True
+
+    async def _health_check_func(self, server):
+        """More private coroutine used by the health checks to check a RADIUS server, with Status-Server."""
+        return await self._async_radius_status_func(server)
+
+    async def _async_send_packet(self, server, code, prepare, kwargs: dict):
+        """More private coroutine used to send a request with the given code to the current RADIUS server, and
+           return the reply. The argument prepare is called with the new request, to add its attributes. Raises
+           CurrentServerTimedOut if there was no reply, or CurrentServerFailed if there was some other error."""
+        # As in _send_packet, a dictionary file which has gone or can't be parsed is not a failure of the server.
+        dictionary = self.dictionary
+        try:
+            protocol = await self._get_protocol(server)
+            return await protocol.send_packet(
+                lambda packet_id: self._create_packet(server, code, packet_id, prepare, dictionary),
+                self._reply_timeouts(server, kwargs), self._rtt_estimators.get(server))
+        except pyrad.client.Timeout:
+            raise CurrentServerTimedOut
+        except (pyrad.packet.PacketError, OSError):
+            raise CurrentServerFailed
+
+    async def radius_auth(self, user: str, password: str):
+        """Public coroutine used to authenticate a user and password against any available RADIUS server. Returns
+           False if the user is rejected, True if the user is accepted. Raises AllAvailableServersFailed if no
+           RADIUS server responded to a request in a useful way."""
+        return await self.request(self._async_radius_auth_func, user=user, password=password)
+
+    def radius_auth_many(self, credentials, concurrency=8):
+        """Public method used to authenticate many users, up to 'concurrency' at a time, spread over the available
+           RADIUS servers. The argument credentials is an iterable of (user, password) tuples. Returns an iterator of
+           awaitables in the same order, which give True if the user is accepted, False if the user is rejected, or
+           an AllAvailableServersFailed instance if no server responded in a useful way."""
+        kwargs_iterable = ({'user': user, 'password': password} for user, password in credentials)
+        return self.request_many(self._async_radius_auth_func, kwargs_iterable, concurrency)
+
+    def _server_drained(self, server):
+        """More private method used to close the socket of a RADIUS server that has been removed."""
+        super()._server_drained(server)
+        protocol = self._protocols.pop(server, None)
+        if protocol is not None and protocol.transport is not None:
+            protocol.transport.close()
+
+    def close(self):
+        """Public method used to close every socket opened by this client."""
+        super().close()
+        for protocol in self._protocols.values():
+            if protocol.transport is not None:
+                protocol.transport.close()
+        self._protocols.clear()
@@ -0,0 +1,319 @@
+"""
+Generic asyncio client of redundant servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers,\
+                                                                    CurrentServerFailed,\
+                                                                    AllAvailableServersFailed,\
+                                                                    load_server_file
+from client_of_redundant_servers.metrics import FAILURE, TIMEOUT, CANCELLED, outcome_of
+from collections import deque
+import asyncio
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClientOfRedundantServers(ClientOfRedundantServers):
+    """Stores information about how to query servers, and provides a simple asyncio interface for requests. Servers
+       are scheduled and failed over exactly as in ClientOfRedundantServers, but func_to_call is a coroutine function
+       so that a request never blocks the event loop."""
+
+    async def request(self, func_to_call, **kwargs):
+        """Public coroutine used to make a request of any available server. Returns a useful result if the request
+           succeeds. Raises AllAvailableServersFailed if no server responded to a request in a useful way. The
+           argument func_to_call is a coroutine function that will be awaited against each server in turn."""
+        if self.result_cache is None:
+            return await self._request_single_flight(func_to_call, kwargs)
+        key, group = self.result_cache.make_keys(kwargs, self._cache_secret_kwargs, func_to_call)
+        found, result = self.result_cache.get(key)
+        if found:
+            return result
+        result = await self._request_single_flight(func_to_call, kwargs)
+        self.result_cache.put(key, group, result)
+        return result
+
+    def request_many(self, func_to_call, kwargs_iterable, concurrency=8):
+        """Public method used to make many requests, up to 'concurrency' at a time. The argument kwargs_iterable
+           gives the keyword arguments of each request, and may be a generator of any length. Returns an iterator of
+           awaitables, one per request in the same order, like asyncio.as_completed: await each in turn to get its
+           result. An exception raised by a request (such as AllAvailableServersFailed) is returned in place of its
+           result, so that one failure does not end the batch. Must be iterated while the event loop is running."""
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("concurrency must be a positive integer")
+        return self._request_many(func_to_call, iter(kwargs_iterable), concurrency)
+
+    def _request_many(self, func_to_call, kwargs_iterator, concurrency: int):
+        """More private generator used by request_many, which starts the next request each time the caller moves on
+           to the next result."""
+        window = deque()
+        try:
+            for kwargs in itertools.islice(kwargs_iterator, concurrency):
+                window.append(asyncio.ensure_future(self._request_or_error(func_to_call, kwargs)))
+            while window:
+                yield window.popleft()
+                for kwargs in itertools.islice(kwargs_iterator, 1):
+                    window.append(asyncio.ensure_future(self._request_or_error(func_to_call, kwargs)))
+        finally:
+            # If the caller stops early, cancel the requests still in flight.
+            for task in window:
+                task.cancel()
+
+    async def _request_or_error(self, func_to_call, kwargs: dict):
+        """More private coroutine used to make a request, returning the exception it raises instead of raising
+           it."""
+        try:
+            return await self.request(func_to_call, **kwargs)
+        except Exception as e:
+            return e
+
+    def start_health_checks(self, interval=10, check_func=None):
+        """Public method used to start checking the health of every server in the background, every 'interval'
+           seconds, as ClientOfRedundantServers does, but in a task rather than a thread. The argument check_func is
+           a coroutine function. Must be called while the event loop is running. Returns the task, which runs until
+           stop_health_checks() or close() is called."""
+        check_func = self._get_check_func(check_func)
+        if self._health_checks is not None:
+            raise RuntimeError("Health checks are already running")
+        self._health_checks = asyncio.ensure_future(self._health_check_loop(interval, check_func))
+        return self._health_checks
+
+    def stop_health_checks(self):
+        """Public method used to stop the background health checks, if they are running."""
+        if self._health_checks is not None:
+            self._health_checks.cancel()
+            self._health_checks = None
+
+    async def check_health(self, check_func=None):
+        """Public coroutine used to check the health of every server once, as the background health checks do. The
+           servers are checked at the same time."""
+        check_func = self._get_check_func(check_func)
+        await asyncio.gather(*[self._check_server(check_func, server) for server in self.server_list])
+
+    async def _check_server(self, check_func, server):
+        """More private coroutine used to check the health of a single server. The check is counted as a request in
+           flight, so a server removed meanwhile isn't closed under it."""
+        started = self._attempt_started(server)
+        if started is None:
+            return
+        try:
+            healthy = await check_func(server)
+        except CurrentServerFailed:
+            healthy = False
+        finally:
+            self._check_finished(server)
+        self._record_health_check(server, healthy, time.monotonic() - started)
+
+    async def _health_check_loop(self, interval, check_func):
+        """More private coroutine, run as the health check task, used to check every server every 'interval'
+           seconds."""
+        while True:
+            try:
+                await self.check_health(check_func)
+            except Exception:
+                logger.exception("Health check failed.")
+            await asyncio.sleep(interval)
+
+    def start_watching_server_file(self, path, parse_func=None, interval=5):
+        """Public method used to reload the servers whenever a file changes, as ClientOfRedundantServers does, but
+           in a task rather than a thread. Must be called while the event loop is running. Returns the task, which
+           runs until stop_watching_server_file() or close() is called."""
+        if self._server_file_watch is not None:
+            raise RuntimeError("A server file is already being watched")
+        self._server_file_watch = asyncio.ensure_future(self._server_file_loop(
+            path, parse_func or load_server_file, interval, self._server_file_mtime(path)))
+        return self._server_file_watch
+
+    def stop_watching_server_file(self):
+        """Public method used to stop watching the server file, if it is being watched."""
+        if self._server_file_watch is not None:
+            self._server_file_watch.cancel()
+            self._server_file_watch = None
+
+    async def _server_file_loop(self, path, parse_func, interval, mtime):
+        """More private coroutine, run as the server file task, used to reload the servers from the file whenever its
+           modification time is no longer 'mtime'."""
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self._reload_server_file(path, parse_func, mtime)
+
+    async def _request_single_flight(self, func_to_call, kwargs: dict):
+        """More private coroutine used to make a request, or if 'coalesce' is set and an identical request is already
+           in flight, to wait for that one and share its result or exception. The shared request runs as a task of
+           its own, so a caller being cancelled does not cancel it for the others."""
+        key = self._flight_key(func_to_call, kwargs)
+        if key is None:
+            return await self._request(func_to_call, kwargs)
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._request(func_to_call, kwargs))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flight_finished(key, flight))
+        return await asyncio.shield(flight)
+
+    def _flight_finished(self, key, flight):
+        """More private method used to forget a shared request once it has finished."""
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.cancelled():
+            # Retrieve the exception, so asyncio does not complain if every caller was cancelled.
+            flight.exception()
+
+    async def _request(self, func_to_call, kwargs: dict):
+        """More private coroutine used to make a request of any available server, without the result cache."""
+        if self.hedge_delay is not None:
+            return await self._request_hedged(func_to_call, kwargs)
+
+        requested = time.monotonic()
+        server_list, start = self._order(kwargs)
+        deadline = self._deadline()
+        attempts_left = len(server_list)
+        outcome = FAILURE
+        for current_server in self._failover_order(server_list, start):
+            attempt_kwargs = self._budgeted_kwargs(kwargs, deadline, attempts_left)
+            if attempt_kwargs is None:
+                logger.error("Request timed out.")
+                outcome = TIMEOUT
+                break
+            started = self._attempt_started(current_server)
+            if started is None:
+                continue
+            attempts_left -= 1
+            attempt_outcome = CANCELLED
+            try:
+                # Do something with current server
+                attempt = func_to_call(current_server, **attempt_kwargs)
+                if deadline is not None:
+                    # Unlike a thread, a coroutine can be stopped once its time budget is spent, so an attempt that
+                    # overruns counts as a failure of the server.
+                    attempt = asyncio.wait_for(attempt, attempt_kwargs['time_budget'])
+                result = await attempt
+                attempt_outcome = outcome_of(result)
+            except CurrentServerFailed as e:
+                attempt_outcome = self._failure_outcome(e)
+                self._record_failure(current_server)
+                continue
+            except asyncio.TimeoutError:
+                attempt_outcome = TIMEOUT
+                self._record_failure(current_server)
+                continue
+            except Exception:
+                attempt_outcome = FAILURE
+                raise
+            finally:
+                self._attempt_finished(current_server, started, attempt_outcome)
+            self._record_success(current_server)
+            self._request_finished(attempt_outcome, len(server_list) - attempts_left, requested)
+            return result
+
+        logger.error("All available servers failed.")
+        self._request_finished(outcome, len(server_list) - attempts_left, requested)
+        raise AllAvailableServersFailed()
+
+    async def _request_hedged(self, func_to_call, kwargs: dict):
+        """More private coroutine used to make a hedged request. Servers are started in the usual failover order, but
+           a slow server only holds up the next one for the hedge delay. The first useful result is returned, and
+           any requests still outstanding are cancelled."""
+        self._earn_hedge_token()
+        requested = time.monotonic()
+        server_list, start = self._order(kwargs)
+        order = self._failover_order(server_list, start)
+        deadline = self._deadline()
+        pending = {}
+        extra_sent = 0
+        depth = 0
+        outcome = FAILURE
+
+        current_server = self._start_next_hedged(func_to_call, order, kwargs, deadline, pending)
+        if current_server is not None:
+            depth += 1
+
+        try:
+            while pending:
+                timeout = None
+                if current_server is not None and self._can_hedge(extra_sent):
+                    timeout = self._hedge_delay_for(current_server)
+                timeout = self._until_deadline(deadline, timeout)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if self._until_deadline(deadline) == 0:
+                        # The requests still in flight are cancelled on the way out.
+                        logger.error("Request timed out.")
+                        outcome = TIMEOUT
+                        break
+                    # The current server is slow, so hedge with the next one.
+                    if not self._take_hedge_token():
+                        # Other requests spent the allowance while we were waiting.
+                        extra_sent = self.hedge_max_extra
+                        continue
+                    current_server = self._start_next_hedged(func_to_call, order, kwargs, deadline, pending)
+                    if current_server is None:
+                        self._refund_hedge_token()
+                        continue
+                    extra_sent += 1
+                    depth += 1
+                    continue
+
+                for task in done:
+                    server = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except CurrentServerFailed:
+                        self._record_failure(server)
+                        if self._until_deadline(deadline) == 0:
+                            # There is no time left to fail over, so the request has timed out.
+                            outcome = TIMEOUT
+                            current_server = None
+                            continue
+                        # Replace the failed server with the next one, which is failover rather than extra load.
+                        current_server = self._start_next_hedged(func_to_call, order, kwargs, deadline, pending)
+                        if current_server is not None:
+                            depth += 1
+                        continue
+                    self._record_success(server)
+                    self._request_finished(outcome_of(result), depth, requested)
+                    return result
+        finally:
+            for task in pending:
+                task.cancel()
+
+        logger.error("All available servers failed.")
+        self._request_finished(outcome, depth, requested)
+        raise AllAvailableServersFailed()
+
+    def _start_next_hedged(self, func_to_call, order, kwargs: dict, deadline, pending: dict):
+        """More private method used to start func_to_call against the next server from the failover order that can
+           still be used, adding its task to 'pending'. Returns the server, or None if there are no more."""
+        for server in order:
+            task = self._start_hedged(func_to_call, server, kwargs, deadline)
+            if task is not None:
+                pending[task] = server
+                return server
+        return None
+
+    def _start_hedged(self, func_to_call, server, kwargs: dict, deadline):
+        """More private method used to start func_to_call against a server as a task. Returns the task, or None if
+           the server has been removed by update_servers. Hedged attempts run side by side, so each may take all the
+           time left before the deadline."""
+        attempt_kwargs = self._budgeted_kwargs(kwargs, deadline, 1)
+        if attempt_kwargs is None:
+            # The deadline has only just passed, so this attempt is cancelled as soon as it is waited for.
+            attempt_kwargs = dict(kwargs, time_budget=0.0)
+        started = self._attempt_started(server)
+        if started is None:
+            return None
+        task = asyncio.ensure_future(func_to_call(server, **attempt_kwargs))
+        task.add_done_callback(lambda _: self._attempt_finished(server, started, self._task_outcome(task, deadline)))
+        return task
+
+    def _task_outcome(self, task, deadline):
+        """More private method used to get the outcome of a finished hedged attempt, from its task. An attempt
+           cancelled because the deadline passed timed out, rather than losing the race to another server."""
+        if task.cancelled() and deadline is not None and self._until_deadline(deadline) == 0:
+            return TIMEOUT
+        return self._future_outcome(task)
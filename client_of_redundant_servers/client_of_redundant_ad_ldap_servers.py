@@ -6,18 +6,243 @@ Client of redundant Active Directory LDAP servers.
 import ldap3
 import ldap3.core.exceptions
 from ldap3.core.tls import Tls, ssl
-from client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed
-from collections import OrderedDict
+from ldap3.utils.conv import escape_filter_chars
+from client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed, CurrentServerTimedOut,\
+                                        ServerDescriptor
+from collections import OrderedDict, deque
+import socket
+import threading
+import time
+
+# The ldap3 exceptions raised by what the caller asked for, such as an empty password, before anything is sent to the
+# server. They reject the user, and don't count against the server.
+CALLER_ERRORS = (ldap3.core.exceptions.LDAPPasswordIsMandatoryError,
+                 ldap3.core.exceptions.LDAPUserNameIsMandatoryError,
+                 ldap3.core.exceptions.LDAPInvalidFilterError)
+
+
+class LdapServer(ServerDescriptor):
+    """The validated configuration of a single LDAP server, along with the ldap3 Server (and its TLS settings) built
+       from it once, to be shared by every connection to that server. If 'connect_timeout' is given, opening a
+       connection to the server gives up after that many seconds. If the configuration gives the server's 'address',
+       connections are made to it without resolving the name, but the certificate is still checked against the
+       name."""
+    __slots__ = ('port', 'use_ssl', 'validate', 'address', 'connect_timeout', 'ldap_server')
+
+    def __init__(self, name, config, connect_timeout=None):
+        super().__init__(name)
+        try:
+            port = config['port']
+            use_ssl = config['ssl']
+            validate = config['validate']
+        except (KeyError, TypeError):
+            raise ValueError("LDAP server " + str(name) + " needs a 'port', 'ssl' and 'validate'")
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError("LDAP server " + str(name) + " has an invalid 'port'")
+        address = config.get('address')
+        if address is not None and not isinstance(address, str):
+            raise ValueError("LDAP server " + str(name) + " has an invalid 'address'")
+        self._set('port', port)
+        self._set('use_ssl', bool(use_ssl))
+        self._set('validate', bool(validate))
+        self._set('address', address)
+        self._set('connect_timeout', connect_timeout)
+
+        server_kwargs = {'port': port}
+        if use_ssl:
+            server_kwargs['use_ssl'] = True
+            if validate and address is not None:
+                server_kwargs['tls'] = Tls(validate=ssl.CERT_REQUIRED, valid_names=[name], sni=name)
+            elif validate:
+                server_kwargs['tls'] = Tls(validate=ssl.CERT_REQUIRED)
+        if connect_timeout is not None:
+            server_kwargs['connect_timeout'] = connect_timeout
+        self._set('ldap_server', ldap3.Server(name if address is None else address, **server_kwargs))
+
+
+class _ConnectTimeoutServer(object):
+    """Stands in for a shared ldap3 Server when a single connection must open sooner than the Server's own
+       'connect_timeout' allows, such as within the time left to an attempt. ldap3 takes the connect timeout from
+       the Server, so this gives the connection one of its own, and leaves everything else, such as the resolved
+       address and the schema read from the server, to the shared Server."""
+    def __init__(self, ldap_server, connect_timeout):
+        object.__setattr__(self, '_ldap_server', ldap_server)
+        object.__setattr__(self, 'connect_timeout', connect_timeout)
+
+    def __getattr__(self, attribute):
+        return getattr(self._ldap_server, attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._ldap_server, attribute, value)
+
+    def __str__(self):
+        return str(self._ldap_server)
+
+
+def time_left(deadline, limit=None):
+    """Public function used to get how long the next step of an attempt may wait, if the attempt must be over by
+       'deadline', in the time of time.monotonic: the time left, but no longer than 'limit' seconds. Either may be
+       None for no limit, and None is returned if both are. Raises LDAPResponseTimeoutError if the deadline has
+       passed, as ldap3 does when a response does not arrive in time."""
+    if deadline is None:
+        return limit
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise ldap3.core.exceptions.LDAPResponseTimeoutError('no time left')
+    return left if limit is None else min(left, limit)
+
+
+def read_root_dse(conn):
+    """Public function used to read the rootDSE of the server a connection is open to, which every LDAP server lets
+       anybody read, to check that the server is working. Returns True if it was read."""
+    return conn.search('', '(objectClass=*)', search_scope=ldap3.BASE, attributes=['1.1'])
+
+
+def set_receive_timeout(conn, seconds):
+    """Public function used to make an open connection give up waiting for each response after 'seconds', which
+       may be a fraction of a second, or wait for as long as the operating system does if it is None. ldap3's own
+       'receive_timeout' only takes whole seconds, and only when a connection is opened, so the timeout is set on
+       the socket instead."""
+    conn_socket = getattr(conn, 'socket', None)
+    if conn_socket is not None:
+        conn_socket.settimeout(seconds)
+
+
+def open_connection(ldap_server, user=None, password=None, bind=True, receive_timeout=None, deadline=None,
+                    connect_timeout=None):
+    """Public function used to open an ldap3 Connection to a server and, if 'bind' is True, to bind it as the
+       user (or anonymously, if the user is None). The bind waits for no longer than 'receive_timeout'. If
+       'deadline' is given, in the time of time.monotonic, opening the connection and the bind must both be over by
+       then; 'connect_timeout' must then be the connect timeout the ldap3 Server was built with. Raises
+       LDAPBindError if the bind is refused, or another ldap3 LDAPException if the connection can't be opened in
+       time, in which case the connection is closed."""
+    if deadline is not None:
+        time_to_connect = time_left(deadline, connect_timeout)
+        if time_to_connect != connect_timeout:
+            ldap_server = _ConnectTimeoutServer(ldap_server, time_to_connect)
+    conn = ldap3.Connection(ldap_server, user, password)
+    try:
+        conn.open()
+        set_receive_timeout(conn, time_left(deadline, receive_timeout))
+        if bind and not conn.bind():
+            raise ldap3.core.exceptions.LDAPBindError('unable to bind')
+    except ldap3.core.exceptions.LDAPException:
+        LdapConnectionPool.discard(conn)
+        raise
+    return conn
+
+
+class LdapConnectionPool(object):
+    """Keeps open ldap3 Connections to a single LDAP server for reuse, so that requests don't each pay for a TCP and
+       TLS handshake. If 'user' is given, new connections are bound as that user (for example a service account),
+       otherwise they are opened but left unbound for the caller to rebind. At most 'max_size' idle connections are
+       kept, and any left idle for more than 'idle_timeout' seconds are closed. A connection that has been idle for
+       more than 'health_check_interval' seconds is checked with a rootDSE read before it is handed out again. If
+       'receive_timeout' is given, connections give up waiting for a response after that many seconds, and
+       'connect_timeout' must be the connect timeout the ldap3 Server was built with."""
+
+    health_check_interval = 30
+
+    def __init__(self, ldap_server, max_size=10, idle_timeout=60, user=None, password=None, clock=time.monotonic,
+                 receive_timeout=None, connect_timeout=None):
+        self.ldap_server = ldap_server
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.user = user
+        self.password = password
+        self.receive_timeout = receive_timeout
+        self.connect_timeout = connect_timeout
+        self._clock = clock
+        # '_idle' holds tuples of an idle connection and the time it was last used, oldest on the left.
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def checkout(self, deadline=None):
+        """Public method used to take a connection from the pool, or to open a new one if none are idle. If
+           'deadline' is given, in the time of time.monotonic, checking an idle connection, or opening and binding a
+           new one, must be over by then. Raises an ldap3 LDAPException if a new connection can't be opened in
+           time."""
+        now = self._clock()
+        while True:
+            # Checked before a connection is taken, so that none is lost if there is no time left.
+            receive_timeout = time_left(deadline, self.receive_timeout)
+            with self._lock:
+                if not self._idle:
+                    break
+                # The most recently used connection is the least likely to have been dropped by the server.
+                conn, last_used = self._idle.pop()
+            if conn.closed or now - last_used > self.idle_timeout:
+                self.discard(conn)
+                continue
+            set_receive_timeout(conn, receive_timeout)
+            if now - last_used > self.health_check_interval and not self._healthy(conn):
+                self.discard(conn)
+                continue
+            return conn
+
+        # Without a user, connections are left unbound for the caller to rebind.
+        return open_connection(self.ldap_server, self.user, self.password, bind=self.user is not None,
+                               receive_timeout=self.receive_timeout, deadline=deadline,
+                               connect_timeout=self.connect_timeout)
+
+    def checkin(self, conn):
+        """Public method used to give a connection back to the pool once a request has finished with it."""
+        now = self._clock()
+        evicted = []
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                evicted.append(self._idle.popleft()[0])
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, now))
+            else:
+                evicted.append(conn)
+        for idle_conn in evicted:
+            self.discard(idle_conn)
+
+    @staticmethod
+    def discard(conn):
+        """Public method used to close a connection which is not going back to the pool, for example because it
+           raised an error."""
+        try:
+            conn.unbind()
+        except ldap3.core.exceptions.LDAPException:
+            pass
+
+    @staticmethod
+    def _healthy(conn):
+        """More private method used to check that an idle connection still works, by reading the rootDSE."""
+        try:
+            return read_root_dse(conn)
+        except ldap3.core.exceptions.LDAPException:
+            return False
+
+    def close(self):
+        """Public method used to close every idle connection."""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self.discard(conn)
 
 
 class ClientOfRedundantAdLdapServers(ClientOfRedundantServers):
     """Stores information about how to query (Active Directory) LDAP servers, and provides a simple interface for
        requests."""
+    _cache_secret_kwargs = ('ldap_pass',)
+    _schedule_key_kwarg = 'ldap_uid'
+
     def __init__(self,
                  server_dict: OrderedDict,
                  ldap_search_base: str,
                  schedule='round-robin',
-                 ad_domain=None):
+                 ad_domain=None,
+                 pool_size=0,
+                 pool_idle_timeout=60,
+                 service_user=None,
+                 service_password=None,
+                 connect_timeout=None,
+                 receive_timeout=None,
+                 **kwargs):
 
         # LDAP Search Base String. Also known as the Base DN (Distinguished Name). Probably something like:
         # 'ou=Users,ou=MyOrg,dc=myad,dc=private,dc=example,dc=com'
@@ -27,6 +252,26 @@ class ClientOfRedundantAdLdapServers(ClientOfRedundantServers):
         # user. Any 'ad_domain' set here is appended to the uid to create the username.
         self.ad_domain = ad_domain
 
+        # 'pool_size' is the number of idle connections to keep open to each LDAP server, to be reused by later
+        # requests. Connections left idle for more than 'pool_idle_timeout' seconds are closed. Leave it as 0 to open
+        # and close a new connection for every request.
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+
+        # 'service_user' and 'service_password' are the credentials of a service account, used for searching when
+        # pooling. If they are set, the user is found with the service account, and the user's own credentials are
+        # only used for a bind. Otherwise the search runs as the user, just like it does without pooling.
+        self.service_user = service_user
+        self.service_password = service_password
+
+        # 'connect_timeout' is the number of seconds to wait for a connection to an LDAP server to open, and
+        # 'receive_timeout' the number of seconds to wait for each response. Leave them as None to use the defaults
+        # of ldap3, which wait for as long as the operating system does. If 'request_timeout' is also set, opening
+        # the connection and every response of an attempt must all be over within the attempt's time budget, pooled
+        # connections included. Both may be fractions of a second.
+        self.connect_timeout = connect_timeout
+        self.receive_timeout = receive_timeout
+
         # 'server_list' must be a collections.OrderedDict of dictionaries, like this:
         #
         # {'srvr-dc1.myad.private.example.com': {'port': 636,
@@ -40,48 +285,222 @@ class ClientOfRedundantAdLdapServers(ClientOfRedundantServers):
         # 'port' is the port of the LDAP server running on the given server. 'ssl' indicates whether we should attempt
         # to use SSL when communicating with this LDAP server. 'validate' means that we not only require SSL, but that
         # we also require the LDAP server to use a valid SSL certificate.
-        super().__init__(server_dict, schedule)
+        # An entry may also give the server's 'address', in which case the hostname is never resolved, as
+        # srv_discovery.SrvServerSource does.
+        #
+        # Each entry is checked when the client is created, and raises ValueError if it is not valid. Requests are
+        # then made with an LdapServer built from it.
+        #
+        # Any other keyword arguments, such as 'failure_threshold' and 'recovery_timeout', are passed on to
+        # ClientOfRedundantServers.
+        super().__init__(server_dict, schedule, **kwargs)
+
+        # '_auth_pools' and '_service_pools' hold the LdapConnectionPools for each server, once it has been used.
+        self._auth_pools = {}
+        self._service_pools = {}
+        self._pools_lock = threading.Lock()
 
     def _ldap_auth_func(self, server, **kwargs):
         """More private method used to authenticate a user and password against the current LDAP server. Returns
-           False if the user is rejected, True if the user is accepted. Raises CurrentServerFailed if there was an
-           error with the request (such as a timeout). Basically, if you can bind as a user, then the user is valid."""
+           False if the user is rejected, True if the user is accepted. Raises CurrentServerTimedOut if the server
+           did not answer in time, or CurrentServerFailed if there was some other error with the request. Basically,
+           if you can bind as a user, then the user is valid."""
+        if self.pool_size:
+            return self._pooled_ldap_auth_func(server, **kwargs)
+
+        deadline = self._attempt_deadline(kwargs)
+        conn = None
         try:
-            port = self.server_dict[server]['port']
-            use_ssl = self.server_dict[server]['ssl']
-            validate = self.server_dict[server]['validate']
-
-            ldap_username = kwargs['ldap_uid']
-            if self.ad_domain is not None:
-                ldap_username = kwargs['ldap_uid'] + '@' + self.ad_domain
-
-            search_filter = "(&(objectClass=user)(cn=" + kwargs['ldap_uid'] + "))"
-            attrs = ['*']
-
-            if use_ssl:
-                if validate:
-                    tls = Tls(validate=ssl.CERT_REQUIRED)
-                    ldap_server = ldap3.Server(server, port=port, use_ssl=True, tls=tls)
-                else:
-                    ldap_server = ldap3.Server(server, port=port, use_ssl=True)
+            conn = open_connection(server.ldap_server, self._ldap_username(kwargs['ldap_uid']), kwargs['ldap_pass'],
+                                   receive_timeout=self.receive_timeout, deadline=deadline,
+                                   connect_timeout=server.connect_timeout)
+            set_receive_timeout(conn, time_left(deadline, self.receive_timeout))
+            conn.search(self.ldap_search_base, self._search_filter(kwargs['ldap_uid']), attributes=['*'])
+            if conn.entries:
+                return True
             else:
-                ldap_server = ldap3.Server(server, port=port)
-
-            with ldap3.Connection(ldap_server, ldap_username, kwargs['ldap_pass'], auto_bind=True) as conn:
-                conn.search(self.ldap_search_base, search_filter, attributes=attrs)
-                if conn.entries:
-                    return True
-                else:
-                    return False
+                return False
         except ldap3.core.exceptions.LDAPBindError:
             # Invalid credentials
             return False
-        except ldap3.core.exceptions.LDAPException:
+        except CALLER_ERRORS:
+            # Credentials that can never be valid, which ldap3 refuses to send
+            return False
+        except ldap3.core.exceptions.LDAPException as e:
             # Some other error
+            raise self._attempt_error(e)
+        finally:
+            if conn is not None:
+                LdapConnectionPool.discard(conn)
+
+    def _pooled_ldap_auth_func(self, server, **kwargs):
+        """More private method used to authenticate a user and password against the current LDAP server using pooled
+           connections. Returns and raises the same as _ldap_auth_func."""
+        search_filter = self._search_filter(kwargs['ldap_uid'])
+        deadline = self._attempt_deadline(kwargs)
+        try:
+            auth_pool, service_pool = self._get_pools(server)
+            if service_pool is not None:
+                conn = service_pool.checkout(deadline)
+                try:
+                    set_receive_timeout(conn, time_left(deadline, self.receive_timeout))
+                    conn.search(self.ldap_search_base, search_filter, attributes=['1.1'])
+                    found = bool(conn.entries)
+                except ldap3.core.exceptions.LDAPException:
+                    service_pool.discard(conn)
+                    raise
+                service_pool.checkin(conn)
+                if not found:
+                    return False
+
+            conn = auth_pool.checkout(deadline)
+            try:
+                # Reuse the open connection, but bind as the user. There is no need to read the schema again.
+                set_receive_timeout(conn, time_left(deadline, self.receive_timeout))
+                if not conn.rebind(self._ldap_username(kwargs['ldap_uid']), kwargs['ldap_pass'],
+                                   read_server_info=False):
+                    # Invalid credentials
+                    auth_pool.checkin(conn)
+                    return False
+                if service_pool is None:
+                    set_receive_timeout(conn, time_left(deadline, self.receive_timeout))
+                    conn.search(self.ldap_search_base, search_filter, attributes=['*'])
+                    found = bool(conn.entries)
+            except ldap3.core.exceptions.LDAPBindError as e:
+                auth_pool.discard(conn)
+                if isinstance(e.__context__, ldap3.core.exceptions.LDAPCommunicationError):
+                    # ldap3's rebind raises LDAPBindError for a connection that failed, such as one that timed out,
+                    # as well as for invalid credentials.
+                    raise e.__context__
+                return False
+            except ldap3.core.exceptions.LDAPException:
+                auth_pool.discard(conn)
+                raise
+            auth_pool.checkin(conn)
+            return found
+        except CALLER_ERRORS:
+            return False
+        except ldap3.core.exceptions.LDAPException as e:
+            raise self._attempt_error(e)
+
+    def _ldap_status_func(self, server):
+        """More private method used to check that the current LDAP server is up, by binding (as the service account
+           if there is one, otherwise anonymously) and reading the rootDSE. Pooled connections are used if pooling
+           is on. Returns True if the server is working. Raises CurrentServerFailed if it is not."""
+        try:
+            if self.pool_size:
+                auth_pool, service_pool = self._get_pools(server)
+                pool = auth_pool if service_pool is None else service_pool
+                conn = pool.checkout()
+                try:
+                    healthy = read_root_dse(conn)
+                except ldap3.core.exceptions.LDAPException:
+                    pool.discard(conn)
+                    raise
+                pool.checkin(conn)
+            else:
+                conn = open_connection(server.ldap_server, self.service_user, self.service_password,
+                                       receive_timeout=self.receive_timeout)
+                try:
+                    healthy = read_root_dse(conn)
+                finally:
+                    LdapConnectionPool.discard(conn)
+        except ldap3.core.exceptions.LDAPException as e:
+            raise self._attempt_error(e)
+        if not healthy:
             raise CurrentServerFailed
+        return True
+
+    def _health_check_func(self, server):
+        """More private method used by the health checks to check an LDAP server, with a bind and a rootDSE read."""
+        return self._ldap_status_func(server)
+
+    def _get_pools(self, server):
+        """More private method used to get the auth pool and the service pool (or None if there is no service
+           account) for the given server, creating them if needed."""
+        auth_pool = self._auth_pools.get(server)
+        if auth_pool is None:
+            with self._pools_lock:
+                auth_pool = self._auth_pools.get(server)
+                if auth_pool is None:
+                    if self.service_user is not None:
+                        self._service_pools[server] = LdapConnectionPool(server.ldap_server, self.pool_size,
+                                                                         self.pool_idle_timeout, self.service_user,
+                                                                         self.service_password,
+                                                                         receive_timeout=self.receive_timeout,
+                                                                         connect_timeout=server.connect_timeout)
+                    auth_pool = LdapConnectionPool(server.ldap_server, self.pool_size, self.pool_idle_timeout,
+                                                   receive_timeout=self.receive_timeout,
+                                                   connect_timeout=server.connect_timeout)
+                    self._auth_pools[server] = auth_pool
+        return auth_pool, self._service_pools.get(server)
+
+    def _server_drained(self, server):
+        """More private method used to close the pooled connections of an LDAP server that has been removed."""
+        with self._pools_lock:
+            pools = [self._auth_pools.pop(server, None), self._service_pools.pop(server, None)]
+        for pool in pools:
+            if pool is not None:
+                pool.close()
+
+    def _make_server(self, name, config):
+        """More private method used to validate the configuration of an LDAP server and build its LdapServer."""
+        return LdapServer(name, config, self.connect_timeout)
+
+    def _shared_health_key(self, server):
+        """More private method used to get the name the health of an LDAP server is kept under in the shared
+           health, which the asyncio client shares."""
+        return 'ldap:' + server.name + ':' + str(server.port)
+
+    @staticmethod
+    def _attempt_deadline(kwargs: dict):
+        """More private method used to get when an attempt must be over, in the time of time.monotonic, given its
+           keyword arguments: once its time budget is spent. Returns None if it has no time budget."""
+        time_budget = kwargs.get('time_budget')
+        if time_budget is None:
+            return None
+        return time.monotonic() + time_budget
+
+    @staticmethod
+    def _attempt_error(error):
+        """More private method used to get what to raise for an ldap3 exception: CurrentServerTimedOut if the
+           server did not answer in time, or else CurrentServerFailed. ldap3 raises socket timeouts as exceptions
+           which are both its own and socket.timeout."""
+        if isinstance(error, (ldap3.core.exceptions.LDAPResponseTimeoutError, socket.timeout)):
+            return CurrentServerTimedOut()
+        return CurrentServerFailed()
+
+    def _ldap_username(self, ldap_uid):
+        """More private method used to turn an LDAP uid into the username to bind as."""
+        if self.ad_domain is not None:
+            return ldap_uid + '@' + self.ad_domain
+        return ldap_uid
+
+    @staticmethod
+    def _search_filter(ldap_uid):
+        """More private method used to build the filter that finds the user with the given LDAP uid. Characters
+           with a meaning in filters, such as '*' and '(', are escaped so they only match themselves."""
+        return "(&(objectClass=user)(cn=" + escape_filter_chars(ldap_uid) + "))"
+
+    def close(self):
+        """Public method used to close every pooled connection."""
+        super().close()
+        with self._pools_lock:
+            for pool in list(self._auth_pools.values()) + list(self._service_pools.values()):
+                pool.close()
+            self._auth_pools.clear()
+            self._service_pools.clear()
 
     def ldap_auth(self, ldap_uid: str, ldap_pass: str):
         """Public method used to authenticate a user and password against any available LDAP server. Returns False
            if the user is rejected, True if the user is accepted. Raises AllAvailableServersFailed if no LDAP
            server responded to a request in a useful way."""
         return self.request(self._ldap_auth_func, ldap_uid=ldap_uid, ldap_pass=ldap_pass)
+
+    def ldap_auth_many(self, credentials, concurrency=8):
+        """Public method used to authenticate many users, up to 'concurrency' at a time, spread over the available
+           LDAP servers. The argument credentials is an iterable of (user, password) tuples. Returns an iterator of
+           the results in the same order: True if the user is accepted, False if the user is rejected, or an
+           AllAvailableServersFailed instance if no server responded in a useful way."""
+        kwargs_iterable = ({'ldap_uid': ldap_uid, 'ldap_pass': ldap_pass} for ldap_uid, ldap_pass in credentials)
+        return self.request_many(self._ldap_auth_func, kwargs_iterable, concurrency)
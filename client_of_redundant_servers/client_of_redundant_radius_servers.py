@@ -6,29 +6,304 @@ Client of redundant RADIUS servers.
 from pyrad.client import Client
 from pyrad.dictionary import Dictionary
 import pyrad.packet
-from client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed
-from collections import OrderedDict
+from client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed, CurrentServerTimedOut,\
+                                        ServerDescriptor
+from collections import OrderedDict, deque
+import threading
 import socket
+import time
 import os
 package_dir = os.path.dirname(os.path.abspath(__file__))
 default_dictionary = os.path.join(package_dir,'dictionary.minimal')
 
+# RADIUS packet identifiers are a single octet, so at most this many requests can be outstanding on one socket.
+MAX_OUTSTANDING = 256
+
+# The gains and variance multiplier used to estimate retransmission timeouts, the same as TCP's (RFC 6298).
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_K = 4
+
+# '_dictionaries' maps the absolute path of each dictionary file that has been loaded to a tuple of its modification
+# time and the parsed pyrad Dictionary, so that clients using the same file share one copy.
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+
+
+def load_dictionary(dict_file: str):
+    """Public function used to get the parsed pyrad Dictionary for a dictionary file. Each file is parsed once per
+       process and the result shared, unless the file has been modified since, in which case it is parsed again.
+       Dictionaries must not be modified once loaded, since they are shared."""
+    path = os.path.abspath(dict_file)
+    mtime = os.stat(path).st_mtime_ns
+    with _dictionaries_lock:
+        cached = _dictionaries.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _dictionaries[path] = (mtime, Dictionary(path))
+    return cached[1]
+
+
+def clear_dictionary_cache():
+    """Public function used to forget every parsed dictionary. Clients that have already loaded theirs keep it."""
+    with _dictionaries_lock:
+        _dictionaries.clear()
+
+
+class RadiusServer(ServerDescriptor):
+    """The validated configuration of a single RADIUS server. The server's address is resolved the first time it is
+       needed, and then cached, unless the configuration gives it as 'address'."""
+    __slots__ = ('auth_port', 'secret', '_address')
+
+    def __init__(self, name, config):
+        super().__init__(name)
+        try:
+            auth_port = config['auth_port']
+            secret = config['secret']
+        except (KeyError, TypeError):
+            raise ValueError("RADIUS server " + str(name) + " needs an 'auth_port' and a 'secret'")
+        if not isinstance(auth_port, int) or not 0 < auth_port < 65536:
+            raise ValueError("RADIUS server " + str(name) + " has an invalid 'auth_port'")
+        if not isinstance(secret, bytes):
+            raise ValueError("RADIUS server " + str(name) + " must have a bytes 'secret'")
+        address = config.get('address')
+        if address is not None and not isinstance(address, str):
+            raise ValueError("RADIUS server " + str(name) + " has an invalid 'address'")
+        self._set('auth_port', auth_port)
+        self._set('secret', secret)
+        self._set('_address', address)
+
+    def address(self):
+        """Public method used to get the IP address of the server. Raises socket.error if it can't be resolved."""
+        if self._address is None:
+            self._set('_address', socket.getaddrinfo(self.name, self.auth_port, 0, socket.SOCK_DGRAM)[0][4][0])
+        return self._address
+
+    def host(self):
+        """Public method used to get the IP address of the server if it is known already, or else its name, for
+           callers that resolve names themselves."""
+        return self.name if self._address is None else self._address
+
+
+class RttEstimator(object):
+    """Estimates how long to wait for a reply from a single RADIUS server before retransmitting, from the round trip
+       times of earlier requests, as TCP does (RFC 6298). The smoothed round trip time and its variance are tracked,
+       and the retransmission timeout is the one plus four times the other, kept between 'min_timeout' and
+       'max_timeout'. Until the first round trip is measured the timeout is 'max_timeout'. Each time a try goes
+       unanswered the timeout is doubled, and it stays doubled until a new round trip is measured. Only replies to
+       the first try of a request are measured, as a reply to a retransmitted request is ambiguous (Karn's
+       algorithm). It is safe to share between threads."""
+    def __init__(self, min_timeout, max_timeout):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        # 'srtt' is the smoothed round trip time and 'rttvar' its variance, in seconds, or None if none has been
+        # measured yet. 'rto' is the current retransmission timeout.
+        self.srtt = None
+        self.rttvar = None
+        self.rto = max_timeout
+        self._lock = threading.Lock()
+
+    def timeouts(self, retries: int):
+        """Public method used to get how long each of 'retries' tries of a request should wait for a reply, backing
+           off exponentially from the current retransmission timeout."""
+        timeout = self.rto
+        timeouts = []
+        for _ in range(retries):
+            timeouts.append(timeout)
+            timeout = min(timeout * 2, self.max_timeout)
+        return timeouts
+
+    def sample(self, rtt: float):
+        """Public method used to record the round trip time of a request that was answered at its first try."""
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += RTT_ALPHA * (rtt - self.srtt)
+            self.rto = min(max(self.srtt + RTT_K * self.rttvar, self.min_timeout), self.max_timeout)
+
+    def backoff(self):
+        """Public method used to record that a try went unanswered, which doubles the retransmission timeout."""
+        with self._lock:
+            self.rto = min(self.rto * 2, self.max_timeout)
+
+
+def send_with_retries(send_once, timeouts, rtt_estimator=None):
+    """Public function used to send a request until it is answered, once for each entry of 'timeouts'. The argument
+       send_once is called with the seconds to wait, and must send (or resend) the request and return the reply, or
+       raise pyrad.client.Timeout. If an RttEstimator is given, it is kept up to date. Raises pyrad.client.Timeout if
+       no try is answered."""
+    for attempt, timeout in enumerate(timeouts):
+        sent = time.monotonic()
+        try:
+            reply = send_once(timeout)
+        except pyrad.client.Timeout:
+            if rtt_estimator is not None:
+                rtt_estimator.backoff()
+            continue
+        if rtt_estimator is not None and attempt == 0:
+            rtt_estimator.sample(time.monotonic() - sent)
+        return reply
+    raise pyrad.client.Timeout
+
+
+class _PendingRequest(object):
+    """A request sent by a RadiusTransport which is waiting for its reply."""
+    __slots__ = ('packet', 'reply', 'error', 'done')
+
+    def __init__(self, packet):
+        self.packet = packet
+        self.reply = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class RadiusTransport(object):
+    """A UDP socket connected to a single RADIUS server, which can be shared by many threads with many requests
+       outstanding at once. Each request gets a packet identifier that is not in use by any other outstanding
+       request, so the pending-request table is keyed by identifier alone. A background thread receives replies,
+       looks up the request by identifier, and only hands the reply over if it verifies against that request's
+       authenticator and our secret. Requests are retransmitted unchanged if no reply arrives in time."""
+
+    # How often, in seconds, the receiving thread checks whether the transport has been closed.
+    poll_interval = 0.1
+
+    def __init__(self, address, port, bind_ip=None, timeout=3, retries=3):
+        # 'timeout' is the number of seconds to wait for a reply before retransmitting, and 'retries' is the number
+        # of times a request is sent before giving up on it.
+        self.timeout = timeout
+        self.retries = retries
+
+        family = socket.getaddrinfo(address, port, 0, socket.SOCK_DGRAM)[0][0]
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        if bind_ip is not None:
+            # Binding to port 0 is the official way to bind to a OS-assigned random port.
+            self._socket.bind((bind_ip, 0))
+        # A connected UDP socket only receives datagrams from the server, and reports ICMP errors to us.
+        self._socket.connect((address, port))
+        self._socket.settimeout(self.poll_interval)
+
+        self._lock = threading.Lock()
+        self._id_free = threading.Condition(self._lock)
+        self._pending = {}
+        # Identifiers are handed out least recently used first, so a late reply is unlikely to find its identifier
+        # already in use by a newer request.
+        self._free_ids = deque(range(MAX_OUTSTANDING))
+        self._closed = False
+
+        self._receiver = threading.Thread(target=self._receive_loop, name='RadiusTransport-' + str(address))
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    def send_packet(self, create_packet, timeouts=None, rtt_estimator=None):
+        """Public method used to send a request and wait for the matching reply. The argument create_packet is
+           called with a free packet identifier and must return the request packet. The request is sent once for
+           each entry of 'timeouts', waiting that many seconds for a reply each time, or 'retries' times waiting
+           'timeout' seconds if it is None. If an RttEstimator is given, it is kept up to date. Blocks while all
+           identifiers are in use. Raises pyrad.client.Timeout if there is no reply, or socket.error if the socket
+           failed."""
+        if timeouts is None:
+            timeouts = [self.timeout] * self.retries
+        with self._id_free:
+            while not self._free_ids:
+                self._id_free.wait()
+            packet_id = self._free_ids.popleft()
+        try:
+            pending = _PendingRequest(create_packet(packet_id))
+            with self._lock:
+                self._pending[packet_id] = pending
+            raw_request = pending.packet.RequestPacket()
+
+            def send_once(timeout):
+                self._socket.send(raw_request)
+                if not pending.done.wait(timeout):
+                    raise pyrad.client.Timeout
+                if pending.error is not None:
+                    raise pending.error
+                return pending.reply
+
+            return send_with_retries(send_once, timeouts, rtt_estimator)
+        finally:
+            with self._id_free:
+                self._pending.pop(packet_id, None)
+                self._free_ids.append(packet_id)
+                self._id_free.notify()
+
+    def _receive_loop(self):
+        """More private method, run by the receiving thread, used to hand each reply to the request waiting for
+           it."""
+        while not self._closed:
+            try:
+                data = self._socket.recv(4096)
+            except socket.timeout:
+                continue
+            except socket.error as exc:
+                if self._closed:
+                    return
+                # Usually an ICMP port unreachable, so every outstanding request to this server has failed.
+                self._fail_pending(exc)
+                continue
+
+            if len(data) < 20:
+                continue
+            with self._lock:
+                pending = self._pending.get(data[1])
+            if pending is None or pending.done.is_set():
+                # A late or duplicate reply to a request we are no longer waiting for.
+                continue
+            try:
+                reply = pending.packet.CreateReply(packet=data)
+            except pyrad.packet.PacketError:
+                continue
+            if pending.packet.VerifyReply(reply, data):
+                pending.reply = reply
+                pending.done.set()
+
+    def _fail_pending(self, exc):
+        """More private method used to fail every outstanding request with the given exception."""
+        with self._lock:
+            pending_requests = list(self._pending.values())
+        for pending in pending_requests:
+            if not pending.done.is_set():
+                pending.error = exc
+                pending.done.set()
+
+    def close(self):
+        """Public method used to stop the receiving thread and close the socket."""
+        self._closed = True
+        self._receiver.join()
+        self._socket.close()
+
 
 class ClientOfRedundantRadiusServers(ClientOfRedundantServers):
     """Stores information about how to query RADIUS servers, and provides a simple interface for requests."""
+    _cache_secret_kwargs = ('password',)
+    _schedule_key_kwarg = 'user'
+
     def __init__(self,
                  server_dict: OrderedDict,
                  nas_identifier: str,
                  schedule: str='round-robin',
                  dict_file=None,
                  server_timeout=3,
-                 client_bind_ip=None):
+                 client_bind_ip=None,
+                 pipelined=False,
+                 server_retries=3,
+                 adaptive_timeout=False,
+                 min_timeout=0.05,
+                 pool_size=16,
+                 **kwargs):
 
-        if dict_file is not None:
-            # 'dict_file' is the path to your dictionary file
-            self.dictionary = Dictionary(dict_file)
-        else:
-            self.dictionary = Dictionary(default_dictionary)
+        # 'dict_file' is the path to your dictionary file, or None to use the minimal one that comes with this
+        # package. It is parsed the first time it is needed, and shared with every other client using the same file,
+        # but a file that can't be found is reported here, rather than by the first request.
+        self.dict_file = os.path.abspath(dict_file if dict_file is not None else default_dictionary)
+        try:
+            os.stat(self.dict_file)
+        except OSError as e:
+            raise ValueError("RADIUS dictionary file " + self.dict_file + " can't be read: " + str(e)) from e
+        self._dictionary = None
 
         # 'nas_identifier' contains a string corresponding to the NAS-Identifier RADIUS attribute identifying the NAS
         # originating the Access-Request. It's can be whatever you want, it's like a friendly name for your client.
@@ -36,13 +311,38 @@ class ClientOfRedundantRadiusServers(ClientOfRedundantServers):
 
         # 'server_timeout' is an integer that should be set to the desired timeout for each individual RADIUS server,
         # in seconds. So if this is set to 3, and you have 4 radius servers in your server list, it may be 12 seconds
-        # before the radius_auth method returns (if all servers time out).
+        # before the radius_auth method returns (if all servers time out). To bound that, pass 'request_timeout' as
+        # well: each server then gets a share of it, and the timeout of each try is shortened to fit.
         self.server_timeout = server_timeout
 
+        # 'server_retries' is the number of times a request is sent to a server before the server is considered
+        # failed. The timeout above applies to each try.
+        self.server_retries = server_retries
+
+        # 'adaptive_timeout' turns on retransmission timeouts estimated from the round trip times of each server, as
+        # in TCP. A fast server is then retransmitted to (and failed over from) after a few of its round trips rather
+        # than after 'server_timeout', and each retry waits twice as long as the last. 'min_timeout' is the shortest
+        # time a try waits, and 'server_timeout' the longest, which is also what is used until a server's round trip
+        # time has been measured, so that slow servers are not given up on too early.
+        self.adaptive_timeout = adaptive_timeout
+        self.min_timeout = min_timeout
+
         # 'client_bind_ip' is used to specify the IP address on the client from which RADIUS requests should originate,
         # or just leave it as None if you don't care.
         self.client_bind_ip = client_bind_ip
 
+        # 'pipelined' selects how requests are sent. If it is False, each request borrows a pyrad Client with a
+        # socket of its own from a pool. If it is True, all requests to a server share a single RadiusTransport,
+        # with up to 256 requests outstanding on its socket at once.
+        self.pipelined = pipelined
+
+        # 'pool_size' is the most idle pyrad Clients, each with its own socket, kept for reuse for each server when
+        # 'pipelined' is False. A Client returned to a full pool has its socket closed, so a burst of concurrent
+        # requests does not leave sockets open for ever.
+        if not isinstance(pool_size, int) or pool_size < 0:
+            raise ValueError("pool_size must be a non-negative integer")
+        self.pool_size = pool_size
+
         # 'server_list' must be a collections.OrderedDict of dictionaries, like this:
         #
         # {'radius0.inst.example.com': {'auth_port': 1812,
@@ -53,34 +353,245 @@ class ClientOfRedundantRadiusServers(ClientOfRedundantServers):
         # The keys of the OrderedDict are the hostnames of the RADIUS servers.
         # 'auth_port' is the port of the RADIUS server running on the given server. 'secret' is the secret that we share
         # with the RADIUS server running on the given server.
-        super().__init__(server_dict, schedule)
+        # An entry may also give the server's 'address', in which case the hostname is never resolved, as
+        # srv_discovery.SrvServerSource does.
+        #
+        # Each entry is checked when the client is created, and raises ValueError if it is not valid. Requests are
+        # then made with a RadiusServer built from it.
+        #
+        # Any other keyword arguments, such as 'failure_threshold' and 'recovery_timeout', are passed on to
+        # ClientOfRedundantServers.
+        super().__init__(server_dict, schedule, **kwargs)
+
+        # '_idle_clients' holds a pool of pyrad Clients, each with its own UDP socket, for every server. Clients are
+        # created as needed and then reused, so that sockets are not opened and closed for every request.
+        self._idle_clients = dict((server, []) for server in self.server_list)
+        self._idle_clients_lock = threading.Lock()
+
+        # '_transports' holds the RadiusTransport for each server when 'pipelined' is True. They are created the
+        # first time a server is used.
+        self._transports = {}
+        self._transports_lock = threading.Lock()
+
+        # '_rtt_estimators' holds the RttEstimator of each server when 'adaptive_timeout' is True.
+        self._rtt_estimators = {}
+        if adaptive_timeout:
+            self._rtt_estimators = dict((server, RttEstimator(min_timeout, server_timeout))
+                                        for server in self.server_list)
+
+    @property
+    def dictionary(self):
+        """The pyrad Dictionary parsed from 'dict_file', which is loaded the first time it is used."""
+        if self._dictionary is None:
+            # If two threads get here at once, both are given the same shared Dictionary.
+            self._dictionary = load_dictionary(self.dict_file)
+        return self._dictionary
 
     def _radius_auth_func(self, server, **kwargs):
         """More private method used to authenticate a user and password against the current RADIUS server. Returns
            False if the user is rejected, True if the user is accepted. Raises CurrentServerFailed if there was an
            error with the request (such as a timeout)."""
+        reply = self._send_packet(server, pyrad.packet.AccessRequest,
+                                  lambda req: self._add_credentials(req, kwargs['user'], kwargs['password']), kwargs)
+        if reply.code == pyrad.packet.AccessAccept:
+            return True
+        else:
+            return False
+
+    def _radius_status_func(self, server):
+        """More private method used to check that the current RADIUS server is up, with a Status-Server request (RFC
+           5997). Returns True if the server answered. Raises CurrentServerFailed if it did not."""
+        self._send_packet(server, pyrad.packet.StatusServer, self._add_message_authenticator, {})
+        return True
+
+    def _health_check_func(self, server):
+        """More private method used by the health checks to check a RADIUS server, with Status-Server."""
+        return self._radius_status_func(server)
+
+    def _send_packet(self, server, code, prepare, kwargs: dict):
+        """More private method used to send a request with the given code to the current RADIUS server, and return
+           the reply. The argument prepare is called with the new request, to add its attributes. Raises
+           CurrentServerTimedOut if there was no reply, or CurrentServerFailed if there was some other error."""
+        # The dictionary is loaded before anything else, so that a dictionary file which has gone or can't be parsed
+        # is raised as it is, rather than being taken for a failure of the server.
+        dictionary = self.dictionary
+        if self.pipelined:
+            return self._pipelined_send_packet(server, code, prepare, kwargs, dictionary)
+
+        try:
+            srv = self._checkout_client(server, dictionary)
+        except pyrad.client.Timeout:
+            raise CurrentServerTimedOut
+        except (pyrad.packet.PacketError, socket.error):
+            raise CurrentServerFailed
+
         try:
-            auth_port = self.server_dict[server]['auth_port']
-            secret = self.server_dict[server]['secret']
+            req = srv.CreateAuthPacket(code=code, NAS_Identifier=self.nas_identifier)
+            prepare(req)
 
-            srv = Client(server=server, authport=auth_port, secret=secret, dict=self.dictionary)
-            srv.timeout = self.server_timeout
-            if self.client_bind_ip is not None:
-                # Binding to port 0 is the official way to bind to a OS-assigned random port.
-                srv.bind((self.client_bind_ip, 0))
-            req = srv.CreateAuthPacket(code=pyrad.packet.AccessRequest, User_Name=kwargs['user'],
-                                       NAS_Identifier=self.nas_identifier)
-            req["User-Password"] = req.PwCrypt(kwargs['password'])
-            reply = srv.SendPacket(req)
-            if reply.code == pyrad.packet.AccessAccept:
-                return True
-            else:
-                return False
-        except (pyrad.packet.PacketError, pyrad.client.Timeout, socket.error):
+            def send_once(timeout):
+                # pyrad sends the same packet again each time, so this is a retransmission rather than a new request.
+                srv.timeout = timeout
+                srv.retries = 1
+                return srv.SendPacket(req)
+
+            reply = send_with_retries(send_once, self._reply_timeouts(server, kwargs), self._rtt_estimators.get(server))
+        except socket.error:
+            # Don't put the client back in the pool, its socket may be broken.
+            srv._CloseSocket()
             raise CurrentServerFailed
+        except pyrad.client.Timeout:
+            self._checkin_client(server, srv)
+            raise CurrentServerTimedOut
+        except pyrad.packet.PacketError:
+            self._checkin_client(server, srv)
+            raise CurrentServerFailed
+        self._checkin_client(server, srv)
+        return reply
+
+    def _pipelined_send_packet(self, server, code, prepare, kwargs: dict, dictionary):
+        """More private method used to send a request to the current RADIUS server over the server's shared
+           RadiusTransport. Returns and raises the same as _send_packet."""
+        try:
+            transport = self._get_transport(server)
+            return transport.send_packet(
+                lambda packet_id: self._create_packet(server, code, packet_id, prepare, dictionary),
+                self._reply_timeouts(server, kwargs), self._rtt_estimators.get(server))
+        except pyrad.client.Timeout:
+            raise CurrentServerTimedOut
+        except (pyrad.packet.PacketError, socket.error):
+            raise CurrentServerFailed
+
+    def _reply_timeouts(self, server, kwargs: dict):
+        """More private method used to get how long each try of a request to the given server waits for a reply:
+           'server_timeout' or the server's adaptive timeout, shortened in proportion if that is needed for all the
+           tries to fit in the time budget of the attempt."""
+        rtt_estimator = self._rtt_estimators.get(server)
+        if rtt_estimator is None:
+            timeouts = [self.server_timeout] * self.server_retries
+        else:
+            timeouts = rtt_estimator.timeouts(self.server_retries)
+        time_budget = kwargs.get('time_budget')
+        total = sum(timeouts)
+        if time_budget is not None and total > time_budget:
+            timeouts = [timeout * time_budget / total for timeout in timeouts]
+        return timeouts
+
+    def _create_packet(self, server, code, packet_id, prepare, dictionary):
+        """More private method used to build a request with the given code for the given server, with the given
+           identifier and pyrad Dictionary. The argument prepare is called with the new request, to add its
+           attributes."""
+        req = pyrad.packet.AuthPacket(code=code, id=packet_id, secret=server.secret, dict=dictionary,
+                                      NAS_Identifier=self.nas_identifier)
+        prepare(req)
+        return req
+
+    @staticmethod
+    def _add_credentials(req, user, password):
+        """More private method used to add a user and password to an Access-Request."""
+        req["User-Name"] = user
+        req["User-Password"] = req.PwCrypt(password)
+
+    @staticmethod
+    def _add_message_authenticator(req):
+        """More private method used to sign a request with a Message-Authenticator, which Status-Server requires."""
+        req.add_message_authenticator()
+
+    def _get_transport(self, server):
+        """More private method used to get the RadiusTransport for the given server, creating it if needed."""
+        transport = self._transports.get(server)
+        if transport is None:
+            with self._transports_lock:
+                transport = self._transports.get(server)
+                if transport is None:
+                    transport = RadiusTransport(server.address(), server.auth_port, bind_ip=self.client_bind_ip,
+                                                timeout=self.server_timeout, retries=self.server_retries)
+                    self._transports[server] = transport
+        return transport
+
+    def _checkout_client(self, server, dictionary):
+        """More private method used to take an idle pyrad Client for the given server from the pool, or to create a
+           new one with the given pyrad Dictionary if they are all busy. Each Client owns one UDP socket, which is
+           only ever used by one request at a time, so pyrad can match replies to requests by identifier and
+           authenticator as usual."""
+        try:
+            return self._idle_clients[server].pop()
+        except (IndexError, KeyError):
+            pass
+
+        # Give pyrad the resolved address, otherwise it looks up the hostname again for every packet sent.
+        srv = Client(server=server.address(), authport=server.auth_port, secret=server.secret, dict=dictionary)
+        if self.client_bind_ip is not None:
+            # Binding to port 0 is the official way to bind to a OS-assigned random port.
+            try:
+                srv.bind((self.client_bind_ip, 0))
+            except socket.error:
+                srv._CloseSocket()
+                raise
+        return srv
+
+    def _checkin_client(self, server, srv):
+        """More private method used to return a pyrad Client to the pool once a request has finished with it."""
+        with self._idle_clients_lock:
+            idle_clients = self._idle_clients.get(server)
+            # If the server has been drained since the request started, there is no pool to return it to.
+            if idle_clients is not None and len(idle_clients) < self.pool_size:
+                idle_clients.append(srv)
+                return
+        srv._CloseSocket()
+
+    def _server_added(self, server):
+        """More private method used to set up the pool and round trip time estimate of a new RADIUS server."""
+        with self._idle_clients_lock:
+            self._idle_clients[server] = []
+        if self.adaptive_timeout:
+            self._rtt_estimators[server] = RttEstimator(self.min_timeout, self.server_timeout)
+
+    def _server_drained(self, server):
+        """More private method used to close the sockets of a RADIUS server that has been removed."""
+        with self._idle_clients_lock:
+            idle_clients = self._idle_clients.pop(server, ())
+        for srv in idle_clients:
+            srv._CloseSocket()
+        self._rtt_estimators.pop(server, None)
+        with self._transports_lock:
+            transport = self._transports.pop(server, None)
+        if transport is not None:
+            transport.close()
+
+    def _make_server(self, name, config):
+        """More private method used to validate the configuration of a RADIUS server and build its RadiusServer."""
+        return RadiusServer(name, config)
+
+    def _shared_health_key(self, server):
+        """More private method used to get the name the health of a RADIUS server is kept under in the shared
+           health, which the asyncio client shares."""
+        return 'radius:' + server.name + ':' + str(server.auth_port)
+
+    def close(self):
+        """Public method used to close every socket opened by this client."""
+        super().close()
+        with self._idle_clients_lock:
+            idle_clients = [srv for server_clients in self._idle_clients.values() for srv in server_clients]
+            for server_clients in self._idle_clients.values():
+                del server_clients[:]
+        for srv in idle_clients:
+            srv._CloseSocket()
+        with self._transports_lock:
+            for transport in self._transports.values():
+                transport.close()
+            self._transports.clear()
 
     def radius_auth(self, user: str, password: str):
         """Public method used to authenticate a user and password against any available RADIUS server. Returns False
            if the user is rejected, True if the user is accepted. Raises AllAvailableServersFailed if no RADIUS
            server responded to a request in a useful way."""
         return self.request(self._radius_auth_func, user=user, password=password)
+
+    def radius_auth_many(self, credentials, concurrency=8):
+        """Public method used to authenticate many users, up to 'concurrency' at a time, spread over the available
+           RADIUS servers. The argument credentials is an iterable of (user, password) tuples. Returns an iterator of
+           the results in the same order: True if the user is accepted, False if the user is rejected, or an
+           AllAvailableServersFailed instance if no server responded in a useful way."""
+        kwargs_iterable = ({'user': user, 'password': password} for user, password in credentials)
+        return self.request_many(self._radius_auth_func, kwargs_iterable, concurrency)
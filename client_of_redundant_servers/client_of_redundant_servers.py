@@ -3,11 +3,20 @@ Generic client of redundant servers.
     :copyright: (c) 2018 by Robert Bricheno.
     :license: MIT, see LICENSE for more details.
 """
-from random import shuffle
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from client_of_redundant_servers.server_health import ServerHealth, FAILURE_LATENCY
+from client_of_redundant_servers.schedulers import get_scheduler, DEFAULT_OPTIONS
+from client_of_redundant_servers.metrics import FAILURE, TIMEOUT, CANCELLED, outcome_of
+import copy
+import heapq
+import itertools
+import json
 import logging
+import os
+import threading
+import time
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -15,67 +24,1082 @@ class CurrentServerFailed(Exception):
     pass
 
 
+class CurrentServerTimedOut(CurrentServerFailed):
+    """Raised instead of CurrentServerFailed when the server did not answer in time, so that metrics can tell
+       timeouts from other failures. It is handled exactly like CurrentServerFailed."""
+
+
 class AllAvailableServersFailed(Exception):
     pass
 
 
+class ServerDescriptor(object):
+    """Base class for the immutable per-server objects that subclasses of ClientOfRedundantServers may build from
+       each entry of their server_dict, by overriding _make_server. The configuration is validated and any derived
+       objects are built once, when the client is created, and the descriptor is what func_to_call is given."""
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self._set('name', name)
+
+    def _set(self, attribute, value):
+        """More private method used to set an attribute, for use by __init__ and caches only."""
+        object.__setattr__(self, attribute, value)
+
+    def __setattr__(self, attribute, value):
+        raise AttributeError(type(self).__name__ + " is immutable")
+
+    def __str__(self):
+        return str(self.name)
+
+    def __repr__(self):
+        return '<' + type(self).__name__ + ' ' + repr(self.name) + '>'
+
+
+def load_server_file(path):
+    """Public function used to read a server_dict from a JSON file, keeping the servers in the order they are in the
+       file. The secrets of RADIUS servers must be bytes, which JSON can't hold, so RADIUS clients need a parse_func
+       of their own to watch a server file."""
+    with open(path) as server_file:
+        return json.load(server_file, object_pairs_hook=OrderedDict)
+
+
+class _Flight(object):
+    """A request in flight, which callers making an identical request wait for rather than repeating it."""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _HedgedRequest(object):
+    """The state of a hedged request, which the calling thread shares with the hedge timer while its own attempt is
+       running. The timer only changes it under 'lock', and not once 'stopped' is set."""
+    __slots__ = ('order', 'deadline', 'pending', 'current_server', 'extra_sent', 'depth', 'timer', 'stopped', 'lock')
+
+    def __init__(self, order, deadline):
+        self.order = order
+        self.deadline = deadline
+        # 'pending' maps the future of each attempt in flight to its server.
+        self.pending = {}
+        # 'current_server' is the server most recently hedged with, or None.
+        self.current_server = None
+        self.extra_sent = 0
+        self.depth = 0
+        self.timer = None
+        self.stopped = True
+        self.lock = threading.Lock()
+
+
+class _HedgeTimer(object):
+    """A daemon thread which calls functions after a delay. A client has one, which starts the hedges of all of its
+       requests, so that a request whose server answers in time never needs a second thread."""
+
+    def __init__(self):
+        self._calls = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        thread = threading.Thread(target=self._run, name='HedgeTimer')
+        thread.daemon = True
+        thread.start()
+
+    def call_later(self, delay: float, func):
+        """Public method used to call func in the timer thread after 'delay' seconds. Returns a handle for cancel."""
+        call = [time.monotonic() + delay, next(self._sequence), func]
+        with self._condition:
+            heapq.heappush(self._calls, call)
+            self._condition.notify()
+        return call
+
+    @staticmethod
+    def cancel(call):
+        """Public method used to stop a call made by call_later from happening, if it has not happened yet."""
+        if call is not None:
+            call[2] = None
+
+    def close(self):
+        """Public method used to stop the timer thread. Calls that have not happened yet never will."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        """More private method used to make each call when it is due, until the timer is closed."""
+        while True:
+            with self._condition:
+                while not self._closed and (not self._calls or self._calls[0][0] > time.monotonic()):
+                    self._condition.wait(self._calls[0][0] - time.monotonic() if self._calls else None)
+                if self._closed:
+                    return
+                func = heapq.heappop(self._calls)[2]
+            if func is None:
+                continue
+            try:
+                func()
+            except Exception:
+                logger.exception("Failed to start a hedged request.")
+
+
+# The most hedged requests that can be sent back to back after a quiet period, whatever the 'hedge_budget'.
+HEDGE_BURST = 10
+
+
 class ClientOfRedundantServers(object):
-    """Stores information about how to query servers, and provides a simple interface for requests."""
-    def __init__(self, server_dict: OrderedDict, schedule: str='round-robin', **kwargs):
+    """Stores information about how to query servers, and provides a simple interface for requests. A single client
+       may be shared by many threads: the round-robin position, the health of each server and the hedge allowance
+       are all updated atomically, so the schedule stays fair however many requests run at once."""
+
+    # The names of the keyword arguments of a request that are secret, such as passwords. A result cache keeps
+    # a group of the results of the requests that differ only in these, so they can be forgotten together.
+    _cache_secret_kwargs = ()
+
+    # The name of the keyword argument of a request that schedules which route by key, such as 'consistent-hash',
+    # use when no 'schedule_key' is given, or None.
+    _schedule_key_kwarg = None
+
+    def __init__(self,
+                 server_dict: OrderedDict,
+                 schedule: str='round-robin',
+                 failure_threshold=3,
+                 recovery_timeout=30,
+                 hedge_delay=None,
+                 hedge_max_extra=1,
+                 hedge_budget=0.1,
+                 hedge_executor=None,
+                 hedge_workers=None,
+                 result_cache=None,
+                 coalesce=False,
+                 request_timeout=None,
+                 metrics=None,
+                 failure_log_interval=10,
+                 schedule_key=None,
+                 shared_health=None,
+                 **kwargs):
         self.server_dict = server_dict
-        self.server_list = list(server_dict.keys())
 
-        # '_rr_position' and '_server_list_len' are used internally to keep track of which server should be used as
-        # the first in the server list when using round-robin scheduling.
+        # 'server_list' holds the servers in the order they are defined in 'server_dict'. These are what func_to_call
+        # is given: the keys of 'server_dict', unless a subclass overrides _make_server. The servers can be changed
+        # later with update_servers, which replaces these attributes rather than changing them, so that a request
+        # that is using them is not affected.
+        self.server_list = [self._make_server(name, config) for name, config in server_dict.items()]
+        self._servers_by_name = dict(zip(server_dict.keys(), self.server_list))
+        # '_server_configs' holds a copy of each entry of 'server_dict', for update_servers to compare with.
+        self._server_configs = copy.deepcopy(dict(server_dict))
+
         self._server_list_len = len(self.server_list)
-        self._rr_position = 0
+
+        # 'failure_threshold' is the number of consecutive failures after which a server is quarantined, and
+        # 'recovery_timeout' is the number of seconds for which it stays quarantined before a single request is let
+        # through to probe it again. Quarantined servers are only tried as a last resort, after every other server
+        # has failed. Set 'failure_threshold' to None to disable quarantine altogether.
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+
+        # 'shared_health' is a shared_health.SharedHealthFile to keep the health of the servers in, so that every
+        # process using the same file (such as the workers of a pre-fork server) shares it, and a dead server is
+        # found once rather than once per process. Leave it as None to keep the health of servers in this client.
+        self._shared_health = shared_health
+        self._health = OrderedDict((server, self._new_health(server)) for server in self.server_list)
+
+        # '_draining' holds the servers removed by update_servers that still have requests in flight. Their health
+        # stays in '_health' until the following update, in case a request that was scheduled before they were
+        # removed still refers to them. '_closing' holds the drained servers whose sockets and connections are
+        # being closed, which is done without the lock as it may block. '_servers_lock' is held while the servers
+        # are changed.
+        self._draining = set()
+        self._closing = set()
+        self._servers_lock = threading.Lock()
+
+        # '_server_file_watch' refers to the watching of a server file started by start_watching_server_file, if it
+        # is running: the Event which stops its thread, or in asyncio its task.
+        self._server_file_watch = None
 
         # 'schedule' is a string used to set the desired scheduling strategy. It must be 'round-robin' to use the
         # round-robin strategy, 'random' to use the random strategy, or 'fixed' to use the deterministic strategy
-        # which uses the servers in the order listed every time.
-        if schedule not in ['round-robin', 'random', 'fixed']:
-            raise NotImplementedError("Schedule type " + schedule + " not implemented")
+        # which uses the servers in the order listed every time. The latency-aware strategies are 'ewma' (fastest
+        # server first), 'least-outstanding' (least busy server first) and 'power-of-two' (the less busy of two
+        # random servers first), 'weighted' uses smooth weighted round-robin within tiers of priority, and
+        # 'consistent-hash' sends requests with the same 'schedule_key' to the same server. Other strategies can be
+        # added with schedulers.register_scheduler.
+        #
+        # Any entry of 'server_dict' that is a dict may also have a 'weight', a positive integer which is the share of
+        # requests the server gets relative to the others (1 by default), and a 'priority', a number where servers
+        # of a higher priority are only used once every server of a lower one has failed or is quarantined (0 by
+        # default). Only the 'weighted' schedule uses them.
+        #
+        # 'schedule_key' is what the 'consistent-hash' schedule routes each request by, so that requests with the
+        # same key go to the same server. It may be the name of a keyword argument of the request, such as 'user',
+        # or a function which takes the keyword arguments and returns the key. If it is None, subclasses route by
+        # their user name argument, and ClientOfRedundantServers does not route by key.
         self._schedule = schedule
+        self._scheduling_options = dict((server, self._get_scheduling_options(config))
+                                        for server, config in zip(self.server_list, server_dict.values()))
+        self._schedule_key = self._get_schedule_key(schedule_key)
+        self._scheduler = get_scheduler(schedule)(self.server_list, self._health, self._scheduling_options,
+                                                  self._schedule_key)
+
+        # 'hedge_delay' turns on hedged requests. If the current server has not answered after 'hedge_delay' seconds,
+        # the same request is also sent to the next server, and whichever answers first wins. It may be a number, or
+        # a function which takes a server and returns a number (for example, the 95th percentile of its latency).
+        # Leave it as None to try servers strictly one after another.
+        self.hedge_delay = hedge_delay
+
+        # 'hedge_max_extra' is the most extra requests a single request may hedge with. 'hedge_budget' caps the
+        # extra load over time, as a fraction of requests, so 0.1 means at most about 10% more requests are sent.
+        self.hedge_max_extra = hedge_max_extra
+        self.hedge_budget = hedge_budget
+        self._hedge_tokens = HEDGE_BURST
+        self._hedge_lock = threading.Lock()
+
+        # 'hedge_executor' is the concurrent.futures.Executor that runs the extra requests of hedged requests; the
+        # first attempt of a request always runs in the calling thread. If it is None, a thread pool of
+        # 'hedge_workers' threads (or the ThreadPoolExecutor default, if that is None too) is created the first time
+        # one is needed, and shut down by close(). A single timer thread starts the hedges of every request.
+        self._hedge_executor = hedge_executor
+        self._owns_hedge_executor = hedge_executor is None
+        self.hedge_workers = hedge_workers
+        self._hedge_timer = None
+
+        # 'result_cache' is a ResultCache of the results of earlier requests, or None to always ask a server. Only
+        # use a cache if the keyword arguments of a request alone decide its result, as they do for authentication.
+        self.result_cache = result_cache
+
+        # 'coalesce' turns on single-flight requests. If a request is made while an identical request (the same
+        # func_to_call and keyword arguments) is in flight, it waits for that request and shares its result or
+        # exception, rather than asking a server again.
+        self.coalesce = coalesce
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+        # 'request_timeout' is the most seconds a request may take in total, across every server it fails over to,
+        # or None for no limit. If it is set, func_to_call is also given a 'time_budget' keyword argument: the
+        # seconds that attempt may take, which is an equal share of the time left between the servers not yet
+        # tried. func_to_call should give up and raise CurrentServerFailed once its budget is spent. No more servers
+        # are tried once the time is up.
+        self.request_timeout = request_timeout
+
+        # '_health_checks' refers to the background health checks started by start_health_checks, if they are
+        # running: the Event which stops their thread, or in asyncio their task.
+        self._health_checks = None
+
+        # 'metrics' is a metrics.Metrics, whose hooks are called with the outcome and latency of every attempt and
+        # request, the failover depth of each request and the time spent scheduling, or None for no metrics.
+        self.metrics = metrics
+
+        # 'failure_log_interval' is the fewest seconds between warnings that a given server failed, so that an outage
+        # does not flood the log. Failures in between are counted, and the count is logged with the next warning.
+        # Set it to 0 to log every failure.
+        self.failure_log_interval = failure_log_interval
+        # '_failure_logs' maps each server to a list of when its next failure may be logged, and how many failures
+        # have not been logged since the last one that was.
+        self._failure_logs = {}
+        self._failure_logs_lock = threading.Lock()
+
+    def update_servers(self, server_dict: OrderedDict):
+        """Public method used to replace the servers with those of a new server_dict, which may be done while other
+           threads make requests. Servers whose entry is unchanged keep their health, latency, sockets and
+           connections. Servers that are no longer there (or whose entry has changed) are drained: no new attempts
+           are made of them, the attempts in flight finish as usual, and their sockets and connections are closed
+           after the last one. Raises ValueError, and changes nothing, if an entry of server_dict is not valid."""
+        with self._servers_lock:
+            server_list = []
+            for name, config in server_dict.items():
+                server = self._servers_by_name.get(name)
+                if server is None or self._server_configs[name] != config:
+                    new_server = self._make_server(name, config)
+                    # The base client's servers are their names, which stay the same when their entry changes.
+                    if server is None or new_server != server:
+                        server = new_server
+                server_list.append(server)
+            options = dict((server, self._get_scheduling_options(config))
+                           for server, config in zip(server_list, server_dict.values()))
+
+            health = OrderedDict()
+            added = []
+            for server in server_list:
+                server_health = self._health.get(server)
+                if server_health is None:
+                    server_health = self._new_health(server)
+                    added.append(server)
+                elif server_health.draining and server not in self._draining:
+                    # The server was drained by an earlier update, so its sockets have been closed.
+                    added.append(server)
+                health[server] = server_health
+            removed = []
+            for server, server_health in self._health.items():
+                if server in health:
+                    continue
+                if server_health.draining and server not in self._draining and not server_health.outstanding:
+                    # Drained by an earlier update, so nothing can refer to it any longer.
+                    continue
+                health[server] = server_health
+                if not server_health.draining:
+                    removed.append(server)
+
+            scheduler = get_scheduler(self._schedule)(server_list, health, options, self._schedule_key)
+            for server in added:
+                if server not in self._closing:
+                    self._server_added(server)
+            for server in server_list:
+                self._draining.discard(server)
+                # A server added back while it is still being closed is set up again, and used, once it is closed.
+                health[server].draining = server in self._closing
+
+            self.server_dict = server_dict
+            self._server_configs = copy.deepcopy(dict(server_dict))
+            self.server_list = server_list
+            self._servers_by_name = dict(zip(server_dict.keys(), server_list))
+            self._server_list_len = len(server_list)
+            self._scheduling_options = options
+            self._health = health
+            for server in removed:
+                health[server].draining = True
+                self._draining.add(server)
+            self._scheduler = scheduler
+
+        logger.info("Servers updated: %d added, %d removed.", len(added), len(removed))
+        for server in removed:
+            if not health[server].outstanding:
+                self._finish_draining(server)
+
+    def _new_health(self, server):
+        """More private method used to create the ServerHealth of a server, or to find it in the shared health."""
+        if self._shared_health is None:
+            return ServerHealth(self._failure_threshold, self._recovery_timeout)
+        return self._shared_health.health(self._shared_health_key(server), self._failure_threshold,
+                                          self._recovery_timeout)
+
+    def _shared_health_key(self, server):
+        """More private method used to get the name the health of a server is kept under in the shared health. It
+           must be the same in every process, and differ between servers that are not the same, so it is the kind of
+           client as well as the server's name. Subclasses may override it to add what else tells their servers
+           apart, such as the port."""
+        return type(self).__name__ + ':' + str(server)
+
+    def _finish_draining(self, server):
+        """More private method used to release the sockets and connections of a removed server, once the last
+           request in flight to it has finished. It does nothing if that has been done already."""
+        with self._servers_lock:
+            if server not in self._draining:
+                return
+            self._draining.discard(server)
+            self._closing.add(server)
+        # Closing may block, so the lock is not held, and requests to the other servers go on meanwhile.
+        try:
+            self._server_drained(server)
+        finally:
+            with self._servers_lock:
+                self._closing.discard(server)
+                if server in self.server_list:
+                    # update_servers added the server back while it was being closed.
+                    self._server_added(server)
+                    self._health[server].draining = False
+        with self._failure_logs_lock:
+            self._failure_logs.pop(server, None)
+        logger.info("Server %s drained.", server)
+
+    def _server_added(self, server):
+        """More private method called by update_servers for each new server, before any request can be made of it.
+           Subclasses may override it to set up what they keep for each server."""
+        pass
+
+    def _server_drained(self, server):
+        """More private method called once a server removed by update_servers has no requests in flight.
+           Subclasses may override it to close what they keep for the server, such as sockets."""
+        pass
+
+    def start_watching_server_file(self, path, parse_func=None, interval=5):
+        """Public method used to reload the servers whenever a file changes. The file's modification time is checked
+           every 'interval' seconds in a daemon thread, and when it changes, parse_func is called with the path and
+           must return the new server_dict, which is passed to update_servers. If parse_func is None the file is
+           read with load_server_file, as JSON. If the file can't be read or is not valid, the error is logged and
+           the servers are left as they are until the file changes again. It runs until close() is called."""
+        if self._server_file_watch is not None:
+            raise RuntimeError("A server file is already being watched")
+        stopped = self._server_file_watch = threading.Event()
+        watcher = threading.Thread(target=self._server_file_loop,
+                                   args=(path, parse_func or load_server_file, interval, self._server_file_mtime(path),
+                                         stopped),
+                                   name='ServerFileWatcher')
+        watcher.daemon = True
+        watcher.start()
+
+    def stop_watching_server_file(self):
+        """Public method used to stop watching the server file, if it is being watched."""
+        if self._server_file_watch is not None:
+            self._server_file_watch.set()
+            self._server_file_watch = None
+
+    def _server_file_loop(self, path, parse_func, interval, mtime, stopped):
+        """More private method, run by the server file thread, used to reload the servers from the file whenever its
+           modification time is no longer 'mtime', until 'stopped' is set."""
+        while not stopped.wait(interval):
+            mtime = self._reload_server_file(path, parse_func, mtime)
+
+    @staticmethod
+    def _server_file_mtime(path):
+        """More private method used to get the modification time of the server file, or None if it can't be read."""
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload_server_file(self, path, parse_func, mtime):
+        """More private method used to reload the servers from the server file if its modification time is not
+           'mtime'. Returns the modification time of the file that was last tried."""
+        new_mtime = self._server_file_mtime(path)
+        if new_mtime is None or new_mtime == mtime:
+            return mtime
+        try:
+            self.update_servers(parse_func(path))
+        except Exception:
+            logger.exception("Reloading the servers from %s failed.", path)
+        return new_mtime
 
     def request(self, func_to_call, **kwargs):
         """Public method used to make a request of any available server. Returns a useful result if the request
            succeeds. Raises AllAvailableServersFailed if no server responded to a request in a useful way. The
            argument func_to_call is a function that will be run against each server in turn."""
-        if self._schedule == 'round-robin':
-            # Round-robin server order, servers are tried starting from the next server in the list each time.
-            # The starting position in the new list moves forward each time the method is called with this schedule.
-            new_list = self.server_list[self._rr_position:self._server_list_len]\
-                       + self.server_list[0:self._rr_position]
-            self._rr_position += 1
-            if self._rr_position >= self._server_list_len:
-                self._rr_position = 0
-            return self._request_recursive(func_to_call, new_list, **kwargs)
-
-        if self._schedule == 'random':
-            # Pseudo-random server order, servers are tried in a random order each time.
-            new_list = list(self.server_list)
-            shuffle(new_list)
-            return self._request_recursive(func_to_call, new_list, **kwargs)
-
-        # Fixed schedule, servers are tried in the order in which they are defined.
-        if self._schedule == 'fixed':
-            return self._request_recursive(func_to_call, self.server_list, **kwargs)
-
-        raise NotImplementedError("Schedule type " + self._schedule + " not implemented")
-
-    def _request_recursive(self, func_to_call, server_list: list, **kwargs):
-        """More private method used to recursively check each server until one doesn't fail."""
-        if not server_list:
-            # Default case, raise an exception if there are no servers to check.
-            logger.error("All available servers failed.")
-            raise AllAvailableServersFailed()
-
-        current_server = server_list[0]
+        if self.result_cache is None:
+            return self._request_single_flight(func_to_call, kwargs)
+        key, group = self.result_cache.make_keys(kwargs, self._cache_secret_kwargs, func_to_call)
+        found, result = self.result_cache.get(key)
+        if found:
+            return result
+        result = self._request_single_flight(func_to_call, kwargs)
+        self.result_cache.put(key, group, result)
+        return result
+
+    def request_many(self, func_to_call, kwargs_iterable, concurrency=8):
+        """Public method used to make many requests, up to 'concurrency' at a time. The argument kwargs_iterable
+           gives the keyword arguments of each request, and may be a generator of any length: it is only read as
+           far ahead as needed. Returns an iterator of the results, in the same order as the requests, which yields
+           each result as soon as it and the ones before it are ready. An exception raised by a request (such as
+           AllAvailableServersFailed) is yielded in place of its result, so that one failure does not end the
+           batch. The requests are scheduled as usual, so they are spread over all the healthy servers."""
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("concurrency must be a positive integer")
+        return self._request_many(func_to_call, iter(kwargs_iterable), concurrency)
 
+    def _request_many(self, func_to_call, kwargs_iterator, concurrency: int):
+        """More private generator used by request_many. Up to twice 'concurrency' requests are queued ahead of the
+           one being waited for, so the workers keep busy while a slow request holds up the results behind it."""
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        window = deque()
         try:
-            # Do something with current server
-            return func_to_call(current_server, **kwargs)
-        except CurrentServerFailed:
-            # Use the original list, minus the server we already tried.
-            logger.warning("Server " + str(current_server) + " failed.")
-            return self._request_recursive(func_to_call, server_list[1:], **kwargs)
+            for kwargs in itertools.islice(kwargs_iterator, 2 * concurrency):
+                window.append(executor.submit(self._request_or_error, func_to_call, kwargs))
+            while window:
+                result = window.popleft().result()
+                for kwargs in itertools.islice(kwargs_iterator, 1):
+                    window.append(executor.submit(self._request_or_error, func_to_call, kwargs))
+                yield result
+        finally:
+            # If the caller stops early, forget the requests that have not started.
+            for future in window:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _request_or_error(self, func_to_call, kwargs: dict):
+        """More private method used to make a request, returning the exception it raises instead of raising it."""
+        try:
+            return self.request(func_to_call, **kwargs)
+        except Exception as e:
+            return e
+
+    def invalidate_cached(self, **kwargs):
+        """Public method used to forget cached results. If every keyword argument of a request is given, only the
+           result of that request is forgotten. If the secret arguments (such as the password) are left out, the
+           results of every request with the other arguments are forgotten. Results are forgotten whichever
+           func_to_call they came from."""
+        if self.result_cache is None:
+            return
+        key, group = self.result_cache.make_keys(kwargs, self._cache_secret_kwargs)
+        if self._cache_secret_kwargs and all(name in kwargs for name in self._cache_secret_kwargs):
+            self.result_cache.invalidate(key)
+        else:
+            self.result_cache.invalidate_group(group)
+
+    def start_health_checks(self, interval=10, check_func=None):
+        """Public method used to start checking the health of every server in the background, every 'interval'
+           seconds, so that a dead server is found (and quarantined) before a request is sent to it, and a server
+           that has come back is used again straight away. The argument check_func is a function that is run against
+           each server in turn, and must return True if it is healthy, or return False or raise CurrentServerFailed
+           if it is not. If it is None, the client's own health check is used. The checks also feed the latency of
+           each server to the latency-aware schedules. They run in a daemon thread until close() is called."""
+        check_func = self._get_check_func(check_func)
+        if self._health_checks is not None:
+            raise RuntimeError("Health checks are already running")
+        stopped = self._health_checks = threading.Event()
+        checker = threading.Thread(target=self._health_check_loop, args=(interval, check_func, stopped),
+                                   name='HealthChecker')
+        checker.daemon = True
+        checker.start()
+
+    def stop_health_checks(self):
+        """Public method used to stop the background health checks, if they are running."""
+        if self._health_checks is not None:
+            self._health_checks.set()
+            self._health_checks = None
+
+    def check_health(self, check_func=None):
+        """Public method used to check the health of every server once, as the background health checks do."""
+        check_func = self._get_check_func(check_func)
+        for server in self.server_list:
+            # A check is counted as a request in flight, so a server removed meanwhile isn't closed under it.
+            started = self._attempt_started(server)
+            if started is None:
+                continue
+            try:
+                healthy = check_func(server)
+            except CurrentServerFailed:
+                healthy = False
+            finally:
+                self._check_finished(server)
+            self._record_health_check(server, healthy, time.monotonic() - started)
+
+    def _health_check_loop(self, interval, check_func, stopped):
+        """More private method, run by the health check thread, used to check every server every 'interval'
+           seconds until 'stopped' is set."""
+        while not stopped.is_set():
+            try:
+                self.check_health(check_func)
+            except Exception:
+                logger.exception("Health check failed.")
+            stopped.wait(interval)
+
+    def _get_check_func(self, check_func):
+        """More private method used to get the function to check the health of servers with: the given one, or the
+           client's own. Raises NotImplementedError if neither exists."""
+        if check_func is not None:
+            return check_func
+        if type(self)._health_check_func is ClientOfRedundantServers._health_check_func:
+            raise NotImplementedError("There is no health check for " + type(self).__name__)
+        return self._health_check_func
+
+    def _health_check_func(self, server):
+        """More private method used to check the health of a server. Subclasses override this with a check suited
+           to their servers."""
+        raise NotImplementedError
+
+    def _record_health_check(self, server, healthy, latency: float):
+        """More private method used to update the health of a server from a health check."""
+        health = self._health.get(server)
+        if health is None:
+            # The server was removed while it was being checked.
+            return
+        if healthy:
+            health.record_latency(latency)
+            health.record_success()
+        else:
+            logger.warning("Health check of server %s failed.", server)
+            health.record_failure()
+
+    def _request_single_flight(self, func_to_call, kwargs: dict):
+        """More private method used to make a request, or if 'coalesce' is set and an identical request is already
+           in flight, to wait for that one and share its result or exception."""
+        key = self._flight_key(func_to_call, kwargs)
+        if key is None:
+            return self._request(func_to_call, kwargs)
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._request(func_to_call, kwargs)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _flight_key(self, func_to_call, kwargs: dict):
+        """More private method used to identify a request for coalescing. Returns None if coalescing is off, or if
+           the request cannot be identified because its arguments are not hashable."""
+        if not self.coalesce:
+            return None
+        key = (func_to_call, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _request(self, func_to_call, kwargs: dict):
+        """More private method used to make a request of any available server, without the result cache."""
+        if self.hedge_delay is not None:
+            return self._request_hedged(func_to_call, kwargs)
+
+        requested = time.monotonic()
+        server_list, start = self._order(kwargs)
+        deadline = self._deadline()
+        attempts_left = len(server_list)
+        outcome = FAILURE
+        for current_server in self._failover_order(server_list, start):
+            attempt_kwargs = self._budgeted_kwargs(kwargs, deadline, attempts_left)
+            if attempt_kwargs is None:
+                logger.error("Request timed out.")
+                outcome = TIMEOUT
+                break
+            started = self._attempt_started(current_server)
+            if started is None:
+                continue
+            attempts_left -= 1
+            attempt_outcome = FAILURE
+            try:
+                # Do something with current server
+                result = func_to_call(current_server, **attempt_kwargs)
+                attempt_outcome = outcome_of(result)
+            except CurrentServerFailed as e:
+                attempt_outcome = self._failure_outcome(e)
+                self._record_failure(current_server)
+                continue
+            finally:
+                self._attempt_finished(current_server, started, attempt_outcome)
+            self._record_success(current_server)
+            self._request_finished(attempt_outcome, len(server_list) - attempts_left, requested)
+            return result
+
+        logger.error("All available servers failed.")
+        self._request_finished(outcome, len(server_list) - attempts_left, requested)
+        raise AllAvailableServersFailed()
+
+    def _request_hedged(self, func_to_call, kwargs: dict):
+        """More private method used to make a hedged request. Servers are tried in the usual failover order, each in
+           the calling thread, but if one has not answered after the hedge delay, the next is also tried in the hedge
+           executor. The calling thread can't give up on its own attempt, so the request is answered once that
+           attempt is over: with the first useful result, or if there is none, by the hedges still in flight. Any
+           replies that arrive after the answer are only used to update server health."""
+        self._start_hedge_executor()
+        self._earn_hedge_token()
+        requested = time.monotonic()
+        server_list, start = self._order(kwargs)
+        hedged = _HedgedRequest(self._failover_order(server_list, start), self._deadline())
+        pending = hedged.pending
+        current_server = None
+        outcome = FAILURE
+
+        while True:
+            if pending:
+                timeout = None
+                if current_server is not None and self._can_hedge(hedged.extra_sent):
+                    timeout = self._hedge_delay_for(current_server)
+                timeout = self._until_deadline(hedged.deadline, timeout)
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            elif outcome == TIMEOUT:
+                break
+            else:
+                # Nothing is in flight, so the next server is tried in this thread.
+                own_future = self._attempt_hedged(func_to_call, kwargs, hedged)
+                if own_future is None:
+                    break
+                current_server = hedged.current_server
+                # Hedges that finished while this thread was busy answered before its own attempt did.
+                done = [future for future in pending if future.done() and future is not own_future] + [own_future]
+
+            if not done:
+                if self._until_deadline(hedged.deadline) == 0:
+                    logger.error("Request timed out.")
+                    outcome = TIMEOUT
+                    self._abandon(pending)
+                    break
+                # The current server is slow, so hedge with the next one.
+                if not self._take_hedge_token():
+                    # Other requests spent the allowance while we were waiting.
+                    hedged.extra_sent = self.hedge_max_extra
+                    continue
+                current_server = self._submit_next_hedged(func_to_call, hedged.order, kwargs, hedged.deadline,
+                                                          pending)
+                if current_server is None:
+                    self._refund_hedge_token()
+                    continue
+                hedged.extra_sent += 1
+                hedged.depth += 1
+                continue
+
+            for future in done:
+                server = pending.pop(future)
+                try:
+                    result = future.result()
+                except CurrentServerFailed:
+                    self._record_failure(server)
+                    if self._until_deadline(hedged.deadline) == 0:
+                        # There is no time left to fail over, so the request has timed out.
+                        outcome = TIMEOUT
+                        current_server = None
+                    elif any(not other.done() for other in pending):
+                        # Replace the failed server with the next one, which is failover rather than extra load.
+                        current_server = self._submit_next_hedged(func_to_call, hedged.order, kwargs,
+                                                                  hedged.deadline, pending)
+                        if current_server is not None:
+                            hedged.depth += 1
+                    continue
+                self._record_success(server)
+                self._abandon(pending)
+                self._request_finished(outcome_of(result), hedged.depth, requested)
+                return result
+
+        logger.error("All available servers failed.")
+        self._request_finished(outcome, hedged.depth, requested)
+        raise AllAvailableServersFailed()
+
+    def _attempt_hedged(self, func_to_call, kwargs: dict, hedged):
+        """More private method used to try the next server from the failover order that can still be used in this
+           thread, while the hedge timer tries more in the hedge executor if it is slow. The attempt is added to the
+           pending requests as a finished future, which is returned, or None if there are no more servers."""
+        for server in hedged.order:
+            attempt_kwargs = self._budgeted_kwargs(kwargs, hedged.deadline, 1)
+            if attempt_kwargs is None:
+                # The deadline has only just passed, so this attempt is abandoned as soon as it is waited for.
+                attempt_kwargs = dict(kwargs, time_budget=0.0)
+            started = self._attempt_started(server)
+            if started is not None:
+                break
+        else:
+            return None
+
+        hedged.depth += 1
+        hedged.current_server = None
+        hedged.stopped = False
+        if self._can_hedge(hedged.extra_sent):
+            hedged.timer = self._hedge_timer.call_later(self._hedge_delay_for(server),
+                                                        self._hedge_launcher(func_to_call, kwargs, hedged))
+        future = Future()
+        try:
+            future.set_result(func_to_call(server, **attempt_kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        with hedged.lock:
+            # From here on, only this thread uses the state of the request.
+            hedged.stopped = True
+        self._hedge_timer.cancel(hedged.timer)
+        self._attempt_finished(server, started, self._future_outcome(future))
+        hedged.pending[future] = server
+        return future
+
+    def _hedge_launcher(self, func_to_call, kwargs: dict, hedged):
+        """More private method used to make the callback which the hedge timer calls once the current server of a
+           hedged request has been slow for the hedge delay. It tries the next server in the hedge executor, and
+           calls itself again after the hedge delay of that server, if the request may hedge again."""
+        def launch():
+            with hedged.lock:
+                if hedged.stopped or not self._can_hedge(hedged.extra_sent) or not self._take_hedge_token():
+                    return
+                server = self._submit_next_hedged(func_to_call, hedged.order, kwargs, hedged.deadline, hedged.pending)
+                if server is None:
+                    self._refund_hedge_token()
+                    return
+                hedged.extra_sent += 1
+                hedged.depth += 1
+                hedged.current_server = server
+                if self._can_hedge(hedged.extra_sent):
+                    hedged.timer = self._hedge_timer.call_later(self._hedge_delay_for(server), launch)
+        return launch
+
+    def _start_hedge_executor(self):
+        """More private method used to create the thread pool and the timer for hedged requests the first time one
+           is needed. Only one of each is ever created, however many threads make their first hedged request at
+           once."""
+        if self._hedge_timer is not None:
+            return
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=self.hedge_workers)
+            if self._hedge_timer is None:
+                self._hedge_timer = _HedgeTimer()
+
+    def _submit_next_hedged(self, func_to_call, order, kwargs: dict, deadline, pending: dict):
+        """More private method used to start func_to_call against the next server from the failover order that
+           can still be used, adding its future to 'pending'. Returns the server, or None if there are no more."""
+        for server in order:
+            future = self._submit_hedged(func_to_call, server, kwargs, deadline)
+            if future is not None:
+                pending[future] = server
+                return server
+        return None
+
+    def _submit_hedged(self, func_to_call, server, kwargs: dict, deadline):
+        """More private method used to start func_to_call against a server in the hedge executor. Returns its
+           future, or None if the server has been removed by update_servers. Hedged attempts run side by side, so
+           each may take all the time left before the deadline."""
+        attempt_kwargs = self._budgeted_kwargs(kwargs, deadline, 1)
+        if attempt_kwargs is None:
+            # The deadline has only just passed, so this attempt is abandoned as soon as it is waited for.
+            attempt_kwargs = dict(kwargs, time_budget=0.0)
+        started = self._attempt_started(server)
+        if started is None:
+            return None
+        future = self._hedge_executor.submit(func_to_call, server, **attempt_kwargs)
+        future.add_done_callback(lambda _: self._attempt_finished(server, started, self._future_outcome(future)))
+        return future
+
+    def _abandon(self, pending: dict):
+        """More private method used to stop waiting for hedged requests. Those that have not started are cancelled,
+           and the replies of the others are only used to update server health."""
+        for late_future, late_server in pending.items():
+            if not late_future.cancel():
+                late_future.add_done_callback(self._late_reply_recorder(late_server))
+
+    def _order(self, kwargs: dict):
+        """More private method used to ask the scheduler for the order of servers for a request, timing it if
+           there are metrics. Returns the same as Scheduler.order."""
+        if self.metrics is None:
+            return self._scheduler.order(kwargs)
+        started = time.monotonic()
+        order = self._scheduler.order(kwargs)
+        self.metrics.record_schedule(self._schedule, time.monotonic() - started)
+        return order
+
+    def _request_finished(self, outcome: str, depth: int, requested: float):
+        """More private method used to record the outcome of a request that was sent to 'depth' servers, and
+           started at 'requested', if there are metrics."""
+        if self.metrics is not None:
+            self.metrics.record_request(outcome, depth, time.monotonic() - requested)
+
+    @staticmethod
+    def _failure_outcome(error):
+        """More private method used to get the outcome of an attempt that raised CurrentServerFailed."""
+        return TIMEOUT if isinstance(error, CurrentServerTimedOut) else FAILURE
+
+    def _future_outcome(self, future):
+        """More private method used to get the outcome of a finished hedged attempt, from its future."""
+        if future.cancelled():
+            return CANCELLED
+        error = future.exception()
+        if error is None:
+            return outcome_of(future.result())
+        if isinstance(error, CurrentServerFailed):
+            return self._failure_outcome(error)
+        return FAILURE
+
+    def _deadline(self):
+        """More private method used to get the time by which a request starting now must finish, or None if there
+           is no 'request_timeout'."""
+        if self.request_timeout is None:
+            return None
+        return time.monotonic() + self.request_timeout
+
+    @staticmethod
+    def _until_deadline(deadline, timeout=None):
+        """More private method used to get the seconds left before the deadline, but no more than 'timeout'. Returns
+           'timeout' if there is no deadline, and 0 once the deadline has passed."""
+        if deadline is None:
+            return timeout
+        remaining = max(deadline - time.monotonic(), 0)
+        if timeout is None:
+            return remaining
+        return min(remaining, timeout)
+
+    def _budgeted_kwargs(self, kwargs: dict, deadline, attempts_left: int):
+        """More private method used to add the time budget of an attempt to the keyword arguments of func_to_call,
+           sharing the time left equally between the 'attempts_left' servers. Returns the keyword arguments as they
+           are if there is no deadline, or None if the deadline has passed."""
+        if deadline is None:
+            return kwargs
+        remaining = self._until_deadline(deadline)
+        if remaining == 0:
+            return None
+        return dict(kwargs, time_budget=remaining / attempts_left)
+
+    def _hedge_delay_for(self, server):
+        """More private method used to get the hedge delay for a server, in seconds."""
+        if callable(self.hedge_delay):
+            return self.hedge_delay(server)
+        return self.hedge_delay
+
+    def _earn_hedge_token(self):
+        """More private method used to add 'hedge_budget' to the hedge allowance, once per hedged request."""
+        with self._hedge_lock:
+            self._hedge_tokens = min(self._hedge_tokens + self.hedge_budget, HEDGE_BURST)
+
+    def _can_hedge(self, extra_sent: int):
+        """More private method used to check whether a request that has already sent 'extra_sent' extra requests
+           may hedge again."""
+        return extra_sent < self.hedge_max_extra and self._hedge_tokens >= 1
+
+    def _take_hedge_token(self):
+        """More private method used to spend one hedge from the allowance. Returns False if there is none left."""
+        with self._hedge_lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            return True
+
+    def _refund_hedge_token(self):
+        """More private method used to give back a hedge that was taken but not sent."""
+        with self._hedge_lock:
+            self._hedge_tokens += 1
+
+    def _late_reply_recorder(self, server):
+        """More private method used to make a callback which records the health of a server from a reply that
+           arrived after the request was already answered. The reply itself is ignored."""
+        def record(future):
+            if future.cancelled():
+                return
+            if isinstance(future.exception(), CurrentServerFailed):
+                self._record_failure(server)
+            elif future.exception() is None:
+                self._record_success(server)
+        return record
+
+    def _failover_order(self, server_list: list, start: int):
+        """More private generator used to yield each server in turn, starting from server_list[start] and wrapping
+           around to the beginning of the list, so that no new list has to be built for each request. Quarantined
+           servers are skipped, and only yielded once every other server has been tried."""
+        list_len = len(server_list)
+        deferred = None
+        for offset in range(list_len):
+            index = start + offset
+            if index >= list_len:
+                index -= list_len
+            current_server = server_list[index]
+
+            health = self._health.get(current_server)
+            if health is None or health.draining:
+                # The server was removed by update_servers after this request was scheduled. It may still be removed
+                # after it is yielded, which _attempt_started checks again.
+                continue
+            if not health.allow_request():
+                if deferred is None:
+                    deferred = []
+                deferred.append(current_server)
+                continue
+            yield current_server
+
+        if deferred is not None:
+            # Last resort, try the quarantined servers in the scheduled order.
+            yield from deferred
+
+    def _attempt_started(self, current_server):
+        """More private method used to record that a request to a server is about to start. Returns the time it
+           started, to be passed to _attempt_finished, or None if the server has been removed by update_servers, in
+           which case no request must be made of it."""
+        # The server is checked and counted as in flight under the lock update_servers holds, so either it is
+        # removed first and the attempt never starts, or update_servers sees the attempt and leaves the server's
+        # sockets and connections open until the attempt has finished.
+        with self._servers_lock:
+            health = self._health.get(current_server)
+            if health is None or health.draining:
+                return None
+            health.attempt_started()
+        return time.monotonic()
+
+    def _attempt_finished(self, current_server, started: float, outcome: str):
+        """More private method used to record that a request to a server finished, with the given outcome."""
+        latency = time.monotonic() - started
+        health = self._health[current_server]
+        health.attempt_finished(self._scheduling_latency(latency, outcome))
+        if health.draining and not health.outstanding:
+            self._finish_draining(current_server)
+        if self.metrics is not None:
+            self.metrics.record_attempt(current_server, outcome, latency)
+
+    def _check_finished(self, server):
+        """More private method used to record that a health check of a server, started with _attempt_started, has
+           finished. Its latency is recorded by _record_health_check rather than here."""
+        health = self._health[server]
+        health.attempt_finished(None)
+        if health.draining and not health.outstanding:
+            self._finish_draining(server)
+
+    @staticmethod
+    def _scheduling_latency(latency: float, outcome: str):
+        """More private method used to get the latency of an attempt that the latency-aware schedules should see. A
+           failure counts as at least FAILURE_LATENCY, so that a server which fails fast is not tried first, and an
+           attempt cancelled before it finished is not counted, as how long it would have taken is not known."""
+        if outcome == CANCELLED:
+            return None
+        if outcome in (FAILURE, TIMEOUT):
+            return max(latency, FAILURE_LATENCY)
+        return latency
+
+    @property
+    def _rr_position(self):
+        """The position in the server list of the first server to try for the next round-robin request."""
+        return getattr(self._scheduler, 'position', 0)
+
+    def _record_failure(self, current_server):
+        """More private method used to record that a server raised CurrentServerFailed."""
+        self._health[current_server].record_failure()
+        if logger.isEnabledFor(logging.WARNING):
+            self._log_failure(current_server)
+
+    def _log_failure(self, current_server):
+        """More private method used to log that a server failed, unless a failure of that server was logged less
+           than 'failure_log_interval' seconds ago, in which case it is only counted."""
+        now = time.monotonic()
+        with self._failure_logs_lock:
+            failure_log = self._failure_logs.get(current_server)
+            if failure_log is None:
+                failure_log = self._failure_logs[current_server] = [0.0, 0]
+            if now < failure_log[0]:
+                failure_log[1] += 1
+                return
+            unlogged = failure_log[1]
+            failure_log[0] = now + self.failure_log_interval
+            failure_log[1] = 0
+        if unlogged:
+            logger.warning("Server %s failed (and %d more times since it was last logged).", current_server, unlogged)
+        else:
+            logger.warning("Server %s failed.", current_server)
+
+    def _record_success(self, current_server):
+        """More private method used to record that a server responded to a request in a useful way."""
+        self._health[current_server].record_success()
+
+    def _make_server(self, name, config):
+        """More private method called once for each entry of server_dict, with its key and value, when the client is
+           created. Subclasses may override it to validate the configuration and return a ServerDescriptor. Raises
+           ValueError if the configuration is not valid."""
+        return name
+
+    @staticmethod
+    def _get_scheduling_options(config):
+        """More private method used to get the scheduling options, such as 'weight' and 'priority', from an entry of
+           server_dict."""
+        if not isinstance(config, dict):
+            return {}
+        return dict((name, config[name]) for name in DEFAULT_OPTIONS if name in config)
+
+    def _get_schedule_key(self, schedule_key):
+        """More private method used to turn 'schedule_key' into a function of the keyword arguments of a request, or
+           None."""
+        if schedule_key is None:
+            schedule_key = self._schedule_key_kwarg
+        if schedule_key is None or callable(schedule_key):
+            return schedule_key
+        return lambda kwargs: kwargs.get(schedule_key)
+
+    def close(self):
+        """Public method used to release anything the client holds on to between requests, such as threads."""
+        self.stop_health_checks()
+        self.stop_watching_server_file()
+        with self._hedge_lock:
+            if self._owns_hedge_executor and self._hedge_executor is not None:
+                self._hedge_executor.shutdown(wait=False)
+                self._hedge_executor = None
+            if self._hedge_timer is not None:
+                self._hedge_timer.close()
+                self._hedge_timer = None
+
+    def server_health(self, server):
+        """Public method used to get the ServerHealth for the given server, which may be given as its key in
+           server_dict, for example to check whether it is currently quarantined."""
+        if server in self._servers_by_name:
+            server = self._servers_by_name[server]
+        return self._health[server]
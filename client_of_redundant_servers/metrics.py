@@ -0,0 +1,207 @@
+"""
+Metrics hooks for clients of redundant servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import Counter
+import bisect
+import threading
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# The outcomes of an attempt against a single server, and of a whole request. A success is a useful result, and a
+# reject a negative one (such as a rejected user). A failure means the server raised CurrentServerFailed (for a
+# request, that every server did), and a timeout that it did not answer in time. An attempt is cancelled when a
+# hedged request is answered by another server first.
+SUCCESS = 'success'
+REJECT = 'reject'
+FAILURE = 'failure'
+TIMEOUT = 'timeout'
+CANCELLED = 'cancelled'
+
+# The upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# The upper bounds of the failover depth histogram buckets, in servers tried.
+DEPTH_BUCKETS = (1, 2, 3, 4, 5, 8, 13, float('inf'))
+
+
+def outcome_of(result):
+    """Public function used to get the outcome of a useful result: SUCCESS if it is true, REJECT if it is false."""
+    return SUCCESS if result else REJECT
+
+
+class Metrics(object):
+    """Base class for metrics hooks, which a client of redundant servers calls as it makes requests. Every hook does
+       nothing here: subclasses override the ones they want. Hooks are called from whichever thread made the request
+       (or from a hedge executor thread), so they must be safe to call from many threads at once, and quick."""
+
+    def record_attempt(self, server, outcome: str, latency: float):
+        """Public method called when an attempt against a single server finishes, with its outcome (SUCCESS, REJECT,
+           FAILURE, TIMEOUT or CANCELLED) and how long it took in seconds."""
+
+    def record_request(self, outcome: str, depth: int, latency: float):
+        """Public method called when a request finishes, with its outcome (SUCCESS, REJECT, FAILURE or TIMEOUT), its
+           failover depth (the number of servers it was sent to) and how long it took in seconds."""
+
+    def record_schedule(self, schedule: str, seconds: float):
+        """Public method called each time a schedule picks the order of servers for a request, with the name of the
+           schedule and how long it took in seconds."""
+
+
+class Histogram(object):
+    """A histogram with fixed buckets, like a Prometheus histogram. 'counts' holds the number of observations in
+       each bucket (not cumulative), 'count' the total number and 'sum' their total."""
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Public method used to add an observation. The caller must hold any lock that protects the histogram."""
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        """Public method used to estimate a quantile, such as 0.99, as the upper bound of the bucket it falls in.
+           Returns None if there are no observations."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class ServerMetrics(object):
+    """The counters and latency histogram of a single server, kept by InMemoryMetrics."""
+    __slots__ = ('attempts', 'successes', 'rejects', 'failures', 'timeouts', 'cancelled', 'latency')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.attempts = 0
+        self.successes = 0
+        self.rejects = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.latency = Histogram(buckets)
+
+
+# The attribute of ServerMetrics that counts each outcome.
+_OUTCOME_COUNTERS = {SUCCESS: 'successes', REJECT: 'rejects', FAILURE: 'failures', TIMEOUT: 'timeouts',
+                     CANCELLED: 'cancelled'}
+
+
+class InMemoryMetrics(Metrics):
+    """Keeps metrics in memory, for a program to read (or log) itself, and for tests. 'servers' maps the name of
+       each server (as a string, as the other backends label it) to its ServerMetrics, 'requests' counts requests by outcome, and 'failover_depth', 'request_latency' and
+       'schedule_time' (a dict of histograms by schedule name) are histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self.servers = {}
+        self.requests = Counter()
+        self.failover_depth = Histogram(DEPTH_BUCKETS)
+        self.request_latency = Histogram(buckets)
+        self.schedule_time = {}
+
+    def record_attempt(self, server, outcome: str, latency: float):
+        with self._lock:
+            name = str(server)
+            server_metrics = self.servers.get(name)
+            if server_metrics is None:
+                server_metrics = self.servers[name] = ServerMetrics(self._buckets)
+            server_metrics.attempts += 1
+            counter = _OUTCOME_COUNTERS[outcome]
+            setattr(server_metrics, counter, getattr(server_metrics, counter) + 1)
+            server_metrics.latency.observe(latency)
+
+    def record_request(self, outcome: str, depth: int, latency: float):
+        with self._lock:
+            self.requests[outcome] += 1
+            self.failover_depth.observe(depth)
+            self.request_latency.observe(latency)
+
+    def record_schedule(self, schedule: str, seconds: float):
+        with self._lock:
+            histogram = self.schedule_time.get(schedule)
+            if histogram is None:
+                histogram = self.schedule_time[schedule] = Histogram(self._buckets)
+            histogram.observe(seconds)
+
+
+class PrometheusMetrics(Metrics):
+    """Exports metrics with prometheus_client, which must be installed. The metric names start with 'namespace':
+       <namespace>_attempts_total and <namespace>_attempt_latency_seconds by server (and outcome), and
+       <namespace>_requests_total, <namespace>_failover_depth, <namespace>_request_latency_seconds and
+       <namespace>_schedule_seconds. They are registered with 'registry', or the default registry if it is None."""
+
+    def __init__(self, namespace='redundant_servers', registry=None, buckets=LATENCY_BUCKETS):
+        if prometheus_client is None:
+            raise ImportError("PrometheusMetrics needs the prometheus_client package")
+        kwargs = {'namespace': namespace}
+        if registry is not None:
+            kwargs['registry'] = registry
+        self._attempts = prometheus_client.Counter('attempts', 'Attempts against each server, by outcome',
+                                                   ['server', 'outcome'], **kwargs)
+        self._attempt_latency = prometheus_client.Histogram('attempt_latency_seconds',
+                                                            'Latency of attempts against each server', ['server'],
+                                                            buckets=buckets, **kwargs)
+        self._requests = prometheus_client.Counter('requests', 'Requests, by outcome', ['outcome'], **kwargs)
+        self._failover_depth = prometheus_client.Histogram('failover_depth', 'Servers tried per request',
+                                                           buckets=DEPTH_BUCKETS, **kwargs)
+        self._request_latency = prometheus_client.Histogram('request_latency_seconds', 'Latency of requests',
+                                                            buckets=buckets, **kwargs)
+        self._schedule_time = prometheus_client.Histogram('schedule_seconds', 'Time spent picking the order of servers',
+                                                          ['schedule'], buckets=buckets, **kwargs)
+
+    def record_attempt(self, server, outcome: str, latency: float):
+        self._attempts.labels(str(server), outcome).inc()
+        self._attempt_latency.labels(str(server)).observe(latency)
+
+    def record_request(self, outcome: str, depth: int, latency: float):
+        self._requests.labels(outcome).inc()
+        self._failover_depth.observe(depth)
+        self._request_latency.observe(latency)
+
+    def record_schedule(self, schedule: str, seconds: float):
+        self._schedule_time.labels(schedule).observe(seconds)
+
+
+class StatsdMetrics(Metrics):
+    """Sends metrics to StatsD through 'client', which may be any object with the incr(stat, count) and
+       timing(stat, milliseconds) methods of a statsd.StatsClient. The stats are <prefix>.server.<server>.attempts,
+       .successes, .rejects, .failures, .timeouts, .cancelled and .latency; <prefix>.requests.<outcome>,
+       <prefix>.failover_depth.<depth> and <prefix>.request_latency; and <prefix>.schedule.<schedule>. Dots in
+       server names are replaced with underscores, so that StatsD does not split them."""
+
+    def __init__(self, client, prefix='redundant_servers'):
+        self.client = client
+        self.prefix = prefix
+
+    def record_attempt(self, server, outcome: str, latency: float):
+        stat = self.prefix + '.server.' + str(server).replace('.', '_') + '.'
+        self.client.incr(stat + 'attempts', 1)
+        self.client.incr(stat + _OUTCOME_COUNTERS[outcome], 1)
+        self.client.timing(stat + 'latency', latency * 1000)
+
+    def record_request(self, outcome: str, depth: int, latency: float):
+        self.client.incr(self.prefix + '.requests.' + outcome, 1)
+        self.client.incr(self.prefix + '.failover_depth.' + str(depth), 1)
+        self.client.timing(self.prefix + '.request_latency', latency * 1000)
+
+    def record_schedule(self, schedule: str, seconds: float):
+        self.client.timing(self.prefix + '.schedule.' + schedule, seconds * 1000)
@@ -0,0 +1,124 @@
+"""
+Cache of the results of requests to redundant servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import OrderedDict
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+
+class ResultCache(object):
+    """A bounded, least recently used cache of request results, which expire after a time to live. Useful results
+       (such as an accepted user) and negative results (such as a rejected user) have separate times to live, so a
+       user who has just fixed a typo is not kept waiting as long as a user who logged in. The requests are never
+       stored: each is identified by the function that made it and a keyed hash of its arguments, with a random salt
+       chosen when the cache is created, so no plaintext passwords are held. The cache is safe to share between
+       threads."""
+    def __init__(self, max_entries=10000, accept_ttl=60.0, reject_ttl=5.0, clock=time.monotonic):
+        # 'max_entries' bounds the memory used. When the cache is full, the least recently used result is evicted.
+        if not isinstance(max_entries, int) or max_entries < 1:
+            raise ValueError("max_entries must be a positive integer")
+        self.max_entries = max_entries
+
+        # 'accept_ttl' is the number of seconds a useful (true) result is kept, and 'reject_ttl' the number of
+        # seconds a negative (false) result is kept. A time to live of 0 means such results are never cached.
+        self.accept_ttl = accept_ttl
+        self.reject_ttl = reject_ttl
+
+        # 'hits' and 'misses' count lookups that did and did not find a live result.
+        self.hits = 0
+        self.misses = 0
+
+        self._salt = os.urandom(16)
+        self._clock = clock
+        self._lock = threading.Lock()
+        # '_entries' maps each key to a tuple of its result, expiry time and group, least recently used first.
+        self._entries = OrderedDict()
+        # '_groups' maps each group to the set of keys in it, so a user can be forgotten whatever their password.
+        self._groups = {}
+
+    def make_keys(self, kwargs: dict, secret_names=(), func_to_call=None):
+        """Public method used to hash the keyword arguments of a request made with func_to_call, so that requests
+           of different functions with the same arguments are told apart, as they are when coalescing. Returns a
+           tuple of the key of the request, and the key of its group: the requests of the same function with the
+           same arguments apart from those named in 'secret_names'. When forgetting results, a func_to_call of None
+           stands for every function."""
+        group = self._digest(sorted((name, value) for name, value in kwargs.items() if name not in secret_names))
+        key = self._digest(sorted(kwargs.items()))
+        return (func_to_call, key), (func_to_call, group)
+
+    def get(self, key):
+        """Public method used to look up the result of a request by its key. Returns a tuple of True and the result
+           if there is a live result, otherwise a tuple of False and None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._clock() < entry[1]:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def put(self, key, group, result):
+        """Public method used to store the result of a request, with the time to live for a useful or negative
+           result as appropriate."""
+        ttl = self.accept_ttl if result else self.reject_ttl
+        if not ttl or ttl <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, self._clock() + ttl, group)
+            self._groups.setdefault(group, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        """Public method used to forget the result of a single request, by its key, or of the request with the same
+           arguments made by every function if the function of the key is None."""
+        with self._lock:
+            for key in self._matching(self._entries, key):
+                self._remove(key)
+
+    def invalidate_group(self, group):
+        """Public method used to forget the results of every request in a group, by the key of the group, or in
+           the groups with the same arguments of every function if the function of the group is None."""
+        with self._lock:
+            for group in self._matching(self._groups, group):
+                for key in list(self._groups.get(group, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """Public method used to forget every result. The hit and miss counters are left alone."""
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        """More private method used to remove an entry, and its key from its group. The lock must be held."""
+        group = self._entries.pop(key)[2]
+        keys = self._groups[group]
+        keys.discard(key)
+        if not keys:
+            del self._groups[group]
+
+    @staticmethod
+    def _matching(entries: dict, key):
+        """More private method used to list the keys of 'entries' which match a key, either exactly or, if the
+           function of the key is None, whatever their function. The latter looks through every entry."""
+        if key[0] is not None:
+            return [key] if key in entries else []
+        return [entry_key for entry_key in entries if entry_key[1] == key[1]]
+
+    def _digest(self, items):
+        """More private method used to hash a sorted list of name and value pairs with the salt."""
+        return hmac.new(self._salt, repr(items).encode('utf-8'), hashlib.sha256).digest()
@@ -0,0 +1,266 @@
+"""
+Scheduling strategies for clients of redundant servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+from random import shuffle, sample
+import bisect
+import hashlib
+import itertools
+
+# The scheduling options of a server that are not given in its entry of server_dict.
+DEFAULT_OPTIONS = {'weight': 1, 'priority': 0}
+
+# The number of points each server of weight 1 has on the ring of the 'consistent-hash' schedule. More points spread
+# the keys more evenly between servers, at the cost of a bigger ring.
+VIRTUAL_NODES = 160
+
+# '_schedulers' maps the name of each schedule to the Scheduler subclass that implements it.
+_schedulers = {}
+
+
+def register_scheduler(name: str, scheduler_class):
+    """Public function used to make a Scheduler subclass available as a schedule of ClientOfRedundantServers, under
+       the given name. Registering a name again replaces the previous scheduler."""
+    _schedulers[name] = scheduler_class
+
+
+def get_scheduler(name: str):
+    """Public function used to get the Scheduler subclass registered under the given name. Raises
+       NotImplementedError if there is no such schedule."""
+    try:
+        return _schedulers[name]
+    except (KeyError, TypeError):
+        raise NotImplementedError("Schedule type " + str(name) + " not implemented")
+
+
+class Scheduler(object):
+    """Base class for scheduling strategies, which pick the order in which servers are tried for each request. A
+       scheduler is given the client's server list, the ServerHealth of each server, which keeps track of
+       failures, latency and requests in flight, and the scheduling options of each server, which are its 'weight'
+       and 'priority'."""
+    def __init__(self, server_list: list, health: dict, options: dict=None, key=None):
+        self.server_list = server_list
+        self.health = health
+
+        # 'options' maps each server to a dict of its scheduling options. Servers that are missing, or options that
+        # are missing, take the defaults: a 'weight' of 1 and a 'priority' of 0.
+        self.options = {} if options is None else options
+
+        # 'key' is a function which takes the keyword arguments of a request and returns the key to route it by,
+        # such as the user name, or None. Only schedulers that route by key, like 'consistent-hash', use it.
+        self.key = key
+
+    def option(self, server, name: str):
+        """Public method used to get a scheduling option of the given server, or its default."""
+        return self.options.get(server, {}).get(name, DEFAULT_OPTIONS[name])
+
+    def weight(self, server):
+        """Public method used to get the 'weight' of the given server. Raises ValueError if it is not a positive
+           integer."""
+        weight = self.option(server, 'weight')
+        if not isinstance(weight, int) or isinstance(weight, bool) or weight < 1:
+            raise ValueError("Server " + str(server) + " must have a positive integer 'weight'")
+        return weight
+
+    def order(self, kwargs: dict):
+        """Public method used to pick the order in which servers are tried for the next request, which is made with
+           the given keyword arguments. Returns a server list and the index in that list of the first server to try;
+           the rest are tried in list order, wrapping around at the end."""
+        raise NotImplementedError
+
+
+class RoundRobinScheduler(Scheduler):
+    """Servers are tried starting from the next server in the list each time. Each request takes a ticket from a
+       shared counter, and starts at the server the ticket falls on. Taking a ticket is a single atomic step, so the
+       distribution stays even when many threads make requests at once."""
+    def __init__(self, server_list: list, health: dict, options: dict=None, key=None):
+        super().__init__(server_list, health, options, key)
+        self._tickets = itertools.count()
+
+        # 'position' is where the next request will start, for information only.
+        self.position = 0
+
+    def order(self, kwargs: dict):
+        list_len = len(self.server_list)
+        if not list_len:
+            return self.server_list, 0
+        ticket = next(self._tickets)
+        self.position = (ticket + 1) % list_len
+        return self.server_list, ticket % list_len
+
+
+class RandomScheduler(Scheduler):
+    """Servers are tried in a pseudo-random order each time."""
+    def order(self, kwargs: dict):
+        new_list = list(self.server_list)
+        shuffle(new_list)
+        return new_list, 0
+
+
+class FixedScheduler(Scheduler):
+    """Servers are tried in the order in which they are defined, every time."""
+    def order(self, kwargs: dict):
+        return self.server_list, 0
+
+
+class EwmaScheduler(Scheduler):
+    """Servers are tried fastest first, by their exponentially weighted moving average latency. Servers we have no
+       latency for yet sort first, so that every server gets measured."""
+    def order(self, kwargs: dict):
+        return sorted(self.server_list, key=self._latency), 0
+
+    def _latency(self, server):
+        latency = self.health[server].latency_ewma
+        return 0.0 if latency is None else latency
+
+
+class LeastOutstandingScheduler(RoundRobinScheduler):
+    """Servers are tried least busy first, by the number of requests currently in flight to each. Servers that are
+       equally busy are taken in round-robin order."""
+    def order(self, kwargs: dict):
+        server_list, start = super().order(kwargs)
+        rotated = server_list[start:] + server_list[:start]
+        # sorted() is stable, so ties keep their round-robin order.
+        return sorted(rotated, key=self._outstanding), 0
+
+    def _outstanding(self, server):
+        return self.health[server].outstanding
+
+
+class PowerOfTwoScheduler(Scheduler):
+    """Two servers are picked at random, and the one with fewer requests in flight (or, if they are equally busy, the
+       lower latency) is tried first, then the other. The rest are failed over to in the order they are defined."""
+    def order(self, kwargs: dict):
+        if len(self.server_list) < 2:
+            return self.server_list, 0
+        first, second = sample(self.server_list, 2)
+        if self._load(second) < self._load(first):
+            first, second = second, first
+        new_list = [first, second]
+        new_list.extend(server for server in self.server_list if server is not first and server is not second)
+        return new_list, 0
+
+    def _load(self, server):
+        health = self.health[server]
+        return health.outstanding, 0.0 if health.latency_ewma is None else health.latency_ewma
+
+
+def smooth_weighted_sequence(weights: list):
+    """Public function used to work out one cycle of smooth weighted round-robin, as done by nginx, for servers with
+       the given positive integer weights. Each turn, every server's current weight goes up by its weight, and the
+       server with the highest current weight is picked and has the total weight taken off. Returns the indexes of
+       the servers picked, in order; the sequence then repeats. A server of weight 3 is picked three times for
+       every time one of weight 1 is, spread out over the cycle rather than three times in a row."""
+    # The weights are divided by their greatest common divisor (math.gcd is not in Python 3.4), as only their
+    # ratios matter, to keep the cycle short.
+    divisor = 0
+    for weight in weights:
+        while weight:
+            divisor, weight = weight, divisor % weight
+    weights = [weight // divisor for weight in weights] if divisor else weights
+    total = sum(weights)
+    current = [0] * len(weights)
+    sequence = []
+    for _ in range(total):
+        for i, weight in enumerate(weights):
+            current[i] += weight
+        # max() returns the first of equal current weights, so ties go to the server defined first.
+        picked = max(range(len(weights)), key=current.__getitem__)
+        current[picked] -= total
+        sequence.append(picked)
+    return sequence
+
+
+class WeightedScheduler(Scheduler):
+    """Servers are grouped into tiers by 'priority', lowest first. Requests go to the first tier with a server that
+       is not quarantined, and fail over to the rest of that tier, and only then to the later tiers in order. Within
+       a tier the first server to try is picked by smooth weighted round-robin, so each server gets a share of the
+       requests in proportion to its 'weight'. Every possible order is worked out when the scheduler is created, so
+       picking one is a ticket from a shared counter and a lookup, however many servers there are."""
+    def __init__(self, server_list: list, health: dict, options: dict=None, key=None):
+        super().__init__(server_list, health, options, key)
+        priorities = sorted(set(self.option(server, 'priority') for server in server_list))
+
+        # '_tiers' holds the servers of each priority, in the order they are defined, lowest priority first.
+        self._tiers = [[server for server in server_list if self.option(server, 'priority') == priority]
+                       for priority in priorities]
+
+        # '_sequences' holds the smooth weighted round-robin cycle of each tier, as indexes into the tier, and
+        # '_tickets' the counter that steps through it.
+        self._sequences = [smooth_weighted_sequence([self.weight(server) for server in tier])
+                           for tier in self._tiers]
+        self._tickets = [itertools.count() for _ in self._tiers]
+
+        # '_orders[tier][i]' is the order in which servers are tried when the i-th server of the tier is picked: the
+        # rest of the tier after it, wrapping around, then the later tiers, then the earlier tiers, which are only
+        # passed over while they are quarantined.
+        self._orders = []
+        for t, tier in enumerate(self._tiers):
+            rest = [server for later_tier in self._tiers[t + 1:] + self._tiers[:t] for server in later_tier]
+            self._orders.append([tier[i:] + tier[:i] + rest for i in range(len(tier))])
+
+    def order(self, kwargs: dict):
+        if not self._tiers:
+            return self.server_list, 0
+        tier = 0
+        for t, servers in enumerate(self._tiers):
+            if any(self.health[server].available for server in servers):
+                tier = t
+                break
+        sequence = self._sequences[tier]
+        return self._orders[tier][sequence[next(self._tickets[tier]) % len(sequence)]], 0
+
+
+class ConsistentHashScheduler(Scheduler):
+    """Requests are routed by their key, such as the user name, so that the same key goes to the same server every
+       time, which keeps that server's caches warm and avoids surprises from replication lag. Servers are placed on
+       a hash ring at VIRTUAL_NODES points each (times their 'weight'), and a key goes to the first server at or
+       after its own hash, failing over to the next distinct servers round the ring. Adding or removing a server
+       only moves the keys next to its points, about 1/N of them. Requests without a key take a ticket instead, as
+       in round-robin. The hashes are MD5, not hash(), so that every process agrees on where a key goes."""
+    def __init__(self, server_list: list, health: dict, options: dict=None, key=None):
+        super().__init__(server_list, health, options, key)
+        ring = sorted((self.hash(str(server) + '#' + str(i)), server)
+                      for server in server_list for i in range(VIRTUAL_NODES * self.weight(server)))
+        self._points = [point for point, _ in ring]
+        self._ring_servers = [server for _, server in ring]
+        self._tickets = itertools.count()
+
+        # '_orders[i]' is the failover order starting from point i of the ring, worked out the first time it is
+        # needed. Working one out twice at once does no harm, so no lock is needed.
+        self._orders = [None] * len(ring)
+
+    @staticmethod
+    def hash(key: str):
+        """Public method used to hash a key, or a point of a server, onto the ring."""
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def order(self, kwargs: dict):
+        if not self._points:
+            return self.server_list, 0
+        request_key = None if self.key is None else self.key(kwargs)
+        if request_key is None:
+            index = next(self._tickets) % len(self._points)
+        else:
+            index = bisect.bisect_left(self._points, self.hash(str(request_key))) % len(self._points)
+        order = self._orders[index]
+        if order is None:
+            order = []
+            for server in itertools.islice(itertools.cycle(self._ring_servers), index, index + len(self._points)):
+                if server not in order:
+                    order.append(server)
+                    if len(order) == len(self.server_list):
+                        break
+            self._orders[index] = order
+        return order, 0
+
+
+register_scheduler('round-robin', RoundRobinScheduler)
+register_scheduler('random', RandomScheduler)
+register_scheduler('fixed', FixedScheduler)
+register_scheduler('ewma', EwmaScheduler)
+register_scheduler('least-outstanding', LeastOutstandingScheduler)
+register_scheduler('power-of-two', PowerOfTwoScheduler)
+register_scheduler('weighted', WeightedScheduler)
+register_scheduler('consistent-hash', ConsistentHashScheduler)
@@ -0,0 +1,124 @@
+"""
+Health state of redundant servers.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# How much weight the latest latency measurement gets in the exponentially weighted moving average.
+EWMA_WEIGHT = 0.3
+
+# The fewest seconds a failed attempt counts as in the moving average of latency. A server that fails fast, for
+# example because nothing is listening, would otherwise look like the fastest server there is.
+FAILURE_LATENCY = 1.0
+
+
+class ServerHealth(object):
+    """Stores the health of a single server, and implements a circuit breaker for it. The circuit is 'closed' while
+       the server is healthy. After 'failure_threshold' consecutive failures the circuit 'opens' and the server is
+       quarantined for 'recovery_timeout' seconds. Once that has elapsed the circuit is 'half-open', and a single
+       request is allowed through as a probe. A success closes the circuit again, a failure re-opens it. It also
+       keeps track of the server's latency and the number of requests in flight to it, for use by schedulers. It is
+       safe to share between threads: every change happens under a lock, and the fast path of allow_request (a
+       closed circuit) only reads."""
+    __slots__ = ('failure_threshold', 'recovery_timeout', 'consecutive_failures', 'state', 'outstanding',
+                 'latency_ewma', 'draining', '_retry_at', '_clock', '_lock')
+
+    def __init__(self, failure_threshold=3, recovery_timeout=30.0, clock=time.monotonic):
+        # 'failure_threshold' is the number of consecutive failures after which the server is quarantined, or None
+        # to never quarantine the server.
+        self.failure_threshold = failure_threshold
+
+        # 'recovery_timeout' is the number of seconds a quarantined server is skipped before it is probed again.
+        self.recovery_timeout = recovery_timeout
+
+        self.consecutive_failures = 0
+        self.state = CLOSED
+
+        # 'outstanding' is the number of requests to the server currently in flight, and 'latency_ewma' is the
+        # moving average of how long requests took in seconds, or None if none have finished yet.
+        self.outstanding = 0
+        self.latency_ewma = None
+
+        # 'draining' is True once the server has been removed from its client, which makes no new requests to it,
+        # but lets those in flight finish.
+        self.draining = False
+
+        self._retry_at = 0.0
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """Public method used to check whether the server should be tried in the normal schedule. Returns True if
+           the circuit is closed, or if the quarantine has expired and this caller should send the half-open probe.
+           Returns False if the server is quarantined."""
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = self._clock()
+            if now >= self._retry_at:
+                # Only one caller per 'recovery_timeout' gets to probe the server, everybody else keeps skipping it.
+                self.state = HALF_OPEN
+                self._retry_at = now + self.recovery_timeout
+                return True
+            return False
+
+    def record_success(self):
+        """Public method used to record that the server responded to a request in a useful way."""
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = CLOSED
+
+    def record_failure(self):
+        """Public method used to record that a request to the server raised CurrentServerFailed."""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.failure_threshold is None:
+                return
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = OPEN
+                self._retry_at = self._clock() + self.recovery_timeout
+
+    def attempt_started(self):
+        """Public method used to record that a request to the server is in flight."""
+        with self._lock:
+            self.outstanding += 1
+
+    def attempt_finished(self, latency):
+        """Public method used to record that a request to the server finished, successfully or not, after 'latency'
+           seconds. The latency is left out of the moving average if it is None."""
+        with self._lock:
+            self.outstanding -= 1
+            if latency is not None:
+                self._update_latency(latency)
+
+    def record_latency(self, latency: float):
+        """Public method used to record how long the server took to answer something other than a request, such as
+           a health check, in seconds."""
+        with self._lock:
+            self._update_latency(latency)
+
+    def _update_latency(self, latency: float):
+        """More private method used to add a latency measurement to the moving average. The lock must be held."""
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += EWMA_WEIGHT * (latency - self.latency_ewma)
+
+    @property
+    def available(self):
+        """True if allow_request would let a request through: the circuit is closed, or the quarantine has expired.
+           Unlike allow_request, it changes nothing, so schedulers may use it to pick servers."""
+        return self.state == CLOSED or self._clock() >= self._retry_at
+
+    @property
+    def quarantined(self):
+        """True if the circuit for this server is not closed."""
+        return self.state != CLOSED
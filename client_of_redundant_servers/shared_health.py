@@ -0,0 +1,294 @@
+"""
+Health state of redundant servers shared between processes.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+from client_of_redundant_servers.server_health import ServerHealth, CLOSED, OPEN, HALF_OPEN, EWMA_WEIGHT
+from contextlib import contextmanager
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b'CORSHLT2'
+
+# The file starts with a header of the magic number and the number of slots, padded to 64 bytes, followed by the
+# slots. Each slot holds a sequence number, the circuit state, the consecutive failures, when the server may be
+# probed again, the latency moving average (NaN for none yet), when the slot was last written or looked up, and the
+# name of the server it belongs to (empty if the slot is free). Nothing in a slot straddles 8 bytes, and every slot
+# starts on a multiple of 8.
+HEADER = struct.Struct('<8sI52x')
+SEQUENCE = struct.Struct('<I')
+FIELDS = struct.Struct('<B3xI4xdd')
+TOUCHED = struct.Struct('<d')
+NAME_SIZE = 64
+TOUCHED_OFFSET = SEQUENCE.size + FIELDS.size
+NAME_OFFSET = TOUCHED_OFFSET + TOUCHED.size
+SLOT_SIZE = NAME_OFFSET + NAME_SIZE
+EMPTY_NAME = b'\0' * NAME_SIZE
+
+STATE_CODES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+STATES = dict((code, state) for state, code in STATE_CODES.items())
+
+# How many times a reader retries while a slot is being written before it takes what it reads. A writer that was
+# killed half way through leaves the slot looking busy for ever, so readers can't wait for it.
+READ_RETRIES = 100
+
+
+def _encode_name(name: str):
+    """More private function used to get the name of a server as it is kept in its slot."""
+    encoded = name.encode('utf-8')
+    if len(encoded) > NAME_SIZE:
+        encoded = b'sha1:' + hashlib.sha1(encoded).hexdigest().encode('ascii')
+    return encoded.ljust(NAME_SIZE, b'\0')
+
+
+class SharedHealthFile(object):
+    """Holds the health of servers in a file mapped into memory, so that every process that opens the same file (such
+       as the workers of a pre-fork server) shares it. A server that one process finds dead is quarantined for all of
+       them, and only one of them probes it when the quarantine expires. Each server has a fixed-size slot, found by
+       its name, and there is room for 'slots' servers, however many clients use the file. Once they are all taken,
+       the slots of servers that have gone stale are given to new ones. Reads take no locks: a sequence number in
+       each slot, which is odd while it is written, lets readers retry a torn read. Writes lock the slot with fcntl,
+       so this only works on Unix. Pass it to a client as 'shared_health'."""
+    def __init__(self, path: str, slots=256, stale_after=86400.0, clock=time.time):
+        if fcntl is None:
+            raise ImportError("SharedHealthFile needs fcntl, which is only available on Unix")
+        self.path = path
+
+        # 'stale_after' is how many seconds a slot may go without being written or looked up by any process before
+        # it is given to another server, once every slot is taken. Servers are written to whenever requests are made
+        # of them or their health is checked, so only the slots of servers that no process uses any longer go
+        # stale. 'clock' must be the same in every process, so it is the wall clock by default.
+        self.stale_after = stale_after
+        self._clock = clock
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self.slots = self._prepare_file(slots)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._fd, HEADER.size + self.slots * SLOT_SIZE)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+        # '_lock' stops the threads of this process writing at once, which fcntl locks, being per process, don't.
+        self._lock = threading.Lock()
+
+    def _prepare_file(self, slots: int):
+        """More private method used to write the header and empty slots of a new file, or to check the header of an
+           existing one. Returns the number of slots in the file. The file must be locked."""
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            os.ftruncate(self._fd, HEADER.size + slots * SLOT_SIZE)
+            os.write(self._fd, HEADER.pack(MAGIC, slots))
+            return slots
+        header = os.read(self._fd, HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(self.path + " is not a shared health file")
+        magic, slots = HEADER.unpack(header)
+        if magic != MAGIC or size < HEADER.size + slots * SLOT_SIZE:
+            raise ValueError(self.path + " is not a shared health file")
+        return slots
+
+    def health(self, name, failure_threshold=3, recovery_timeout=30.0, clock=time.time):
+        """Public method used to get a SharedServerHealth for the server with the given name, taking a free slot
+           for it if it has none yet. Raises ValueError if every slot is taken, and none has gone stale."""
+        name = str(name)
+        return SharedServerHealth(self, name, self.find_slot(name), failure_threshold, recovery_timeout, clock)
+
+    def find_slot(self, name: str):
+        """Public method used to get the offset of the slot of the named server, taking a free one if it has none
+           yet, or else the one that has been stale the longest. Raises ValueError if every slot is taken, and none
+           has gone stale."""
+        encoded = _encode_name(name)
+        # The header is locked while slots are looked up, so two processes can't both take the same free slot.
+        with self._locked(0, HEADER.size):
+            now = self._clock()
+            free = None
+            stalest = None
+            for slot in range(self.slots):
+                offset = HEADER.size + slot * SLOT_SIZE
+                slot_name = self._map[offset + NAME_OFFSET:offset + SLOT_SIZE]
+                if slot_name == encoded:
+                    TOUCHED.pack_into(self._map, offset + TOUCHED_OFFSET, now)
+                    return offset
+                if slot_name == EMPTY_NAME:
+                    if free is None:
+                        free = offset
+                elif free is None:
+                    touched = TOUCHED.unpack_from(self._map, offset + TOUCHED_OFFSET)[0]
+                    if touched < now - self.stale_after and (stalest is None or touched < stalest[0]):
+                        stalest = (touched, offset)
+            if free is None and stalest is not None:
+                free = stalest[1]
+            if free is None:
+                raise ValueError("Every slot of " + self.path + " is taken")
+            # A stale slot may still be held by a process that has not used it for a long time, so it is locked
+            # while it is given to the new server.
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT_SIZE, free)
+            try:
+                self._map[free + NAME_OFFSET:free + SLOT_SIZE] = encoded
+                self.write(free, STATE_CODES[CLOSED], 0, 0.0, float('nan'))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT_SIZE, free)
+            return free
+
+    def holds(self, offset: int, name: str):
+        """Public method used to check that the slot at the given offset still belongs to the named server, rather
+           than having gone stale and been given to another."""
+        return self._map[offset + NAME_OFFSET:offset + SLOT_SIZE] == _encode_name(name)
+
+    @contextmanager
+    def _locked(self, offset: int, length: int):
+        """More private context manager used to lock part of the file against the other threads and processes."""
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def locked(self, offset: int):
+        """Public method used to lock the slot at the given offset, for a read followed by a write."""
+        return self._locked(offset, SLOT_SIZE)
+
+    def state_code(self, offset: int):
+        """Public method used to read just the state of the slot at the given offset, which is a single byte, so it
+           can't be torn."""
+        return self._map[offset + SEQUENCE.size]
+
+    def read(self, offset: int):
+        """Public method used to read the state, consecutive failures, retry time and latency of the slot at the
+           given offset, without locking it."""
+        for _ in range(READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(self._map, offset)[0]
+            if sequence & 1:
+                continue
+            fields = FIELDS.unpack_from(self._map, offset + SEQUENCE.size)
+            if SEQUENCE.unpack_from(self._map, offset)[0] == sequence:
+                return fields
+        return FIELDS.unpack_from(self._map, offset + SEQUENCE.size)
+
+    def write(self, offset: int, state_code: int, failures: int, retry_at: float, latency: float):
+        """Public method used to write the fields of the slot at the given offset. The slot must be locked."""
+        # The sequence number is odd while the slot is written. It may be odd already if a writer was killed half way
+        # through, in which case it stays as it is.
+        sequence = SEQUENCE.unpack_from(self._map, offset)[0] | 1
+        SEQUENCE.pack_into(self._map, offset, sequence)
+        FIELDS.pack_into(self._map, offset + SEQUENCE.size, state_code, failures, retry_at, latency)
+        TOUCHED.pack_into(self._map, offset + TOUCHED_OFFSET, self._clock())
+        SEQUENCE.pack_into(self._map, offset, (sequence + 1) & 0xffffffff)
+
+    def close(self):
+        """Public method used to unmap and close the file. The health it holds must not be used afterwards."""
+        self._map.close()
+        os.close(self._fd)
+
+
+class SharedServerHealth(ServerHealth):
+    """The health of a single server, as ServerHealth, but kept in a slot of a SharedHealthFile, so that every
+       process using the file sees the same circuit, failures and latency. Only the number of requests in flight is
+       kept per process, as it is what this process's scheduler needs. The clock must be the same in every process,
+       so it is the wall clock by default."""
+    __slots__ = ('_shared', '_name', '_offset')
+
+    def __init__(self, shared: SharedHealthFile, name: str, offset: int, failure_threshold=3, recovery_timeout=30.0,
+                 clock=time.time):
+        # ServerHealth.__init__ is not called, as the state it sets up lives in the slot.
+        self._shared = shared
+        self._name = name
+        self._offset = offset
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.outstanding = 0
+        self.draining = False
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """More private context manager used to lock the server's slot for a read followed by a write. If the slot
+           went stale and was given to another server while this process was not using it, the server is given a
+           slot again first, so its writes never land on another server's."""
+        if not self._shared.holds(self._offset, self._name):
+            self._offset = self._shared.find_slot(self._name)
+        with self._shared.locked(self._offset):
+            yield
+
+    @property
+    def state(self):
+        return STATES[self._shared.state_code(self._offset)]
+
+    @property
+    def consecutive_failures(self):
+        return self._shared.read(self._offset)[1]
+
+    @property
+    def _retry_at(self):
+        return self._shared.read(self._offset)[2]
+
+    @property
+    def latency_ewma(self):
+        latency = self._shared.read(self._offset)[3]
+        # NaN, which is not equal to itself, stands for no latency yet.
+        return None if latency != latency else latency
+
+    def allow_request(self):
+        if self._shared.state_code(self._offset) == STATE_CODES[CLOSED]:
+            return True
+        with self._locked():
+            state_code, failures, retry_at, latency = self._shared.read(self._offset)
+            if state_code == STATE_CODES[CLOSED]:
+                return True
+            now = self._clock()
+            if now >= retry_at:
+                # Only one caller in any process gets to probe the server.
+                self._shared.write(self._offset, STATE_CODES[HALF_OPEN], failures, now + self.recovery_timeout,
+                                   latency)
+                return True
+            return False
+
+    def record_success(self):
+        state_code, failures, _, _ = self._shared.read(self._offset)
+        if state_code == STATE_CODES[CLOSED] and not failures:
+            # Nothing to change, which is the usual case, so don't lock.
+            return
+        with self._locked():
+            _, _, retry_at, latency = self._shared.read(self._offset)
+            self._shared.write(self._offset, STATE_CODES[CLOSED], 0, retry_at, latency)
+
+    def record_failure(self):
+        with self._locked():
+            state_code, failures, retry_at, latency = self._shared.read(self._offset)
+            failures += 1
+            if self.failure_threshold is not None and (state_code == STATE_CODES[HALF_OPEN] or
+                                                       failures >= self.failure_threshold):
+                state_code = STATE_CODES[OPEN]
+                retry_at = self._clock() + self.recovery_timeout
+            self._shared.write(self._offset, state_code, failures, retry_at, latency)
+
+    def attempt_finished(self, latency):
+        with self._lock:
+            self.outstanding -= 1
+        if latency is not None:
+            self.record_latency(latency)
+
+    def record_latency(self, latency: float):
+        with self._locked():
+            state_code, failures, retry_at, latency_ewma = self._shared.read(self._offset)
+            if latency_ewma != latency_ewma:
+                latency_ewma = latency
+            else:
+                latency_ewma += EWMA_WEIGHT * (latency - latency_ewma)
+            self._shared.write(self._offset, state_code, failures, retry_at, latency_ewma)
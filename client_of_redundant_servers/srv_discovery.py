@@ -0,0 +1,230 @@
+"""
+Discovery of redundant servers from DNS SRV records.
+    :copyright: (c) 2018 by Robert Bricheno.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+logger = logging.getLogger(__name__)
+
+
+class ServerDiscoveryFailed(Exception):
+    pass
+
+
+def ad_ldap_srv_name(domain: str):
+    """Public function used to get the name of the SRV records of the domain controllers of an Active Directory
+       domain."""
+    return '_ldap._tcp.dc._msdcs.' + domain
+
+
+def radius_srv_name(domain: str):
+    """Public function used to get the name of the SRV records of the RADIUS servers of a domain."""
+    return '_radius._udp.' + domain
+
+
+class DnspythonResolver(object):
+    """Looks up SRV and address records with dnspython, which must be installed. A dns.resolver.Resolver may be
+       given, for example to use particular name servers. Any other object with the same two methods can be given
+       to SrvServerSource instead, such as a stub for tests."""
+    def __init__(self, resolver=None):
+        if dns is None:
+            raise ImportError("DnspythonResolver needs the dnspython package")
+        self.resolver = dns.resolver.Resolver() if resolver is None else resolver
+
+    def srv(self, name: str):
+        """Public method used to look up the SRV records with the given name. Returns a list of (priority, weight,
+           port, target) tuples, and their TTL in seconds. Raises ServerDiscoveryFailed if the lookup fails."""
+        answer = self._resolve(name, 'SRV')
+        records = [(record.priority, record.weight, record.port, record.target.to_text(omit_final_dot=True))
+                   for record in answer]
+        return records, answer.rrset.ttl
+
+    def addresses(self, name: str):
+        """Public method used to look up the IPv4 and IPv6 addresses of a host. Returns a list of the addresses, IPv4
+           first, and their TTL in seconds. Raises ServerDiscoveryFailed if the lookup fails, or finds neither."""
+        addresses = []
+        ttl = None
+        for rdtype in ('A', 'AAAA'):
+            try:
+                answer = self._resolve(name, rdtype)
+            except ServerDiscoveryFailed:
+                continue
+            addresses.extend(record.address for record in answer)
+            ttl = answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl)
+        if not addresses:
+            raise ServerDiscoveryFailed("No addresses found for " + name)
+        return addresses, ttl
+
+    def _resolve(self, name: str, rdtype: str):
+        """More private method used to look up the records of the given type and name."""
+        # dnspython 2 renamed query() to resolve().
+        resolve = getattr(self.resolver, 'resolve', None) or self.resolver.query
+        try:
+            return resolve(name, rdtype)
+        except dns.exception.DNSException as e:
+            raise ServerDiscoveryFailed("Looking up " + rdtype + " records of " + name + " failed: " + str(e))
+
+
+class SrvServerSource(object):
+    """Builds a server_dict from the DNS SRV records with the given name, such as ad_ldap_srv_name('example.com'),
+       so that the servers of a client need not be listed by hand. Each server gets its SRV 'priority' and 'weight',
+       which the 'weighted' schedule uses, and the 'address' it resolves to, so that requests never wait for name
+       resolution. The SRV records and addresses are cached for as long as their TTLs allow, and looked up again
+       after that. If a lookup fails, the records found last are kept (and retried after 'min_ttl' seconds), as
+       losing every server because DNS was briefly unavailable would be worse than using old records. start() keeps
+       a client up to date with the records in a background thread."""
+    def __init__(self, srv_name: str, make_config, resolver=None, min_ttl=5, max_ttl=3600, resolve_addresses=True,
+                 clock=time.monotonic):
+        self.srv_name = srv_name
+
+        # 'make_config' is a function which takes the port from an SRV record and returns the rest of the server's
+        # entry in server_dict, for example lambda port: {'port': port, 'ssl': True, 'validate': True}.
+        self.make_config = make_config
+
+        # 'resolver' looks up the records. If it is None, a DnspythonResolver is used.
+        self.resolver = DnspythonResolver() if resolver is None else resolver
+
+        # 'min_ttl' and 'max_ttl' bound how many seconds records are cached, whatever their TTL.
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+
+        # 'resolve_addresses' turns on looking up the address of each server. If it is False, the clients resolve
+        # the names of servers themselves.
+        self.resolve_addresses = resolve_addresses
+
+        self._clock = clock
+        # '_srv' is a tuple of the SRV records found last and when they expire, or None. '_addresses' maps each
+        # target to a tuple of its address and when that expires.
+        self._srv = None
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+        # '_watch' is the Event which stops the thread started by start(), if it is running.
+        self._watch = None
+
+    def server_dict(self):
+        """Public method used to get a server_dict of the servers named by the SRV records, lowest priority and then
+           highest weight first, looking up whatever has expired. Raises ServerDiscoveryFailed if the SRV records
+           have never been found."""
+        with self._lock:
+            now = self._clock()
+            records = self._srv_records(now)
+            server_dict = OrderedDict()
+            # Sort by priority, then by weight, heaviest first, then by name so that the order is stable.
+            for priority, weight, port, target in sorted(records, key=lambda r: (r[0], -r[1], r[3])):
+                if target in server_dict or target in ('', '.'):
+                    # A target of '.' means the service is not available at this domain (RFC 2782).
+                    continue
+                config = dict(self.make_config(port))
+                config['priority'] = priority
+                # A weight of 0 means 'hardly ever' in SRV, but the 'weighted' schedule needs a positive weight.
+                config['weight'] = max(weight, 1)
+                if self.resolve_addresses:
+                    address = self._address(target, now)
+                    if address is not None:
+                        config['address'] = address
+                server_dict[target] = config
+            return server_dict
+
+    def expires(self):
+        """Public method used to get when the soonest expiry of the cached records is, in the time of the clock,
+           or None if nothing has been looked up yet."""
+        with self._lock:
+            if self._srv is None:
+                return None
+            return min([self._srv[1]] + [expires for _, expires in self._addresses.values()])
+
+    def _srv_records(self, now: float):
+        """More private method used to get the SRV records, looking them up again if they have expired. The lock
+           must be held."""
+        if self._srv is not None and now < self._srv[1]:
+            return self._srv[0]
+        try:
+            records, ttl = self.resolver.srv(self.srv_name)
+        except ServerDiscoveryFailed:
+            if self._srv is None:
+                raise
+            logger.warning("Looking up SRV records %s failed, so the old ones are used.", self.srv_name)
+            self._srv = (self._srv[0], now + self.min_ttl)
+            return self._srv[0]
+        self._srv = (records, now + self._bounded(ttl))
+        # Forget the addresses of servers that have gone.
+        targets = set(record[3] for record in records)
+        for target in list(self._addresses):
+            if target not in targets:
+                del self._addresses[target]
+        return records
+
+    def _address(self, target: str, now: float):
+        """More private method used to get the address of a server, looking it up again if it has expired. Returns
+           None if it has never been found, so that the client resolves the name itself. The lock must be held."""
+        cached = self._addresses.get(target)
+        if cached is not None and now < cached[1]:
+            return cached[0]
+        try:
+            addresses, ttl = self.resolver.addresses(target)
+        except ServerDiscoveryFailed:
+            logger.warning("Looking up the address of %s failed.", target)
+            if cached is None:
+                return None
+            self._addresses[target] = (cached[0], now + self.min_ttl)
+            return cached[0]
+        # Keep the address the server had if it still has it, so that its connections are kept.
+        address = cached[0] if cached is not None and cached[0] in addresses else addresses[0]
+        self._addresses[target] = (address, now + self._bounded(ttl))
+        return address
+
+    def _bounded(self, ttl):
+        """More private method used to keep a TTL between 'min_ttl' and 'max_ttl'."""
+        return min(max(ttl, self.min_ttl), self.max_ttl)
+
+    def refresh(self, client):
+        """Public method used to give the client the servers named by the SRV records, if they are not the servers
+           it has already. Returns True if the servers of the client were changed."""
+        server_dict = self.server_dict()
+        if server_dict == client.server_dict:
+            return False
+        client.update_servers(server_dict)
+        return True
+
+    def start(self, client):
+        """Public method used to keep the servers of the client up to date with the SRV records in a daemon thread,
+           which looks them up again as soon as the first of them expires, until stop() is called. The client
+           should be one created with the server_dict of this source. It suits thread-based clients; an asyncio
+           client should call refresh() from a task of its own, in an executor."""
+        if self._watch is not None:
+            raise RuntimeError("The SRV records are already being watched")
+        stopped = self._watch = threading.Event()
+        watcher = threading.Thread(target=self._watch_loop, args=(client, stopped), name='SrvWatcher')
+        watcher.daemon = True
+        watcher.start()
+
+    def stop(self):
+        """Public method used to stop keeping a client up to date, if it is being kept up to date."""
+        if self._watch is not None:
+            self._watch.set()
+            self._watch = None
+
+    def _watch_loop(self, client, stopped):
+        """More private method, run by the watching thread, used to refresh the client whenever records expire."""
+        while True:
+            expires = self.expires()
+            wait = self.min_ttl if expires is None else max(expires - self._clock(), 0)
+            if stopped.wait(wait):
+                return
+            try:
+                self.refresh(client)
+            except Exception:
+                logger.exception("Refreshing servers from SRV records %s failed.", self.srv_name)
+                if stopped.wait(self.min_ttl):
+                    return
@@ -1,6 +1,10 @@
 from client_of_redundant_servers.client_of_redundant_ad_ldap_servers import ClientOfRedundantAdLdapServers
 from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
 from collections import OrderedDict
+import logging
+
+# The library leaves configuring logging to the application.
+logging.basicConfig(level=logging.INFO)
 
 LDAP_SERVERS = OrderedDict()
 LDAP_SERVERS['srvr-dc1.myad.private.example.com'] = {'port': 636,
@@ -1,6 +1,10 @@
 from client_of_redundant_servers.client_of_redundant_radius_servers import ClientOfRedundantRadiusServers
 from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
 from collections import OrderedDict
+import logging
+
+# The library leaves configuring logging to the application.
+logging.basicConfig(level=logging.INFO)
 
 CLIENT_BIND_IP = "10.0.0.2"
 NAS_IDENTIFIER = "CoolRADIUSClient"
@@ -0,0 +1,58 @@
+import asyncio
+import mock
+import unittest
+import logging
+from client_of_redundant_servers.async_client_of_redundant_ad_ldap_servers import AsyncClientOfRedundantAdLdapServers
+from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import ldap3.core.exceptions
+
+logging.disable(logging.CRITICAL)
+
+
+class TestAsyncClientOfRedundantAdLdapServers(unittest.TestCase):
+    """Tests for `async_client_of_redundant_ad_ldap_servers.py`."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.fake_server_dict = OrderedDict()
+        self.fake_server_dict['srvr-dc1.myad.private.example.com'] = {'port': 636,
+                                                                      'ssl': False,
+                                                                      'validate': False}
+        self.fake_server_dict['srvr-dc2.myad.private.example.com'] = {'port': 636,
+                                                                      'ssl': False,
+                                                                      'validate': False}
+
+    def test_client_ldap_auth_no_servers(self):
+        a_client = AsyncClientOfRedundantAdLdapServers(OrderedDict(), "test")
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete,
+                          a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_some_servers(self, mock_ldap3):
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        a_client = AsyncClientOfRedundantAdLdapServers(self.fake_server_dict, "test", executor=executor)
+        result = self.loop.run_until_complete(a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        mocked_server = mock_ldap3.Server.return_value
+        mock_ldap3.Connection.assert_called_with(mocked_server, 'test', '1234')
+        mock_ldap3.Connection.return_value.bind.assert_called_with()
+        self.assertEqual(True, result)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_ldap_exception(self, mock_ldap3):
+        # Explicitly un-mock the exceptions we are testing
+        mock_ldap3.Connection.side_effect = ldap3.core.exceptions.LDAPException()
+        mock_ldap3.core.exceptions.LDAPException = ldap3.core.exceptions.LDAPException
+        mock_ldap3.core.exceptions.LDAPBindError = ldap3.core.exceptions.LDAPBindError
+        mock_ldap3.core.exceptions.LDAPResponseTimeoutError = ldap3.core.exceptions.LDAPResponseTimeoutError
+        a_client = AsyncClientOfRedundantAdLdapServers(self.fake_server_dict, "test")
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete,
+                          a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        self.assertEqual(2, mock_ldap3.Connection.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import unittest
+import logging
+from client_of_redundant_servers.async_client_of_redundant_radius_servers import AsyncClientOfRedundantRadiusServers
+from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
+from collections import OrderedDict
+import pyrad.packet
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeRadiusServer(asyncio.DatagramProtocol):
+    """Accepts the user 'test' with password '1234', and rejects everybody else. Answers Status-Server."""
+    def __init__(self, secret, dictionary):
+        self.secret = secret
+        self.dictionary = dictionary
+        self.transport = None
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        request = pyrad.packet.AuthPacket(packet=data, secret=self.secret, dict=self.dictionary)
+        reply = request.CreateReply()
+        if request.code == pyrad.packet.StatusServer:
+            # Status-Server must be signed, and is answered with an Access-Accept (RFC 5997)
+            if not request.verify_message_authenticator():
+                return
+            reply.code = pyrad.packet.AccessAccept
+        elif request['User-Name'][0] == 'test' and request.PwDecrypt(request[2][0]) == '1234':
+            reply.code = pyrad.packet.AccessAccept
+        else:
+            reply.code = pyrad.packet.AccessReject
+        self.transport.sendto(reply.ReplyPacket(), addr)
+
+
+class TestAsyncClientOfRedundantRadiusServers(unittest.TestCase):
+    """Tests for `async_client_of_redundant_radius_servers.py`."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def start_server(self, secret, dictionary):
+        transport, protocol = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: FakeRadiusServer(secret, dictionary), local_addr=('127.0.0.1', 0)))
+        self.addCleanup(transport.close)
+        return protocol, transport.get_extra_info('sockname')[1]
+
+    def test_client_radius_auth_accept_and_reject(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        fake_server, port = self.start_server(b'xxxx', a_client.dictionary)
+        server_dict = OrderedDict([('127.0.0.1', {'auth_port': port, 'secret': b'xxxx'})])
+        a_client = AsyncClientOfRedundantRadiusServers(server_dict, "test")
+        self.assertEqual(True, self.loop.run_until_complete(a_client.radius_auth("test", "1234")))
+        self.assertEqual(False, self.loop.run_until_complete(a_client.radius_auth("test", "4321")))
+        # Both requests share one socket
+        self.assertEqual(1, len(a_client._protocols))
+        a_client.close()
+
+    def test_client_radius_auth_concurrent(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        fake_server, port = self.start_server(b'xxxx', a_client.dictionary)
+        server_dict = OrderedDict([('127.0.0.1', {'auth_port': port, 'secret': b'xxxx'})])
+        a_client = AsyncClientOfRedundantRadiusServers(server_dict, "test", server_timeout=0.5)
+
+        async def many():
+            return await asyncio.gather(*[a_client.radius_auth("test", "1234" if i % 2 else "bad")
+                                          for i in range(600)])
+
+        results = self.loop.run_until_complete(many())
+        self.assertEqual([bool(i % 2) for i in range(600)], results)
+        # Some packets may have been dropped by the kernel and retransmitted
+        self.assertLessEqual(600, fake_server.received)
+        a_client.close()
+
+    def test_client_radius_auth_wrong_secret_times_out(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        _, port = self.start_server(b'yyyy', a_client.dictionary)
+        server_dict = OrderedDict([('127.0.0.1', {'auth_port': port, 'secret': b'xxxx'})])
+        a_client = AsyncClientOfRedundantRadiusServers(server_dict, "test", server_timeout=0.05)
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete, a_client.radius_auth("test", "1234"))
+        a_client.close()
+
+    def test_client_radius_auth_no_servers(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete, a_client.radius_auth("test", "1234"))
+
+    def test_client_radius_auth_many(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        fake_server, port = self.start_server(b'xxxx', a_client.dictionary)
+        server_dict = OrderedDict([('127.0.0.1', {'auth_port': port, 'secret': b'xxxx'})])
+        a_client = AsyncClientOfRedundantRadiusServers(server_dict, "test")
+        credentials = [("test", "1234" if i % 2 else "bad") for i in range(50)]
+
+        async def collect():
+            return [await next_result for next_result in a_client.radius_auth_many(credentials, concurrency=5)]
+
+        self.assertEqual([bool(i % 2) for i in range(50)], self.loop.run_until_complete(collect()))
+        a_client.close()
+
+    def test_client_radius_auth_adaptive_timeout(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        fake_server, port = self.start_server(b'xxxx', a_client.dictionary)
+        server_dict = OrderedDict([('127.0.0.1', {'auth_port': port, 'secret': b'xxxx'})])
+        a_client = AsyncClientOfRedundantRadiusServers(server_dict, "test", adaptive_timeout=True)
+        for _ in range(5):
+            self.assertEqual(True, self.loop.run_until_complete(a_client.radius_auth("test", "1234")))
+        rtt_estimator = a_client._rtt_estimators[a_client.server_list[0]]
+        self.assertIsNotNone(rtt_estimator.srtt)
+        self.assertLess(rtt_estimator.rto, 1)
+        a_client.close()
+
+    def test_health_check(self):
+        a_client = AsyncClientOfRedundantRadiusServers(OrderedDict(), "test")
+        fake_server, port = self.start_server(b'xxxx', a_client.dictionary)
+        server_dict = OrderedDict([('127.0.0.1', {'auth_port': port, 'secret': b'xxxx'}),
+                                   ('127.0.0.2', {'auth_port': port, 'secret': b'xxxx'})])
+        a_client = AsyncClientOfRedundantRadiusServers(server_dict, "test", server_timeout=0.02)
+        self.loop.run_until_complete(a_client.check_health())
+        self.assertEqual(0, a_client.server_health('127.0.0.1').consecutive_failures)
+        self.assertIsNotNone(a_client.server_health('127.0.0.1').latency_ewma)
+        # Nothing is listening on the second address
+        self.assertEqual(1, a_client.server_health('127.0.0.2').consecutive_failures)
+        a_client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,312 @@
+import asyncio
+import unittest
+import logging
+import os
+import tempfile
+import time
+
+from client_of_redundant_servers.async_client_of_redundant_servers import AsyncClientOfRedundantServers
+from client_of_redundant_servers.client_of_redundant_servers import CurrentServerFailed, AllAvailableServersFailed
+from collections import OrderedDict
+
+
+logging.disable(logging.CRITICAL)
+
+
+class TestAsyncClientOfRedundantServers(unittest.TestCase):
+    """Tests for `async_client_of_redundant_servers.py`."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.calls = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def fake_server_func(self, server, bad_servers=()):
+        self.calls.append(server)
+        await asyncio.sleep(0)
+        if server in bad_servers:
+            raise CurrentServerFailed
+        return server
+
+    def test_servers_used_rr(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]))
+        results = [self.loop.run_until_complete(a_client.request(self.fake_server_func)) for _ in range(4)]
+        self.assertEqual(['a', 'b', 'c', 'a'], results)
+        self.assertEqual(1, a_client._rr_position)
+
+    def test_failover(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]),
+                                                 schedule='fixed')
+        result = self.loop.run_until_complete(a_client.request(self.fake_server_func, bad_servers=('a', 'b')))
+        self.assertEqual('c', result)
+        self.assertEqual(['a', 'b', 'c'], self.calls)
+
+    def test_all_servers_fail(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]))
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete,
+                          a_client.request(self.fake_server_func, bad_servers=('a', 'b')))
+
+    def test_failing_server_is_quarantined(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed',
+                                                 failure_threshold=1)
+        self.loop.run_until_complete(a_client.request(self.fake_server_func, bad_servers=('a',)))
+        self.calls = []
+        result = self.loop.run_until_complete(a_client.request(self.fake_server_func, bad_servers=('a',)))
+        self.assertEqual('b', result)
+        self.assertEqual(['b'], self.calls)
+
+    def test_concurrent_requests(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]))
+
+        async def many():
+            return await asyncio.gather(*[a_client.request(self.fake_server_func) for _ in range(100)])
+
+        results = self.loop.run_until_complete(many())
+        self.assertEqual(50, results.count('a'))
+        self.assertEqual(50, results.count('b'))
+
+    def test_hedged_request_uses_faster_server(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed',
+                                                 hedge_delay=0.01)
+        cancelled = []
+
+        async def slow_first_func(server):
+            self.calls.append(server)
+            if server == 'a':
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(server)
+                    raise
+            return server
+
+        self.assertEqual('b', self.loop.run_until_complete(a_client.request(slow_first_func)))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(['a', 'b'], self.calls)
+        # The slow request is cancelled once the fast one answers
+        self.assertEqual(['a'], cancelled)
+
+    def test_hedged_request_fails_over(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed',
+                                                 hedge_delay=1)
+        result = self.loop.run_until_complete(a_client.request(self.fake_server_func, bad_servers=('a',)))
+        self.assertEqual('b', result)
+        self.assertEqual(['a', 'b'], self.calls)
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete,
+                          a_client.request(self.fake_server_func, bad_servers=('a', 'b')))
+
+    def test_identical_requests_are_coalesced(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), coalesce=True)
+
+        async def many():
+            return await asyncio.gather(*[a_client.request(self.fake_server_func, bad_servers=bad)
+                                          for bad in [(), (), (), ('a',)]])
+
+        self.assertEqual(['a', 'a', 'a', 'b'], self.loop.run_until_complete(many()))
+        self.assertEqual(['a', 'b'], self.calls)
+        self.assertEqual({}, a_client._flights)
+
+    def test_coalesced_requests_share_exceptions(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None)]), coalesce=True)
+
+        async def many():
+            return await asyncio.gather(*[a_client.request(self.fake_server_func, bad_servers=('a',))
+                                          for _ in range(3)], return_exceptions=True)
+
+        results = self.loop.run_until_complete(many())
+        self.assertEqual([AllAvailableServersFailed] * 3, [type(result) for result in results])
+        self.assertEqual(['a'], self.calls)
+
+    def test_cancelled_caller_does_not_cancel_coalesced_request(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None)]), coalesce=True)
+
+        async def cancel_first():
+            first = asyncio.ensure_future(a_client.request(self.fake_server_func))
+            second = asyncio.ensure_future(a_client.request(self.fake_server_func))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual('a', self.loop.run_until_complete(cancel_first()))
+        self.assertEqual(['a'], self.calls)
+
+    def test_request_many(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed')
+
+        async def collect():
+            results = []
+            for next_result in a_client.request_many(self.fake_server_func,
+                                                     [{}, {'bad_servers': ('a',)}, {'bad_servers': ('a', 'b')}],
+                                                     concurrency=2):
+                results.append(await next_result)
+            return results
+
+        results = self.loop.run_until_complete(collect())
+        self.assertEqual(['a', 'b'], results[:2])
+        self.assertIsInstance(results[2], AllAvailableServersFailed)
+
+    def test_request_many_is_bounded(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None)]))
+        in_flight = []
+        most_in_flight = []
+
+        async def counting_func(server, value):
+            in_flight.append(value)
+            most_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.001)
+            in_flight.remove(value)
+            return value
+
+        async def collect():
+            return [await next_result for next_result in
+                    a_client.request_many(counting_func, ({'value': i} for i in range(20)), concurrency=4)]
+
+        self.assertEqual(list(range(20)), self.loop.run_until_complete(collect()))
+        self.assertEqual(4, max(most_in_flight))
+
+    def test_request_timeout_stops_slow_server(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed',
+                                                 request_timeout=0.2)
+        budgets = []
+
+        async def slow_first_func(server, time_budget):
+            budgets.append(time_budget)
+            if server == 'a':
+                await asyncio.sleep(5)
+            return server
+
+        self.assertEqual('b', self.loop.run_until_complete(a_client.request(slow_first_func)))
+        self.assertAlmostEqual(0.1, budgets[0], places=1)
+        self.assertAlmostEqual(0.1, budgets[1], places=1)
+        self.assertEqual(1, a_client.server_health('a').consecutive_failures)
+
+    def test_hedged_request_timeout(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), hedge_delay=0.01,
+                                                 request_timeout=0.05)
+
+        async def stuck_func(server, time_budget):
+            await asyncio.sleep(5)
+
+        started = time.monotonic()
+        self.assertRaises(AllAvailableServersFailed, self.loop.run_until_complete, a_client.request(stuck_func))
+        self.assertLess(time.monotonic() - started, 1)
+
+
+    def test_background_health_checks(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), failure_threshold=1)
+        checks = []
+
+        async def check_func(server):
+            checks.append(server)
+            await asyncio.sleep(0)
+            if server == 'b':
+                raise CurrentServerFailed
+            return True
+
+        async def check_twice():
+            task = a_client.start_health_checks(interval=0.01, check_func=check_func)
+            self.assertRaises(RuntimeError, a_client.start_health_checks, check_func=check_func)
+            while len(checks) < 4:
+                await asyncio.sleep(0.01)
+            a_client.close()
+            await asyncio.sleep(0)
+            return task
+
+        task = self.loop.run_until_complete(check_twice())
+        self.assertTrue(task.cancelled())
+        self.assertFalse(a_client.server_health('a').quarantined)
+        self.assertTrue(a_client.server_health('b').quarantined)
+
+    def test_check_health_needs_a_check(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None)]))
+        self.assertRaises(NotImplementedError, a_client.start_health_checks)
+
+    def test_update_servers_drains_after_request(self):
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed')
+
+        async def slow_func(server):
+            await asyncio.sleep(0.02)
+            return server
+
+        async def update_during_request():
+            task = asyncio.ensure_future(a_client.request(slow_func))
+            await asyncio.sleep(0)
+            a_client.update_servers(OrderedDict([('b', None)]))
+            self.assertTrue(a_client.server_health('a').draining)
+            self.assertEqual('b', await a_client.request(slow_func))
+            return await task
+
+        self.assertEqual('a', self.loop.run_until_complete(update_during_request()))
+        self.assertNotIn('a', a_client._draining)
+
+    def test_check_health_counts_as_in_flight(self):
+        drained = []
+
+        class DrainingClient(AsyncClientOfRedundantServers):
+            def _server_drained(self, server):
+                drained.append(server)
+
+        a_client = DrainingClient(OrderedDict([('a', None), ('b', None)]))
+
+        checking = asyncio.Event()
+
+        async def check_func(server):
+            checking.set()
+            await asyncio.sleep(0.01)
+            return True
+
+        async def update_during_check():
+            task = asyncio.ensure_future(a_client.check_health(check_func))
+            await checking.wait()
+            a_client.update_servers(OrderedDict([('b', None)]))
+            self.assertEqual(1, a_client.server_health('a').outstanding)
+            self.assertEqual([], drained)
+            await task
+
+        self.loop.run_until_complete(update_during_check())
+        self.assertEqual(['a'], drained)
+        self.assertEqual(0, a_client.server_health('a').outstanding)
+
+    def test_update_servers_between_failover_and_attempt(self):
+        class RacingClient(AsyncClientOfRedundantServers):
+            def _failover_order(self, server_list, start):
+                for server in super()._failover_order(server_list, start):
+                    if server == 'a':
+                        # Remove 'a' after it has been checked, but before the attempt of it starts.
+                        self.update_servers(OrderedDict([('b', None)]))
+                    yield server
+
+        async def func(server):
+            return server
+
+        for kwargs in ({}, {'hedge_delay': 1.0}):
+            a_client = RacingClient(OrderedDict([('a', None), ('b', None)]), schedule='fixed', **kwargs)
+            self.assertEqual('b', self.loop.run_until_complete(a_client.request(func)))
+            self.assertEqual(0, a_client.server_health('a').outstanding)
+            self.assertNotIn('a', a_client._draining)
+
+    def test_watch_server_file(self):
+        server_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.addCleanup(os.unlink, server_file.name)
+        server_file.write('{"a": null}')
+        server_file.close()
+        a_client = AsyncClientOfRedundantServers(OrderedDict([('a', None)]))
+
+        async def watch():
+            task = a_client.start_watching_server_file(server_file.name, interval=0.01)
+            with open(server_file.name, 'w') as new_server_file:
+                new_server_file.write('{"b": null}')
+            os.utime(server_file.name, ns=(0, 0))
+            while a_client.server_list != ['b']:
+                await asyncio.sleep(0.01)
+            a_client.close()
+            await asyncio.sleep(0)
+            return task
+
+        task = self.loop.run_until_complete(asyncio.wait_for(watch(), 5))
+        self.assertTrue(task.cancelled())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
 import mock
 import unittest
 import logging
-from client_of_redundant_servers.client_of_redundant_ad_ldap_servers import ClientOfRedundantAdLdapServers
+from client_of_redundant_servers.client_of_redundant_ad_ldap_servers import ClientOfRedundantAdLdapServers,\
+                                                                            LdapConnectionPool
 from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
+from client_of_redundant_servers.metrics import InMemoryMetrics
+from benchmarks.standins import StandInLdapServer, RIGHT_PASSWORD
 from collections import OrderedDict
 import ldap3.core.exceptions
+import socket
+import time
 
 logging.disable(logging.CRITICAL)
 
@@ -61,10 +66,14 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         result = a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
         mocked_tls = mock_tls.return_value
         hostname = list(self.fake_server_dict.keys())[0]
-        mock_ldap3.Server.assert_called_with(hostname,
-                                             port=self.fake_server_dict[hostname]['port'],
-                                             use_ssl=self.fake_server_dict[hostname]['ssl'],
-                                             tls=mocked_tls)
+        # ldap3 Servers are built once per server, when the client is created
+        self.assertEqual(2, mock_ldap3.Server.call_count)
+        self.assertEqual(2, mock_tls.call_count)
+        self.assertEqual(mock.call(hostname,
+                                   port=self.fake_server_dict[hostname]['port'],
+                                   use_ssl=self.fake_server_dict[hostname]['ssl'],
+                                   tls=mocked_tls),
+                         mock_ldap3.Server.call_args_list[0])
         self.assertEqual(True, result)
 
     @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
@@ -72,9 +81,10 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         a_client = ClientOfRedundantAdLdapServers(self.no_validate_dict, "test")
         result = a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
         hostname = list(self.no_validate_dict.keys())[0]
-        mock_ldap3.Server.assert_called_with(hostname,
-                                             port=self.no_validate_dict[hostname]['port'],
-                                             use_ssl=self.no_validate_dict[hostname]['ssl'])
+        self.assertEqual(mock.call(hostname,
+                                   port=self.no_validate_dict[hostname]['port'],
+                                   use_ssl=self.no_validate_dict[hostname]['ssl']),
+                         mock_ldap3.Server.call_args_list[0])
         self.assertEqual(True, result)
 
     @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
@@ -82,23 +92,97 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test")
         result = a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
         hostname = list(self.no_ssl_dict.keys())[0]
-        mock_ldap3.Server.assert_called_with(hostname,
-                                             port=self.no_ssl_dict[hostname]['port'])
+        self.assertEqual(mock.call(hostname,
+                                   port=self.no_ssl_dict[hostname]['port']),
+                         mock_ldap3.Server.call_args_list[0])
         self.assertEqual(True, result)
 
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_timeouts(self, mock_ldap3):
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", connect_timeout=2, receive_timeout=5)
+        self.assertEqual(True, a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        hostname = list(self.no_ssl_dict.keys())[0]
+        self.assertEqual(mock.call(hostname, port=self.no_ssl_dict[hostname]['port'], connect_timeout=2),
+                         mock_ldap3.Server.call_args_list[0])
+        mock_ldap3.Connection.assert_called_with(mock_ldap3.Server.return_value, 'test', '1234')
+        mock_ldap3.Connection.return_value.socket.settimeout.assert_called_with(5)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_request_timeout(self, mock_ldap3):
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", connect_timeout=5, receive_timeout=5,
+                                                  request_timeout=2)
+        for _ in range(2):
+            a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
+        # The shared ldap3 Servers are kept, rather than new ones being built for each attempt
+        self.assertEqual(2, mock_ldap3.Server.call_count)
+        self.assertEqual(5, mock_ldap3.Server.call_args[1]['connect_timeout'])
+        # There are two servers, so the first may take half the request timeout, to connect and for every reply
+        connection_server = mock_ldap3.Connection.call_args[0][0]
+        self.assertIs(mock_ldap3.Server.return_value, connection_server._ldap_server)
+        self.assertAlmostEqual(1, connection_server.connect_timeout, delta=0.05)
+        self.assertAlmostEqual(1, mock_ldap3.Connection.return_value.socket.settimeout.call_args[0][0], delta=0.05)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_short_connect_timeout_is_kept(self, mock_ldap3):
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", connect_timeout=0.1, request_timeout=2)
+        a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
+        # The configured connect timeout is shorter than the budget, so the shared ldap3 Server is used as it is
+        self.assertEqual(2, mock_ldap3.Server.call_count)
+        self.assertIs(mock_ldap3.Server.return_value, mock_ldap3.Connection.call_args[0][0])
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_sub_second_timeouts(self, mock_ldap3):
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", receive_timeout=2.5, request_timeout=0.2)
+        a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
+        # The budget is not rounded up to whole seconds, as ldap3's own receive_timeout would need
+        self.assertNotIn('receive_timeout', mock_ldap3.Connection.call_args[1])
+        self.assertAlmostEqual(0.1, mock_ldap3.Connection.return_value.socket.settimeout.call_args[0][0], delta=0.05)
+        self.assertNotIn('connect_timeout', mock_ldap3.Server.call_args[1])
+        self.assertAlmostEqual(0.1, mock_ldap3.Connection.call_args[0][0].connect_timeout, delta=0.05)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_pooled_connections_get_receive_timeout(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", schedule='fixed', pool_size=2,
+                                                  receive_timeout=5, request_timeout=4)
+        auth_pool, _ = a_client._get_pools(a_client.server_list[0])
+        self.assertEqual(5, auth_pool.receive_timeout)
+        for _ in range(2):
+            a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
+            # The connection is reused, but still waits no longer than the budget of each attempt
+            self.assertAlmostEqual(2, mock_conn.socket.settimeout.call_args[0][0], places=2)
+        self.assertEqual(1, mock_conn.open.call_count)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_socket_timeout(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        # ldap3 raises socket errors as classes derived from both its own exception and the socket error
+        receive_timeout_error = type('LDAPSocketReceiveError',
+                                     (ldap3.core.exceptions.LDAPSocketReceiveError, socket.timeout), {})
+        mock_ldap3.Connection.return_value.search.side_effect = receive_timeout_error('timed out')
+        recorder = InMemoryMetrics()
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", metrics=recorder)
+        self.assertRaises(AllAvailableServersFailed, a_client.ldap_auth, ldap_uid="test", ldap_pass="1234")
+        for server in a_client.server_list:
+            self.assertEqual(1, recorder.servers[server.name].timeouts)
+        # The connections are closed even though the search failed
+        self.assertEqual(2, mock_ldap3.Connection.return_value.unbind.call_count)
+
     @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
     def test_client_ldap_auth_some_servers_with_ad_domain(self, mock_ldap3):
         a_client = ClientOfRedundantAdLdapServers(self.fake_server_dict, "test", ad_domain="testdomain")
         result = a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
         mocked_server = mock_ldap3.Server.return_value
-        mock_ldap3.Connection.assert_called_with(mocked_server, 'test@testdomain', '1234', auto_bind=True)
+        mock_ldap3.Connection.assert_called_with(mocked_server, 'test@testdomain', '1234')
+        mock_ldap3.Connection.return_value.bind.assert_called_with()
         self.assertEqual(True, result)
 
     @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
     def test_client_ldap_auth_failing_servers(self, mock_ldap3):
         a_client = ClientOfRedundantAdLdapServers(self.fake_server_dict, "test")
-        # This '__enter__' is how we mock the 'with ldap3.Connection...' context manager
-        mock_ldap3.Connection.return_value.__enter__.return_value.entries = []
+        mock_ldap3.Connection.return_value.entries = []
         result = a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
         self.assertEqual(False, result)
 
@@ -107,10 +191,20 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         # Explicitly un-mock the exception we are testing
         mock_ldap3.Connection.side_effect = ldap3.core.exceptions.LDAPBindError()
         mock_ldap3.core.exceptions.LDAPBindError = ldap3.core.exceptions.LDAPBindError
+        mock_ldap3.core.exceptions.LDAPResponseTimeoutError = ldap3.core.exceptions.LDAPResponseTimeoutError
         a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test")
         result = a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
         self.assertEqual(False, result)
 
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_bind_refused(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_ldap3.Connection.return_value.bind.return_value = False
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test")
+        self.assertEqual(False, a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        self.assertEqual(False, mock_ldap3.Connection.return_value.search.called)
+        mock_ldap3.Connection.return_value.unbind.assert_called_with()
+
     @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
     def test_client_ldap_auth_ldap_exception(self, mock_ldap3):
         # Explicitly un-mock the exception we are testing
@@ -118,10 +212,288 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         mock_ldap3.core.exceptions.LDAPException = ldap3.core.exceptions.LDAPException
         # Also un-mock the previous exception, as we check for it when handling LDAPException
         mock_ldap3.core.exceptions.LDAPBindError = ldap3.core.exceptions.LDAPBindError
+        mock_ldap3.core.exceptions.LDAPResponseTimeoutError = ldap3.core.exceptions.LDAPResponseTimeoutError
 
         a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test")
         self.assertRaises(AllAvailableServersFailed, a_client.ldap_auth, ldap_uid="test", ldap_pass="1234")
 
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_empty_password_keeps_server_healthy(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_ldap3.Connection.return_value.bind.side_effect = ldap3.core.exceptions.LDAPPasswordIsMandatoryError()
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", schedule='fixed', failure_threshold=1)
+        for _ in range(3):
+            self.assertEqual(False, a_client.ldap_auth(ldap_uid="test", ldap_pass=""))
+        # Only the first server was asked, and its circuit breaker is still closed.
+        self.assertEqual(3, mock_ldap3.Connection.call_count)
+        for server in a_client.server_list:
+            self.assertEqual(0, a_client.server_health(server).consecutive_failures)
+            self.assertFalse(a_client.server_health(server).quarantined)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_pooled_ldap_auth_empty_password_keeps_server_healthy(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        mock_conn.rebind.side_effect = ldap3.core.exceptions.LDAPPasswordIsMandatoryError()
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", pool_size=2, failure_threshold=1)
+        self.assertEqual(False, a_client.ldap_auth(ldap_uid="test", ldap_pass=""))
+        for server in a_client.server_list:
+            self.assertFalse(a_client.server_health(server).quarantined)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_escapes_filter(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", schedule='fixed')
+        a_client.ldap_auth(ldap_uid="*)(cn=admin", ldap_pass="1234")
+        mock_ldap3.Connection.return_value.search.assert_called_with(
+            'test', '(&(objectClass=user)(cn=\\2a\\29\\28cn=admin))', attributes=['*'])
+
+    def test_client_ldap_auth_many(self):
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test")
+        # Only 'good' users are accepted
+        a_client._ldap_auth_func = lambda server, ldap_uid, ldap_pass: ldap_uid.startswith('good')
+        credentials = [("good" + str(i) if i % 2 else "bad" + str(i), "1234") for i in range(20)]
+        self.assertEqual([bool(i % 2) for i in range(20)], list(a_client.ldap_auth_many(credentials)))
+
+    def unmock_exceptions(self, mock_ldap3):
+        mock_ldap3.core.exceptions.LDAPException = ldap3.core.exceptions.LDAPException
+        mock_ldap3.core.exceptions.LDAPBindError = ldap3.core.exceptions.LDAPBindError
+        mock_ldap3.core.exceptions.LDAPResponseTimeoutError = ldap3.core.exceptions.LDAPResponseTimeoutError
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_pooled_ldap_auth_reuses_connection(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", schedule='fixed', pool_size=2,
+                                                  ad_domain="testdomain")
+        self.assertEqual(True, a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        self.assertEqual(True, a_client.ldap_auth(ldap_uid="test2", ldap_pass="5678"))
+        mock_ldap3.Connection.assert_called_once_with(mock_ldap3.Server.return_value, None, None)
+        self.assertEqual(False, mock_conn.bind.called)
+        self.assertEqual(2, mock_ldap3.Server.call_count)
+        self.assertEqual(1, mock_conn.open.call_count)
+        mock_conn.rebind.assert_called_with('test2@testdomain', '5678', read_server_info=False)
+        mock_conn.search.assert_called_with('test', '(&(objectClass=user)(cn=test2))', attributes=['*'])
+        a_client.close()
+        mock_conn.unbind.assert_called_with()
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_pooled_ldap_auth_bad_password(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        mock_conn.rebind.return_value = False
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", pool_size=2)
+        self.assertEqual(False, a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        self.assertEqual(False, mock_conn.search.called)
+        # The connection is still good, so it goes back in the pool
+        self.assertEqual(False, mock_conn.unbind.called)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_pooled_ldap_auth_with_service_account(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", pool_size=2,
+                                                  service_user='svc', service_password='secret')
+        self.assertEqual(True, a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        mock_ldap3.Connection.assert_any_call(mock_ldap3.Server.return_value, 'svc', 'secret')
+        mock_conn.search.assert_called_once_with('test', '(&(objectClass=user)(cn=test))', attributes=['1.1'])
+        mock_conn.rebind.assert_called_once_with('test', '1234', read_server_info=False)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_pooled_ldap_auth_with_service_account_unknown_user(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        mock_conn.entries = []
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", pool_size=2,
+                                                  service_user='svc', service_password='secret')
+        self.assertEqual(False, a_client.ldap_auth(ldap_uid="test", ldap_pass="1234"))
+        self.assertEqual(False, mock_conn.rebind.called)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_pooled_ldap_auth_ldap_exception(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.closed = False
+        mock_conn.search.side_effect = ldap3.core.exceptions.LDAPException()
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", pool_size=2)
+        self.assertRaises(AllAvailableServersFailed, a_client.ldap_auth, ldap_uid="test", ldap_pass="1234")
+        # Broken connections are closed, not pooled
+        self.assertEqual(2, mock_conn.unbind.call_count)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_client_ldap_auth_reuses_ldap_server(self, mock_ldap3):
+        a_client = ClientOfRedundantAdLdapServers(self.fake_server_dict, "test", schedule='fixed')
+        for _ in range(3):
+            a_client.ldap_auth(ldap_uid="test", ldap_pass="1234")
+        self.assertEqual(2, mock_ldap3.Server.call_count)
+
+    def test_update_servers_closes_drained_pools(self):
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", pool_size=2)
+        removed, kept = a_client.server_list
+        removed_pool, _ = a_client._get_pools(removed)
+        kept_pool, _ = a_client._get_pools(kept)
+        removed_pool.close = mock.Mock()
+        a_client.update_servers(OrderedDict([('srvr-dc2.myad.private.example.com', self.no_ssl_dict[kept.name])]))
+        removed_pool.close.assert_called_with()
+        self.assertEqual([kept], a_client.server_list)
+        self.assertIs(kept_pool, a_client._get_pools(kept)[0])
+
+    def test_configured_address_keeps_certificate_name(self):
+        server_dict = OrderedDict([('dc1.example.com', {'port': 636, 'ssl': True, 'validate': True,
+                                                        'address': '192.0.2.7'})])
+        a_client = ClientOfRedundantAdLdapServers(server_dict, "test")
+        ldap_server = a_client.server_list[0].ldap_server
+        self.assertEqual('192.0.2.7', ldap_server.host)
+        self.assertEqual(['dc1.example.com'], ldap_server.tls.valid_names)
+        self.assertEqual('dc1.example.com', ldap_server.tls.sni)
+
+    def test_bad_server_config_fails_at_startup(self):
+        bad_dicts = [OrderedDict([('dc1', {'port': 636, 'ssl': True})]),
+                     OrderedDict([('dc1', {'port': '636', 'ssl': True, 'validate': True})]),
+                     OrderedDict([('dc1', {'port': 0, 'ssl': True, 'validate': True})]),
+                     OrderedDict([('dc1', None)])]
+        for bad_dict in bad_dicts:
+            self.assertRaises(ValueError, ClientOfRedundantAdLdapServers, bad_dict, "test")
+
+    def test_servers_are_immutable(self):
+        a_client = ClientOfRedundantAdLdapServers(self.fake_server_dict, "test")
+        server = a_client.server_list[0]
+        self.assertEqual('srvr-dc1.myad.private.example.com', server.name)
+        self.assertEqual('srvr-dc1.myad.private.example.com', str(server))
+        self.assertRaises(AttributeError, setattr, server, 'port', 389)
+        self.assertRaises(AttributeError, setattr, server, 'colour', 'blue')
+
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_health_check_binds_and_reads_root_dse(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_conn = mock_ldap3.Connection.return_value
+        mock_conn.search.side_effect = [True, False]
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", failure_threshold=1)
+        a_client.check_health()
+        # Without a service account the check binds anonymously
+        mock_ldap3.Connection.assert_called_with(mock.ANY, None, None)
+        mock_conn.bind.assert_called_with()
+        mock_conn.search.assert_called_with('', '(objectClass=*)', search_scope=mock_ldap3.BASE, attributes=['1.1'])
+        self.assertFalse(a_client.server_health(a_client.server_list[0]).quarantined)
+        self.assertTrue(a_client.server_health(a_client.server_list[1]).quarantined)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_health_check_ldap_exception(self, mock_ldap3):
+        self.unmock_exceptions(mock_ldap3)
+        mock_ldap3.Connection.side_effect = ldap3.core.exceptions.LDAPSocketOpenError
+        a_client = ClientOfRedundantAdLdapServers(self.no_ssl_dict, "test", failure_threshold=1,
+                                                  service_user="svc", service_password="secret")
+        a_client.check_health()
+        mock_ldap3.Connection.assert_called_with(mock.ANY, "svc", "secret")
+        for server in a_client.server_list:
+            self.assertTrue(a_client.server_health(server).quarantined)
+
+class FakeConnection(object):
+    def __init__(self, healthy=True):
+        self.closed = False
+        self.healthy = healthy
+        self.unbound = False
+
+    def search(self, *args, **kwargs):
+        return self.healthy
+
+    def unbind(self):
+        self.unbound = True
+        self.closed = True
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLdapConnectionPool(unittest.TestCase):
+    """Tests for `LdapConnectionPool`."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pool = LdapConnectionPool(None, max_size=2, idle_timeout=60, clock=self.clock)
+
+    def test_reuses_most_recent_connection(self):
+        conn1 = FakeConnection()
+        conn2 = FakeConnection()
+        self.pool.checkin(conn1)
+        self.pool.checkin(conn2)
+        self.assertIs(conn2, self.pool.checkout())
+        self.assertIs(conn1, self.pool.checkout())
+
+    def test_max_size(self):
+        conns = [FakeConnection() for _ in range(3)]
+        for conn in conns:
+            self.pool.checkin(conn)
+        self.assertEqual(True, conns[2].unbound)
+        self.assertEqual(2, len(self.pool._idle))
+
+    def test_idle_connections_are_evicted(self):
+        conn1 = FakeConnection()
+        self.pool.checkin(conn1)
+        self.clock.now += 61
+        conn2 = FakeConnection()
+        self.pool.checkin(conn2)
+        self.assertEqual(True, conn1.unbound)
+        self.assertIs(conn2, self.pool.checkout())
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_ad_ldap_servers.ldap3')
+    def test_unhealthy_connection_is_replaced(self, mock_ldap3):
+        conn = FakeConnection(healthy=False)
+        self.pool.checkin(conn)
+        self.clock.now += 31
+        self.assertIs(mock_ldap3.Connection.return_value, self.pool.checkout())
+        self.assertEqual(True, conn.unbound)
+
+    def test_healthy_connection_is_reused(self):
+        conn = FakeConnection()
+        self.pool.checkin(conn)
+        self.clock.now += 31
+        self.assertIs(conn, self.pool.checkout())
+
+
+class TestLdapTimeBudget(unittest.TestCase):
+    """Tests of the time budget of LDAP requests against a real, but slow, LDAP server."""
+
+    def setUp(self):
+        # Each reply takes 0.3s, so a bind followed by a search can't be done within the request timeout.
+        self.server = StandInLdapServer('127.0.0.1', latency=0.3)
+        self.addCleanup(self.server.close)
+        self.server_dict = OrderedDict([('127.0.0.1', {'port': self.server.port, 'ssl': False, 'validate': False})])
+
+    def assert_within_request_timeout(self, a_client):
+        self.addCleanup(a_client.close)
+        for _ in range(2):
+            started = time.monotonic()
+            self.assertRaises(AllAvailableServersFailed, a_client.ldap_auth, ldap_uid="user", ldap_pass=RIGHT_PASSWORD)
+            # Allow a little for closing the connection once the time is up.
+            self.assertLess(time.monotonic() - started, 0.45)
+
+    def test_request_timeout_covers_the_whole_attempt(self):
+        self.assert_within_request_timeout(ClientOfRedundantAdLdapServers(
+            self.server_dict, "dc=example", request_timeout=0.4, failure_threshold=None))
+
+    def test_request_timeout_covers_the_whole_pooled_attempt(self):
+        self.assert_within_request_timeout(ClientOfRedundantAdLdapServers(
+            self.server_dict, "dc=example", pool_size=2, request_timeout=0.4, failure_threshold=None))
+
+    def test_request_within_request_timeout_succeeds(self):
+        self.server.latency = 0.05
+        a_client = ClientOfRedundantAdLdapServers(self.server_dict, "dc=example", pool_size=2, request_timeout=0.4)
+        self.addCleanup(a_client.close)
+        for _ in range(2):
+            self.assertTrue(a_client.ldap_auth(ldap_uid="user", ldap_pass=RIGHT_PASSWORD))
+
 
 if __name__ == '__main__':
     unittest.main()
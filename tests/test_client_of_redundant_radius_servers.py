@@ -1,15 +1,83 @@
 import mock
 import unittest
 import logging
-from client_of_redundant_servers.client_of_redundant_radius_servers import ClientOfRedundantRadiusServers
+from client_of_redundant_servers.client_of_redundant_radius_servers import ClientOfRedundantRadiusServers,\
+                                                                           RadiusTransport,\
+                                                                           RttEstimator,\
+                                                                           send_with_retries,\
+                                                                           load_dictionary,\
+                                                                           clear_dictionary_cache
 from client_of_redundant_servers.client_of_redundant_servers import AllAvailableServersFailed
+from client_of_redundant_servers.metrics import InMemoryMetrics
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pyrad.dictionary import Dictionary
 import os
+import pyrad.client
 import pyrad.packet
+import shutil
 import socket
+import tempfile
+import threading
+import time
 
 logging.disable(logging.CRITICAL)
 
+package_parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_dictionary = os.path.join(package_parent_dir, 'client_of_redundant_servers', 'dictionary.minimal')
+
+
+class FakeRadiusServer(object):
+    """Accepts the user 'test' with password '1234', and rejects everybody else. Answers Status-Server. Replies are
+       held back until 'batch' requests have arrived, and then sent in reverse order."""
+    def __init__(self, secret, batch=1, silent=False):
+        self.secret = secret
+        self.batch = batch
+        self.silent = silent
+        self.dictionary = Dictionary(default_dictionary)
+        self.received = 0
+        self.status_received = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self._stopped = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.start()
+
+    def _serve(self):
+        held = []
+        while not self._stopped:
+            try:
+                data, addr = self.socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            self.received += 1
+            if self.silent:
+                continue
+            request = pyrad.packet.AuthPacket(packet=data, secret=self.secret, dict=self.dictionary)
+            reply = request.CreateReply()
+            if request.code == pyrad.packet.StatusServer:
+                # Status-Server must be signed, and is answered with an Access-Accept (RFC 5997)
+                if not request.verify_message_authenticator():
+                    continue
+                self.status_received += 1
+                reply.code = pyrad.packet.AccessAccept
+            elif request['User-Name'][0] == 'test' and request.PwDecrypt(request[2][0]) == '1234':
+                reply.code = pyrad.packet.AccessAccept
+            else:
+                reply.code = pyrad.packet.AccessReject
+            held.append((reply.ReplyPacket(), addr))
+            if len(held) >= self.batch:
+                for raw_reply, reply_addr in reversed(held):
+                    self.socket.sendto(raw_reply, reply_addr)
+                held = []
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+        self.socket.close()
+
 
 class TestClientOfRedundantAdLdapServers(unittest.TestCase):
     """Tests for `client_of_redundant_radius_servers.py`."""
@@ -21,12 +89,26 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         self.fake_server_dict['radius1.inst.example.com'] = {'auth_port': 1812,
                                                              'secret': b'yyyy'}
 
+        # Hostnames are resolved once when a pyrad Client is created
+        self.fake_address = '192.0.2.1'
+        getaddrinfo_patcher = mock.patch('socket.getaddrinfo',
+                                         return_value=[(socket.AF_INET, socket.SOCK_DGRAM, 17, '',
+                                                        (self.fake_address, 1812))])
+        self.mock_getaddrinfo = getaddrinfo_patcher.start()
+        self.addCleanup(getaddrinfo_patcher.stop)
+        # Some tests mock Dictionary, so don't let them share parsed dictionaries with the others.
+        clear_dictionary_cache()
+        self.addCleanup(clear_dictionary_cache)
+
     @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
     def test_new_client_has_variables(self, mock_dictionary):
         fake_server_dict = OrderedDict()
         package_parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         default_dictionary = os.path.join(package_parent_dir, 'client_of_redundant_servers', 'dictionary.minimal')
         a_client = ClientOfRedundantRadiusServers(fake_server_dict, "test")
+        # The dictionary is only parsed when it is first used
+        self.assertFalse(mock_dictionary.called)
+        self.assertIs(mock_dictionary.return_value, a_client.dictionary)
         mock_dictionary.assert_called_with(default_dictionary)
         self.assertEqual("test", a_client.nas_identifier)
         self.assertEqual(3, a_client.server_timeout)
@@ -36,10 +118,44 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
     @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
     def test_new_client_has_manual_dictionary(self, mock_dictionary):
         fake_server_dict = OrderedDict()
-        test_dir = os.path.dirname(os.path.abspath(__file__))
-        test_dictionary = os.path.join(test_dir, 'dictionary.fictional')
-        _ = ClientOfRedundantRadiusServers(fake_server_dict, "test", dict_file=test_dictionary)
-        mock_dictionary.assert_called_with(test_dictionary)
+        with tempfile.NamedTemporaryFile(suffix='.fictional') as test_dictionary:
+            a_client = ClientOfRedundantRadiusServers(fake_server_dict, "test", dict_file=test_dictionary.name)
+            a_client.dictionary
+        mock_dictionary.assert_called_with(test_dictionary.name)
+
+    def test_missing_dictionary_is_raised_at_construction(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertRaises(ValueError, ClientOfRedundantRadiusServers, OrderedDict(), "test",
+                              dict_file=os.path.join(temp_dir, 'missing'))
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    def test_dictionary_error_is_not_a_server_failure(self, mock_pyrad_client):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dict_file = os.path.join(temp_dir, 'dictionary')
+            shutil.copy(default_dictionary, dict_file)
+            a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", dict_file=dict_file)
+        # The file has gone by the time the first request is made.
+        for pipelined in (False, True):
+            a_client.pipelined = pipelined
+            self.assertRaises(FileNotFoundError, a_client.radius_auth, user="test", password="1234")
+        self.assertFalse(mock_pyrad_client.called)
+        for server in a_client.server_list:
+            self.assertEqual(0, a_client._health[server].consecutive_failures)
+
+    def test_dictionaries_are_shared(self):
+        clients = [ClientOfRedundantRadiusServers(OrderedDict(), "test") for _ in range(3)]
+        self.assertIs(clients[0].dictionary, clients[1].dictionary)
+        self.assertIs(clients[0].dictionary, clients[2].dictionary)
+
+    def test_modified_dictionary_is_reloaded(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dict_file = os.path.join(temp_dir, 'dictionary')
+            shutil.copy(default_dictionary, dict_file)
+            first = load_dictionary(dict_file)
+            self.assertIs(first, load_dictionary(dict_file))
+            stat = os.stat(dict_file)
+            os.utime(dict_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            self.assertIsNot(first, load_dictionary(dict_file))
 
     def test_client_radius_auth_no_servers(self):
         fake_server_dict = OrderedDict()
@@ -52,7 +168,8 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test")
         result = a_client.radius_auth(user="test", password="1234")
         hostname = list(self.fake_server_dict.keys())[0]
-        mock_pyrad_client.assert_called_with(server=hostname,
+        self.mock_getaddrinfo.assert_called_with(hostname, 1812, 0, socket.SOCK_DGRAM)
+        mock_pyrad_client.assert_called_with(server=self.fake_address,
                                              authport=self.fake_server_dict[hostname]['auth_port'],
                                              secret=self.fake_server_dict[hostname]['secret'],
                                              dict=mock_dictionary.return_value)
@@ -67,7 +184,8 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         # We don't bind to a specific IP
         assert not mock_pyrad_client.return_value.bind.called
         hostname = list(self.fake_server_dict.keys())[0]
-        mock_pyrad_client.assert_called_with(server=hostname,
+        self.mock_getaddrinfo.assert_called_with(hostname, 1812, 0, socket.SOCK_DGRAM)
+        mock_pyrad_client.assert_called_with(server=self.fake_address,
                                              authport=self.fake_server_dict[hostname]['auth_port'],
                                              secret=self.fake_server_dict[hostname]['secret'],
                                              dict=mock_dictionary.return_value)
@@ -82,7 +200,8 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         # We must bind to the given IP
         mock_pyrad_client.return_value.bind.assert_called_with(('192.168.0.1', 0))
         hostname = list(self.fake_server_dict.keys())[0]
-        mock_pyrad_client.assert_called_with(server=hostname,
+        self.mock_getaddrinfo.assert_called_with(hostname, 1812, 0, socket.SOCK_DGRAM)
+        mock_pyrad_client.assert_called_with(server=self.fake_address,
                                              authport=self.fake_server_dict[hostname]['auth_port'],
                                              secret=self.fake_server_dict[hostname]['secret'],
                                              dict=mock_dictionary.return_value)
@@ -100,8 +219,378 @@ class TestClientOfRedundantAdLdapServers(unittest.TestCase):
         mock_pyrad_client.side_effect = pyrad.client.Timeout
         self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
 
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    def test_client_radius_auth_timeout_is_counted(self, mock_pyrad_client):
+        recorder = InMemoryMetrics()
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", metrics=recorder)
+        mock_pyrad_client.return_value.SendPacket.side_effect = pyrad.client.Timeout
+        self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        for server in a_client.server_list:
+            self.assertEqual(1, recorder.servers[server.name].timeouts)
+
     @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
     def test_client_radius_auth_socket_error_exception(self, mock_pyrad_client):
         a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test")
         mock_pyrad_client.side_effect = socket.error
         self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
+    def test_client_radius_auth_reuses_client(self, mock_dictionary, mock_pyrad_client):
+        mock_pyrad_client.return_value.SendPacket.return_value.code = pyrad.packet.AccessAccept
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", schedule='fixed',
+                                                  client_bind_ip='192.168.0.1')
+        for _ in range(3):
+            self.assertEqual(True, a_client.radius_auth(user="test", password="1234"))
+        self.assertEqual(1, mock_pyrad_client.call_count)
+        self.assertEqual(1, mock_pyrad_client.return_value.bind.call_count)
+        self.assertEqual(1, self.mock_getaddrinfo.call_count)
+        self.assertEqual(3, mock_pyrad_client.return_value.SendPacket.call_count)
+        a_client.close()
+        mock_pyrad_client.return_value._CloseSocket.assert_called_with()
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
+    def test_client_radius_auth_reuses_client_after_timeout(self, mock_dictionary, mock_pyrad_client):
+        mock_pyrad_client.return_value.SendPacket.side_effect = pyrad.client.Timeout
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", schedule='fixed',
+                                                  failure_threshold=None)
+        for _ in range(2):
+            self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        # One client per server
+        self.assertEqual(2, mock_pyrad_client.call_count)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
+    def test_client_radius_auth_discards_client_after_socket_error(self, mock_dictionary, mock_pyrad_client):
+        mock_pyrad_client.return_value.SendPacket.side_effect = socket.error
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", schedule='fixed',
+                                                  failure_threshold=None)
+        for _ in range(2):
+            self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        self.assertEqual(4, mock_pyrad_client.call_count)
+        # The socket of each discarded client is closed rather than leaked.
+        self.assertEqual(4, mock_pyrad_client.return_value._CloseSocket.call_count)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
+    def test_client_pool_is_bounded(self, mock_dictionary, mock_pyrad_client):
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", pool_size=2)
+        server = a_client.server_list[0]
+        clients = [a_client._checkout_client(server, a_client.dictionary) for _ in range(3)]
+        for srv in clients:
+            a_client._checkin_client(server, srv)
+        self.assertEqual(2, len(a_client._idle_clients[server]))
+        self.assertEqual(1, mock_pyrad_client.return_value._CloseSocket.call_count)
+        self.assertRaises(ValueError, ClientOfRedundantRadiusServers, self.fake_server_dict, "test", pool_size=-1)
+
+    def test_shared_health_key(self):
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test")
+        self.assertEqual('radius:radius0.inst.example.com:1812', a_client._shared_health_key(a_client.server_list[0]))
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Dictionary')
+    def test_update_servers(self, mock_dictionary, mock_pyrad_client):
+        mock_pyrad_client.return_value.SendPacket.return_value.code = pyrad.packet.AccessAccept
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", schedule='fixed',
+                                                  adaptive_timeout=True)
+        self.assertEqual(True, a_client.radius_auth(user="test", password="1234"))
+        kept = a_client.server_list[1]
+        new_server_dict = OrderedDict([('radius2.inst.example.com', {'auth_port': 1812, 'secret': b'zzzz'}),
+                                       ('radius1.inst.example.com', {'auth_port': 1812, 'secret': b'yyyy'})])
+        a_client.update_servers(new_server_dict)
+        # The removed server's socket is closed, as nothing was in flight, and the unchanged server is kept.
+        mock_pyrad_client.return_value._CloseSocket.assert_called_with()
+        self.assertIs(kept, a_client.server_list[1])
+        self.assertEqual(['radius2.inst.example.com', 'radius1.inst.example.com'],
+                         [server.name for server in a_client.server_list])
+        self.assertEqual(True, a_client.radius_auth(user="test", password="1234"))
+        self.assertIn(a_client.server_list[0], a_client._rtt_estimators)
+
+    def test_update_servers_changed_secret(self):
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test")
+        old_server = a_client.server_list[0]
+        new_server_dict = OrderedDict(self.fake_server_dict)
+        new_server_dict['radius0.inst.example.com'] = {'auth_port': 1812, 'secret': b'new!'}
+        a_client.update_servers(new_server_dict)
+        self.assertIsNot(old_server, a_client.server_list[0])
+        self.assertEqual(b'new!', a_client.server_list[0].secret)
+        self.assertRaises(ValueError, a_client.update_servers, OrderedDict([('radius0', {'auth_port': 1812})]))
+        self.assertEqual(b'new!', a_client.server_list[0].secret)
+
+    def test_configured_address_is_not_resolved(self):
+        server_dict = OrderedDict([('radius0', {'auth_port': 1812, 'secret': b'xxxx', 'address': '192.0.2.7'})])
+        a_client = ClientOfRedundantRadiusServers(server_dict, "test")
+        self.assertEqual('192.0.2.7', a_client.server_list[0].address())
+        self.assertEqual('192.0.2.7', a_client.server_list[0].host())
+        self.assertEqual(0, self.mock_getaddrinfo.call_count)
+        bad_dict = OrderedDict([('radius0', {'auth_port': 1812, 'secret': b'xxxx', 'address': 7})])
+        self.assertRaises(ValueError, ClientOfRedundantRadiusServers, bad_dict, "test")
+
+    def test_bad_server_config_fails_at_startup(self):
+        bad_dicts = [OrderedDict([('radius0', {'auth_port': 1812})]),
+                     OrderedDict([('radius0', {'auth_port': 1812, 'secret': 'not bytes'})]),
+                     OrderedDict([('radius0', {'auth_port': 70000, 'secret': b'xxxx'})])]
+        for bad_dict in bad_dicts:
+            self.assertRaises(ValueError, ClientOfRedundantRadiusServers, bad_dict, "test")
+
+    def test_server_address_is_cached(self):
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test")
+        server = a_client.server_list[0]
+        self.assertEqual(0, self.mock_getaddrinfo.call_count)
+        self.assertEqual(self.fake_address, server.address())
+        self.assertEqual(self.fake_address, server.address())
+        self.assertEqual(1, self.mock_getaddrinfo.call_count)
+        self.assertIs(a_client.server_health('radius0.inst.example.com'), a_client.server_health(server))
+
+    def make_pipelined_client(self, fake_server, **kwargs):
+        self.mock_getaddrinfo.return_value = [(socket.AF_INET, socket.SOCK_DGRAM, 17, '', ('127.0.0.1', 0))]
+        server_dict = OrderedDict([('radius0.inst.example.com', {'auth_port': fake_server.port,
+                                                                 'secret': b'xxxx'})])
+        a_client = ClientOfRedundantRadiusServers(server_dict, "test", pipelined=True, **kwargs)
+        self.addCleanup(a_client.close)
+        return a_client
+
+    def test_pipelined_radius_auth(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server)
+        self.assertEqual(True, a_client.radius_auth(user="test", password="1234"))
+        self.assertEqual(False, a_client.radius_auth(user="test", password="4321"))
+        self.assertEqual(1, len(a_client._transports))
+
+    def test_pipelined_radius_auth_replies_out_of_order(self):
+        fake_server = FakeRadiusServer(b'xxxx', batch=2)
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            accepted = executor.submit(a_client.radius_auth, user="test", password="1234")
+            rejected = executor.submit(a_client.radius_auth, user="test", password="4321")
+            self.assertEqual(True, accepted.result())
+            self.assertEqual(False, rejected.result())
+
+    def test_pipelined_radius_auth_many_threads(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server)
+        passwords = ["1234" if i % 3 else "bad" for i in range(1000)]
+        with ThreadPoolExecutor(max_workers=50) as executor:
+            results = list(executor.map(lambda password: a_client.radius_auth(user="test", password=password),
+                                        passwords))
+        self.assertEqual([password == "1234" for password in passwords], results)
+        self.assertEqual(1, len(a_client._transports))
+
+    def test_pipelined_radius_auth_timeout(self):
+        fake_server = FakeRadiusServer(b'xxxx', silent=True)
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server, server_timeout=0.02)
+        self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        # The request was retransmitted before giving up
+        self.assertEqual(3, fake_server.received)
+
+    def test_pipelined_radius_auth_wrong_secret_is_ignored(self):
+        fake_server = FakeRadiusServer(b'yyyy')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server, server_timeout=0.02)
+        self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+
+    def test_transport_frees_identifiers(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        transport = RadiusTransport('127.0.0.1', fake_server.port)
+        self.addCleanup(transport.close)
+        dictionary = Dictionary(default_dictionary)
+        used_ids = []
+
+        def create_packet(packet_id):
+            used_ids.append(packet_id)
+            packet = pyrad.packet.AuthPacket(id=packet_id, secret=b'xxxx', dict=dictionary, User_Name='test')
+            packet['User-Password'] = packet.PwCrypt('1234')
+            return packet
+
+        for _ in range(300):
+            transport.send_packet(create_packet)
+        self.assertEqual(list(range(256)) + list(range(44)), used_ids)
+        self.assertEqual({}, transport._pending)
+
+    def test_pipelined_radius_auth_many(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server)
+        credentials = [("test", "1234" if i % 3 else "bad") for i in range(100)]
+        results = list(a_client.radius_auth_many(credentials, concurrency=10))
+        self.assertEqual([password == "1234" for _, password in credentials], results)
+
+    def test_pipelined_radius_auth_request_timeout(self):
+        fake_server = FakeRadiusServer(b'xxxx', silent=True)
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server, request_timeout=0.09)
+        started = time.monotonic()
+        self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        # All three tries fit in the request timeout, despite the default 'server_timeout' of 3 seconds
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(3, fake_server.received)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    def test_client_radius_auth_request_timeout(self, mock_pyrad_client):
+        mock_pyrad_client.return_value.retries = 3
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", request_timeout=1.5)
+        a_client.radius_auth(user="test", password="1234")
+        # There are two servers, so the first gets half the time, split between three tries
+        self.assertAlmostEqual(0.25, mock_pyrad_client.return_value.timeout, places=2)
+
+    def test_reply_timeouts(self):
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", server_timeout=3)
+        server = a_client.server_list[0]
+        self.assertEqual([3, 3, 3], a_client._reply_timeouts(server, {}))
+        self.assertEqual([3, 3, 3], a_client._reply_timeouts(server, {'time_budget': 30}))
+        for expected, timeout in zip([0.5, 0.5, 0.5], a_client._reply_timeouts(server, {'time_budget': 1.5})):
+            self.assertAlmostEqual(expected, timeout)
+
+    def test_adaptive_reply_timeouts(self):
+        a_client = ClientOfRedundantRadiusServers(self.fake_server_dict, "test", server_timeout=3, server_retries=4,
+                                                  adaptive_timeout=True, min_timeout=0.01)
+        server = a_client.server_list[0]
+        # Nothing has been measured yet, so the server gets the full 'server_timeout'
+        self.assertEqual([3, 3, 3, 3], a_client._reply_timeouts(server, {}))
+        a_client._rtt_estimators[server].sample(0.1)
+        for expected, timeout in zip([0.3, 0.6, 1.2, 2.4], a_client._reply_timeouts(server, {})):
+            self.assertAlmostEqual(expected, timeout)
+        for expected, timeout in zip([0.15, 0.3, 0.6, 1.2], a_client._reply_timeouts(server, {'time_budget': 2.25})):
+            self.assertAlmostEqual(expected, timeout)
+
+    def test_pipelined_radius_auth_adaptive_timeout(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server, adaptive_timeout=True)
+        for _ in range(10):
+            self.assertEqual(True, a_client.radius_auth(user="test", password="1234"))
+        rtt_estimator = a_client._rtt_estimators[a_client.server_list[0]]
+        # A local server answers in well under the 3 second 'server_timeout'
+        self.assertIsNotNone(rtt_estimator.srtt)
+        self.assertLess(rtt_estimator.rto, 1)
+
+        fake_server.silent = True
+        started = time.monotonic()
+        self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(13, fake_server.received)
+
+    @mock.patch('client_of_redundant_servers.client_of_redundant_radius_servers.Client')
+    def test_client_radius_auth_retries(self, mock_pyrad_client):
+        mock_pyrad_client.return_value.SendPacket.side_effect = pyrad.client.Timeout
+        a_client = ClientOfRedundantRadiusServers(OrderedDict([('radius0.inst.example.com', {'auth_port': 1812,
+                                                                                            'secret': b'xxxx'})]),
+                                                  "test", server_retries=5)
+        self.assertRaises(AllAvailableServersFailed, a_client.radius_auth, user="test", password="1234")
+        # The same packet is sent once per try
+        self.assertEqual(5, mock_pyrad_client.return_value.SendPacket.call_count)
+        sent_packets = set(id(call[0][0]) for call in mock_pyrad_client.return_value.SendPacket.call_args_list)
+        self.assertEqual(1, len(sent_packets))
+
+
+    def test_pipelined_health_check(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server, failure_threshold=1, server_timeout=0.05)
+        a_client.check_health()
+        self.assertEqual(1, fake_server.status_received)
+        health = a_client.server_health('radius0.inst.example.com')
+        self.assertIsNotNone(health.latency_ewma)
+        self.assertEqual(False, health.quarantined)
+
+        fake_server.silent = True
+        a_client.check_health()
+        self.assertEqual(True, health.quarantined)
+        fake_server.silent = False
+        a_client.check_health()
+        self.assertEqual(False, health.quarantined)
+
+    def test_health_check_wrong_secret(self):
+        fake_server = FakeRadiusServer(b'yyyy')
+        self.addCleanup(fake_server.stop)
+        a_client = self.make_pipelined_client(fake_server, server_timeout=0.02)
+        a_client.check_health()
+        self.assertEqual(1, a_client.server_health('radius0.inst.example.com').consecutive_failures)
+
+    def test_pooled_health_check(self):
+        fake_server = FakeRadiusServer(b'xxxx')
+        self.addCleanup(fake_server.stop)
+        self.mock_getaddrinfo.return_value = [(socket.AF_INET, socket.SOCK_DGRAM, 17, '', ('127.0.0.1', 0))]
+        server_dict = OrderedDict([('radius0.inst.example.com', {'auth_port': fake_server.port,
+                                                                 'secret': b'xxxx'})])
+        a_client = ClientOfRedundantRadiusServers(server_dict, "test")
+        self.addCleanup(a_client.close)
+        a_client.check_health()
+        self.assertEqual(1, fake_server.status_received)
+        self.assertEqual(0, a_client.server_health('radius0.inst.example.com').consecutive_failures)
+
+class TestRttEstimator(unittest.TestCase):
+    """Tests for `RttEstimator`."""
+
+    def setUp(self):
+        self.rtt_estimator = RttEstimator(0.05, 3)
+
+    def test_first_sample(self):
+        self.assertEqual(3, self.rtt_estimator.rto)
+        self.rtt_estimator.sample(0.2)
+        self.assertAlmostEqual(0.2, self.rtt_estimator.srtt)
+        self.assertAlmostEqual(0.1, self.rtt_estimator.rttvar)
+        self.assertAlmostEqual(0.6, self.rtt_estimator.rto)
+
+    def test_later_samples(self):
+        self.rtt_estimator.sample(0.2)
+        self.rtt_estimator.sample(0.4)
+        self.assertAlmostEqual(0.225, self.rtt_estimator.srtt)
+        self.assertAlmostEqual(0.125, self.rtt_estimator.rttvar)
+        self.assertAlmostEqual(0.725, self.rtt_estimator.rto)
+
+    def test_timeout_is_bounded(self):
+        for _ in range(20):
+            self.rtt_estimator.sample(0.001)
+        self.assertEqual(0.05, self.rtt_estimator.rto)
+        self.rtt_estimator.sample(10)
+        self.assertEqual(3, self.rtt_estimator.rto)
+
+    def test_backoff(self):
+        self.rtt_estimator.sample(0.1)
+        self.rtt_estimator.backoff()
+        self.assertAlmostEqual(0.6, self.rtt_estimator.rto)
+        for _ in range(10):
+            self.rtt_estimator.backoff()
+        self.assertEqual(3, self.rtt_estimator.rto)
+        # A new measurement brings the timeout straight back down
+        self.rtt_estimator.sample(0.1)
+        self.assertLess(self.rtt_estimator.rto, 1)
+
+    def test_timeouts(self):
+        self.rtt_estimator.sample(0.2)
+        for expected, timeout in zip([0.6, 1.2, 2.4, 3], self.rtt_estimator.timeouts(4)):
+            self.assertAlmostEqual(expected, timeout)
+
+
+class TestSendWithRetries(unittest.TestCase):
+    """Tests for `send_with_retries`."""
+
+    def test_only_first_try_is_measured(self):
+        rtt_estimator = RttEstimator(0.05, 3)
+        tries = []
+
+        def send_once(timeout):
+            tries.append(timeout)
+            if len(tries) < 2:
+                raise pyrad.client.Timeout
+            return 'reply'
+
+        self.assertEqual('reply', send_with_retries(send_once, [1, 2, 3], rtt_estimator))
+        self.assertEqual([1, 2], tries)
+        # The reply was to a retransmission, so it can't be timed, but the unanswered try backed off the timeout.
+        self.assertIsNone(rtt_estimator.srtt)
+        self.assertEqual(3, rtt_estimator.rto)
+
+    def test_no_reply(self):
+        def send_once(timeout):
+            raise pyrad.client.Timeout
+
+        self.assertRaises(pyrad.client.Timeout, send_with_retries, send_once, [0.1, 0.2])
+
@@ -1,10 +1,20 @@
+import mock
 import unittest
+import sys
 import types
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers,\
                                                                     CurrentServerFailed,\
-                                                                    AllAvailableServersFailed
+                                                                    AllAvailableServersFailed,\
+                                                                    CurrentServerTimedOut,\
+                                                                    ServerDescriptor
 from collections import OrderedDict
 
 
@@ -29,8 +39,8 @@ class FakeServer(object):
 
 
 class ClientOfRedundantFakeServers(ClientOfRedundantServers):
-    def __init__(self, server_dict: OrderedDict, schedule='round-robin'):
-        super().__init__(server_dict, schedule)
+    def __init__(self, server_dict: OrderedDict, schedule='round-robin', **kwargs):
+        super().__init__(server_dict, schedule, **kwargs)
 
     def _fake_server_func(self, server):
         try:
@@ -42,6 +52,19 @@ class ClientOfRedundantFakeServers(ClientOfRedundantServers):
         return self.request(self._fake_server_func)
 
 
+class PortServer(ServerDescriptor):
+    __slots__ = ('port',)
+
+    def __init__(self, name, config):
+        super().__init__(name)
+        self._set('port', config['port'])
+
+
+class ClientOfRedundantPortServers(ClientOfRedundantServers):
+    def _make_server(self, name, config):
+        return PortServer(name, config)
+
+
 class TestClientOfRedundantServers(unittest.TestCase):
     """Tests for `client_of_redundant_servers.py`."""
 
@@ -146,6 +169,706 @@ class TestClientOfRedundantServers(unittest.TestCase):
             and not (fake_server_1.used and fake_server_2.used)
         self.assertEqual(True, any_one_server_used)
 
+    def test_failing_server_is_quarantined(self):
+        bad_server = FakeServer(True)
+        good_server = FakeServer(False)
+        fake_server_dict = OrderedDict()
+        fake_server_dict[bad_server] = None
+        fake_server_dict[good_server] = None
+        a_client = ClientOfRedundantFakeServers(fake_server_dict, schedule='fixed', failure_threshold=2)
+        _ = a_client.fake_func()
+        _ = a_client.fake_func()
+        self.assertEqual(True, a_client.server_health(bad_server).quarantined)
+        bad_server.used = False
+        result = a_client.fake_func()
+        self.assertEqual(True, result)
+        # The quarantined server is skipped while another server is healthy
+        self.assertEqual(False, bad_server.used)
+
+    def test_quarantined_server_is_last_resort(self):
+        recovering_server = FakeServer(True)
+        bad_server = FakeServer(True)
+        fake_server_dict = OrderedDict()
+        fake_server_dict[recovering_server] = None
+        fake_server_dict[bad_server] = None
+        a_client = ClientOfRedundantFakeServers(fake_server_dict, schedule='fixed', failure_threshold=1)
+        self.assertRaises(AllAvailableServersFailed, a_client.fake_func)
+        self.assertEqual(True, a_client.server_health(recovering_server).quarantined)
+        self.assertEqual(True, a_client.server_health(bad_server).quarantined)
+        recovering_server.bad = False
+        result = a_client.fake_func()
+        self.assertEqual(True, result)
+        self.assertEqual(False, a_client.server_health(recovering_server).quarantined)
+
+    def test_quarantine_disabled(self):
+        bad_server = FakeServer(True)
+        good_server = FakeServer(False)
+        fake_server_dict = OrderedDict()
+        fake_server_dict[bad_server] = None
+        fake_server_dict[good_server] = None
+        a_client = ClientOfRedundantFakeServers(fake_server_dict, schedule='fixed', failure_threshold=None)
+        for _ in range(5):
+            bad_server.used = False
+            _ = a_client.fake_func()
+            self.assertEqual(True, bad_server.used)
+
+    def test_rr_failover_wraps_around(self):
+        calls = []
+        fake_server_dict = OrderedDict([('a', None), ('b', None), ('c', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, failure_threshold=None)
+
+        def fail_on_c(server):
+            calls.append(server)
+            if server == 'c':
+                raise CurrentServerFailed
+            return server
+
+        self.assertEqual('a', a_client.request(fail_on_c))
+        self.assertEqual('b', a_client.request(fail_on_c))
+        self.assertEqual('a', a_client.request(fail_on_c))
+        self.assertEqual(['a', 'b', 'c', 'a'], calls)
+        self.assertEqual(0, a_client._rr_position)
+
+    def test_failover_across_many_servers(self):
+        # Failing over must not recurse once per server
+        fake_server_dict = OrderedDict((i, None) for i in range(5000))
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', failure_threshold=None)
+
+        def last_one_works(server):
+            if server != 4999:
+                raise CurrentServerFailed
+            return server
+
+        self.assertEqual(4999, a_client.request(last_one_works))
+
+    def test_none_is_a_valid_result(self):
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict)
+        self.assertEqual(None, a_client.request(lambda server: None))
+
+    def slow_first_func(self, server, calls, release):
+        calls.append(server)
+        if server == 'a':
+            release.wait(5)
+        if server == 'c':
+            raise CurrentServerFailed
+        return server
+
+    def test_hedged_request_uses_faster_server(self):
+        calls = []
+        release = threading.Event()
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=0.01)
+        self.addCleanup(a_client.close)
+        threading.Timer(0.1, release.set).start()
+        result = a_client.request(self.slow_first_func, calls=calls, release=release)
+        self.assertEqual('b', result)
+        self.assertEqual(['a', 'b'], calls)
+
+    def test_hedged_request_runs_first_attempt_in_calling_thread(self):
+        threads = {}
+        release = threading.Event()
+
+        def func(server):
+            threads[server] = threading.current_thread()
+            if server == 'a':
+                release.wait(5)
+            return server
+
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=0.01, hedge_workers=1)
+        self.addCleanup(a_client.close)
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual('b', a_client.request(func))
+        self.assertIs(threading.current_thread(), threads['a'])
+        self.assertIsNot(threading.current_thread(), threads['b'])
+        self.assertEqual(1, a_client._hedge_executor._max_workers)
+
+    def test_hedged_request_without_hedge_stays_in_calling_thread(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed', hedge_delay=1)
+        self.addCleanup(a_client.close)
+        self.assertIs(threading.current_thread(), a_client.request(lambda server: threading.current_thread()))
+        self.assertEqual(0, len(a_client._hedge_executor._threads))
+
+    def test_hedged_request_failed_first_attempt_waits_for_hedge(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def func(server):
+            if server == 'a':
+                time.sleep(0.05)
+                raise CurrentServerFailed
+            release.wait(0.1)
+            return server
+
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=0.01)
+        self.addCleanup(a_client.close)
+        self.assertEqual('b', a_client.request(func))
+        self.assertEqual(1, a_client.server_health('a').consecutive_failures)
+        self.assertEqual(0, a_client.server_health('b').consecutive_failures)
+
+    def test_hedged_request_with_callable_delay(self):
+        calls = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+        delays = []
+
+        def hedge_delay(server):
+            delays.append(server)
+            return 0.01
+
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=hedge_delay)
+        self.assertEqual('b', a_client.request(self.slow_first_func, calls=calls, release=release))
+        self.assertEqual(['a'], delays)
+
+    def test_hedged_request_respects_max_extra(self):
+        calls = []
+        release = threading.Event()
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=0.01, hedge_max_extra=0)
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual('a', a_client.request(self.slow_first_func, calls=calls, release=release))
+        self.assertEqual(['a'], calls)
+
+    def test_hedged_request_respects_budget(self):
+        calls = []
+        release = threading.Event()
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=0.01, hedge_budget=0)
+        a_client._hedge_tokens = 0
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual('a', a_client.request(self.slow_first_func, calls=calls, release=release))
+        self.assertEqual(['a'], calls)
+
+    def test_hedged_request_fails_over(self):
+        calls = []
+        release = threading.Event()
+        fake_server_dict = OrderedDict([('c', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=1)
+        self.assertEqual('b', a_client.request(self.slow_first_func, calls=calls, release=release))
+        self.assertEqual(['c', 'b'], calls)
+        self.assertEqual(1, a_client.server_health('c').consecutive_failures)
+
+    def test_hedged_request_all_servers_fail(self):
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, hedge_delay=0.01)
+
+        def just_raise(server):
+            raise CurrentServerFailed
+
+        self.assertRaises(AllAvailableServersFailed, a_client.request, just_raise)
+
+    def test_func_is_given_server_descriptors(self):
+        fake_server_dict = OrderedDict([('a', {'port': 1}), ('b', {'port': 2})])
+        a_client = ClientOfRedundantPortServers(fake_server_dict, schedule='fixed')
+        server = a_client.request(lambda server: server)
+        self.assertIsInstance(server, PortServer)
+        self.assertEqual('a', server.name)
+        self.assertEqual(1, server.port)
+        self.assertIs(server, a_client.server_list[0])
+        self.assertIs(a_client.server_health('a'), a_client.server_health(server))
+
+    def test_shared_between_threads(self):
+        fake_server_dict = OrderedDict([(str(i), None) for i in range(4)])
+        a_client = ClientOfRedundantServers(fake_server_dict)
+        counts = {name: 0 for name in fake_server_dict}
+        counts_lock = threading.Lock()
+
+        def count_server(server):
+            with counts_lock:
+                counts[server] += 1
+            return server
+
+        def worker():
+            for _ in range(500):
+                a_client.request(count_server)
+
+        # Switch threads as often as possible, to give races every chance to happen.
+        old_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker) for _ in range(32)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(old_interval)
+
+        self.assertEqual({name: 4000 for name in fake_server_dict}, counts)
+        for name in fake_server_dict:
+            self.assertEqual(0, a_client.server_health(name).outstanding)
+
+    def test_hedge_budget_shared_between_threads(self):
+        fake_server_dict = OrderedDict([('a', None), ('b', None)])
+        a_client = ClientOfRedundantServers(fake_server_dict, schedule='fixed', hedge_delay=0, hedge_budget=0)
+        threads = [threading.Thread(target=a_client.request, args=(lambda server: time.sleep(0.01),))
+                   for _ in range(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(0, a_client._hedge_tokens)
+        a_client.close()
+
+    def test_ewma_does_not_favour_server_that_fails_fast(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('dead', None), ('slow', None)]), schedule='ewma',
+                                            failure_threshold=None)
+        calls = []
+
+        def server_func(server):
+            calls.append(server)
+            if server == 'dead':
+                raise CurrentServerFailed
+            time.sleep(0.01)
+            return server
+
+        for _ in range(3):
+            self.assertEqual('slow', a_client.request(server_func))
+        # Only the first request tried the dead server, which then sorted behind the slow one.
+        self.assertEqual(['dead', 'slow', 'slow', 'slow'], calls)
+        self.assertGreaterEqual(a_client.server_health('dead').latency_ewma, 1.0)
+
+    def test_hedge_executor_created_once(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]), hedge_delay=1)
+        barrier = threading.Barrier(16)
+        executors = []
+        real_executor = ThreadPoolExecutor
+
+        def slow_executor(max_workers=None):
+            # Give every thread time to get past the first check before the executor is set.
+            time.sleep(0.01)
+            executor = real_executor(max_workers)
+            executors.append(executor)
+            return executor
+
+        def worker():
+            barrier.wait()
+            a_client.request(lambda server: server)
+
+        with mock.patch('client_of_redundant_servers.client_of_redundant_servers.ThreadPoolExecutor', slow_executor):
+            threads = [threading.Thread(target=worker) for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, len(executors))
+        a_client.close()
+        self.assertIsNone(a_client._hedge_executor)
+        self.assertIsNone(a_client._hedge_timer)
+
+    def test_identical_requests_are_coalesced(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), coalesce=True)
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_func(server, user):
+            calls.append((server, user))
+            started.set()
+            release.wait(5)
+            return user
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(a_client.request(blocking_func, user='bob')))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Give the followers time to join the request in flight.
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual('eve', a_client.request(blocking_func, user='eve'))
+        self.assertEqual(['bob'] * 5, results)
+        self.assertEqual([('a', 'bob'), ('b', 'eve')], calls)
+        self.assertEqual({}, a_client._flights)
+
+    def test_coalesced_requests_share_exceptions(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]), coalesce=True)
+        calls = []
+        release = threading.Event()
+
+        def failing_func(server):
+            calls.append(server)
+            release.wait(5)
+            raise CurrentServerFailed
+
+        errors = []
+
+        def worker():
+            try:
+                a_client.request(failing_func)
+            except AllAvailableServersFailed as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(errors))
+        self.assertEqual(['a'], calls)
+
+    def test_unhashable_requests_are_not_coalesced(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]), coalesce=True)
+        self.assertEqual(['x'], a_client.request(lambda server, value: value, value=['x']))
+        self.assertEqual({}, a_client._flights)
+
+    def test_request_many_streams_results_in_order(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]))
+        servers = []
+
+        def slow_func(server, value):
+            servers.append(server)
+            # Later requests finish first, but the results still come back in order.
+            time.sleep(0.001 * (20 - value))
+            if value == 7:
+                raise CurrentServerFailed
+            return value
+
+        results = list(a_client.request_many(slow_func, ({'value': i} for i in range(20)), concurrency=4))
+        self.assertEqual(list(range(7)), results[:7])
+        self.assertIsInstance(results[7], AllAvailableServersFailed)
+        self.assertEqual(list(range(8, 20)), results[8:])
+        # The work was spread over every server.
+        self.assertEqual({'a', 'b', 'c'}, set(servers))
+
+    def test_request_many_is_bounded(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]))
+        in_flight = []
+        most_in_flight = []
+        lock = threading.Lock()
+
+        def counting_func(server, value):
+            with lock:
+                in_flight.append(value)
+                most_in_flight.append(len(in_flight))
+            time.sleep(0.005)
+            with lock:
+                in_flight.remove(value)
+            return value
+
+        read = []
+
+        def kwargs_iterable():
+            for i in range(30):
+                read.append(i)
+                yield {'value': i}
+
+        results = a_client.request_many(counting_func, kwargs_iterable(), concurrency=3)
+        self.assertEqual(0, next(results))
+        # Only a window of requests is read ahead of the results.
+        self.assertLessEqual(len(read), 7)
+        self.assertEqual(list(range(1, 30)), list(results))
+        self.assertEqual(3, max(most_in_flight))
+
+    def test_request_many_bad_concurrency(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]))
+        self.assertRaises(ValueError, a_client.request_many, lambda server: server, [{}], concurrency=0)
+
+    def test_request_timeout_is_shared_between_servers(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]), schedule='fixed',
+                                            request_timeout=3)
+        budgets = []
+
+        def failing_func(server, time_budget):
+            budgets.append(time_budget)
+            raise CurrentServerFailed
+
+        self.assertRaises(AllAvailableServersFailed, a_client.request, failing_func)
+        # Each server gets an equal share of the time left, so a fast failure leaves more for the rest.
+        self.assertEqual(3, len(budgets))
+        for expected, budget in zip([1.0, 1.5, 3.0], budgets):
+            self.assertAlmostEqual(expected, budget, places=1)
+
+    def test_request_timeout_stops_failover(self):
+        a_client = ClientOfRedundantServers(OrderedDict([(str(i), None) for i in range(5)]), schedule='fixed',
+                                            request_timeout=0.08)
+        calls = []
+
+        def slow_failing_func(server, time_budget):
+            calls.append(server)
+            time.sleep(0.05)
+            raise CurrentServerFailed
+
+        self.assertRaises(AllAvailableServersFailed, a_client.request, slow_failing_func)
+        self.assertEqual(['0', '1'], calls)
+
+    def test_no_time_budget_without_request_timeout(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]))
+        self.assertEqual({}, a_client.request(lambda server, **kwargs: kwargs))
+
+    def test_hedged_request_timeout(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), hedge_delay=0.01,
+                                            request_timeout=0.05)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def stuck_func(server, time_budget):
+            # Neither server answers, so each attempt gives up when its time budget is spent.
+            if not release.wait(time_budget):
+                raise CurrentServerTimedOut
+            return server
+
+        started = time.monotonic()
+        self.assertRaises(AllAvailableServersFailed, a_client.request, stuck_func)
+        self.assertLess(time.monotonic() - started, 1)
+        a_client.close()
+
+
+    def test_check_health(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), failure_threshold=1)
+
+        def check_func(server):
+            if server == 'b':
+                raise CurrentServerFailed
+            return True
+
+        a_client.check_health(check_func)
+        self.assertFalse(a_client.server_health('a').quarantined)
+        self.assertIsNotNone(a_client.server_health('a').latency_ewma)
+        self.assertTrue(a_client.server_health('b').quarantined)
+        self.assertEqual('a', a_client.request(lambda server: server))
+        a_client.check_health(lambda server: True)
+        self.assertFalse(a_client.server_health('b').quarantined)
+
+    def test_check_health_needs_a_check(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]))
+        self.assertRaises(NotImplementedError, a_client.check_health)
+        self.assertRaises(NotImplementedError, a_client.start_health_checks)
+
+    def test_background_health_checks(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), failure_threshold=1)
+        checked = threading.Event()
+
+        def check_func(server):
+            if server == 'b':
+                checked.set()
+                return False
+            return True
+
+        a_client.start_health_checks(interval=0.01, check_func=check_func)
+        self.assertRaises(RuntimeError, a_client.start_health_checks, check_func=check_func)
+        self.assertTrue(checked.wait(5))
+        self.assertTrue(a_client.server_health('b').quarantined)
+        checkers = [thread for thread in threading.enumerate() if thread.name == 'HealthChecker']
+        a_client.close()
+        for thread in checkers:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def enable_logging(self):
+        logging.disable(logging.NOTSET)
+        self.addCleanup(logging.disable, logging.CRITICAL)
+
+    def test_failure_logs_are_rate_limited(self):
+        self.enable_logging()
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed',
+                                            failure_threshold=None, failure_log_interval=0.05)
+
+        def failing_func(server):
+            if server == 'a':
+                raise CurrentServerFailed
+            return server
+
+        logger_name = 'client_of_redundant_servers.client_of_redundant_servers'
+        with self.assertLogs(logger_name, logging.WARNING) as logs:
+            for _ in range(5):
+                a_client.request(failing_func)
+        self.assertEqual(["WARNING:" + logger_name + ":Server a failed."], logs.output)
+
+        time.sleep(0.06)
+        with self.assertLogs(logger_name, logging.WARNING) as logs:
+            a_client.request(failing_func)
+        self.assertEqual(["WARNING:" + logger_name + ":Server a failed (and 4 more times since it was last logged)."],
+                         logs.output)
+
+    def test_every_failure_is_logged_without_interval(self):
+        self.enable_logging()
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]), failure_threshold=None,
+                                            failure_log_interval=0)
+
+        def failing_func(server):
+            raise CurrentServerFailed
+
+        with self.assertLogs('client_of_redundant_servers', logging.WARNING) as logs:
+            for _ in range(3):
+                self.assertRaises(AllAvailableServersFailed, a_client.request, failing_func)
+        self.assertEqual(3, sum(1 for line in logs.output if line.endswith("Server a failed.")))
+
+    def test_update_servers_keeps_unchanged_servers(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='fixed',
+                                            failure_threshold=1)
+        a_client.server_health('a').record_failure()
+        health_of_a = a_client.server_health('a')
+        a_client.update_servers(OrderedDict([('c', None), ('a', None)]))
+        self.assertEqual(['c', 'a'], a_client.server_list)
+        self.assertIs(health_of_a, a_client.server_health('a'))
+        self.assertTrue(a_client.server_health('a').quarantined)
+        self.assertEqual(['c', 'c'], [a_client.request(lambda server: server) for _ in range(2)])
+
+    def test_update_servers_drains_removed_servers(self):
+        drained = []
+
+        class DrainingClient(ClientOfRedundantServers):
+            def _server_drained(self, server):
+                drained.append(server)
+
+        a_client = DrainingClient(OrderedDict([('a', None), ('b', None)]), schedule='fixed')
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_func(server):
+            started.set()
+            release.wait(5)
+            return server
+
+        thread = threading.Thread(target=a_client.request, args=(slow_func,))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        a_client.update_servers(OrderedDict([('b', None)]))
+        self.assertEqual([], drained)
+        self.assertTrue(a_client.server_health('a').draining)
+        self.assertEqual('b', a_client.request(lambda server: server))
+        release.set()
+        thread.join(5)
+        self.assertEqual(['a'], drained)
+
+        # The drained server is only forgotten at the next update, which may also add it back.
+        a_client.update_servers(OrderedDict([('b', None), ('a', None)]))
+        self.assertFalse(a_client.server_health('a').draining)
+        self.assertEqual(['b', 'a'], a_client.server_list)
+
+    def test_server_drained_without_servers_lock(self):
+        added = []
+        while_closing = []
+
+        class ReAddingClient(ClientOfRedundantServers):
+            def _server_added(self, server):
+                added.append(server)
+
+            def _server_drained(self, server):
+                # Taking the lock here would deadlock if it were still held.
+                self.update_servers(OrderedDict([('a', None), ('b', None)]))
+                while_closing.append(self.request(lambda server: server))
+
+        a_client = ReAddingClient(OrderedDict([('a', None), ('b', None)]), schedule='fixed')
+        a_client.update_servers(OrderedDict([('b', None)]))
+        self.assertEqual(['b'], while_closing)
+        # 'a' was added back while it was being closed, so it is only set up again, and used, once it is closed.
+        self.assertEqual(['a'], added)
+        self.assertFalse(a_client.server_health('a').draining)
+        self.assertEqual('a', a_client.request(lambda server: server))
+
+    def test_check_health_counts_as_in_flight(self):
+        drained = []
+
+        class DrainingClient(ClientOfRedundantServers):
+            def _server_drained(self, server):
+                drained.append(server)
+
+        a_client = DrainingClient(OrderedDict([('a', None), ('b', None)]))
+
+        def check_func(server):
+            if server == 'a':
+                a_client.update_servers(OrderedDict([('b', None)]))
+                self.assertEqual([], drained)
+                self.assertEqual(1, a_client.server_health('a').outstanding)
+            return True
+
+        a_client.check_health(check_func)
+        self.assertEqual(['a'], drained)
+        self.assertEqual(0, a_client.server_health('a').outstanding)
+        a_client.check_health(lambda server: self.assertEqual('b', server) or True)
+
+    def test_update_servers_skips_removed_servers_in_failover(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]),
+                                            schedule='fixed')
+        tried = []
+
+        def failing_func(server):
+            tried.append(server)
+            if server == 'a':
+                # Remove 'b' while this request is failing over.
+                a_client.update_servers(OrderedDict([('a', None), ('c', None)]))
+                raise CurrentServerFailed
+            return server
+
+        self.assertEqual('c', a_client.request(failing_func))
+        self.assertEqual(['a', 'c'], tried)
+
+    def test_update_servers_between_failover_and_attempt(self):
+        drained = []
+
+        class RacingClient(ClientOfRedundantServers):
+            def _failover_order(self, server_list, start):
+                for server in super()._failover_order(server_list, start):
+                    if server == 'a':
+                        # Remove 'a' after it has been checked, but before the attempt of it starts.
+                        self.update_servers(OrderedDict([('b', None)]))
+                    yield server
+
+            def _server_drained(self, server):
+                drained.append(server)
+
+        for kwargs in ({}, {'hedge_delay': 1.0}):
+            del drained[:]
+            a_client = RacingClient(OrderedDict([('a', None), ('b', None)]), schedule='fixed', **kwargs)
+            self.addCleanup(a_client.close)
+            tried = []
+
+            def func(server):
+                tried.append(server)
+                return server
+
+            self.assertEqual('b', a_client.request(func))
+            self.assertEqual(['b'], tried)
+            self.assertEqual(['a'], drained)
+            self.assertEqual(0, a_client.server_health('a').outstanding)
+
+    def test_update_servers_rejects_bad_entries(self):
+        class ValidatingClient(ClientOfRedundantServers):
+            def _make_server(self, name, config):
+                if config is None:
+                    raise ValueError("bad server")
+                return name
+
+        a_client = ValidatingClient(OrderedDict([('a', {})]))
+        self.assertRaises(ValueError, a_client.update_servers, OrderedDict([('a', {}), ('b', None)]))
+        self.assertEqual(['a'], a_client.server_list)
+
+    def test_watch_server_file(self):
+        server_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.addCleanup(os.unlink, server_file.name)
+        json.dump({'a': None}, server_file)
+        server_file.close()
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]))
+        a_client.start_watching_server_file(server_file.name, interval=0.01)
+        self.assertRaises(RuntimeError, a_client.start_watching_server_file, server_file.name)
+        self.addCleanup(a_client.close)
+
+        with open(server_file.name, 'w') as new_server_file:
+            new_server_file.write('{"b": null, "c": null}')
+        # Make sure the modification time changes, however coarse the file system's clock is.
+        os.utime(server_file.name, ns=(0, 0))
+        deadline = time.monotonic() + 5
+        while a_client.server_list != ['b', 'c'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['b', 'c'], a_client.server_list)
+
+        with open(server_file.name, 'w') as new_server_file:
+            new_server_file.write('not json')
+        os.utime(server_file.name, ns=(10 ** 9, 10 ** 9))
+        time.sleep(0.05)
+        self.assertEqual(['b', 'c'], a_client.server_list)
 
 if __name__ == '__main__':
     unittest.main()
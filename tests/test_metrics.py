@@ -0,0 +1,251 @@
+import asyncio
+import mock
+import unittest
+import logging
+import threading
+import time
+
+from concurrent.futures import Executor, Future
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers,\
+                                                                    CurrentServerFailed,\
+                                                                    CurrentServerTimedOut,\
+                                                                    AllAvailableServersFailed,\
+                                                                    ServerDescriptor
+from client_of_redundant_servers.async_client_of_redundant_servers import AsyncClientOfRedundantServers
+from client_of_redundant_servers.metrics import Histogram, InMemoryMetrics, PrometheusMetrics, StatsdMetrics,\
+                                                SUCCESS, REJECT, FAILURE, TIMEOUT, CANCELLED
+from collections import OrderedDict
+
+
+logging.disable(logging.CRITICAL)
+
+
+class TestHistogram(unittest.TestCase):
+    """Tests for `metrics.py`."""
+
+    def test_observe(self):
+        histogram = Histogram((0.1, 1.0, float('inf')))
+        for value in (0.05, 0.1, 0.5, 20):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1], histogram.counts)
+        self.assertEqual(4, histogram.count)
+        self.assertAlmostEqual(20.65, histogram.sum)
+
+    def test_quantile(self):
+        histogram = Histogram((1, 2, 3, float('inf')))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in [1] * 98 + [3, 3]:
+            histogram.observe(value)
+        self.assertEqual(1, histogram.quantile(0.5))
+        self.assertEqual(3, histogram.quantile(0.99))
+
+
+class TestInMemoryMetrics(unittest.TestCase):
+
+    def test_counters(self):
+        recorder = InMemoryMetrics()
+        for outcome in (SUCCESS, SUCCESS, REJECT, FAILURE, TIMEOUT, CANCELLED):
+            recorder.record_attempt('a', outcome, 0.01)
+        server_metrics = recorder.servers['a']
+        self.assertEqual(6, server_metrics.attempts)
+        self.assertEqual(2, server_metrics.successes)
+        self.assertEqual(1, server_metrics.rejects)
+        self.assertEqual(1, server_metrics.failures)
+        self.assertEqual(1, server_metrics.timeouts)
+        self.assertEqual(1, server_metrics.cancelled)
+        self.assertEqual(6, server_metrics.latency.count)
+
+    def test_servers_are_keyed_by_name(self):
+        recorder = InMemoryMetrics()
+        recorder.record_attempt(ServerDescriptor('a'), SUCCESS, 0.01)
+        # A descriptor built again for the same server, as update_servers may do, shares its metrics.
+        recorder.record_attempt(ServerDescriptor('a'), FAILURE, 0.01)
+        self.assertEqual(['a'], list(recorder.servers))
+        self.assertEqual(2, recorder.servers['a'].attempts)
+
+    def test_requests_and_schedule(self):
+        recorder = InMemoryMetrics()
+        recorder.record_request(SUCCESS, 1, 0.01)
+        recorder.record_request(FAILURE, 3, 0.5)
+        recorder.record_schedule('round-robin', 0.0001)
+        self.assertEqual({SUCCESS: 1, FAILURE: 1}, dict(recorder.requests))
+        self.assertEqual([1, 0, 1, 0, 0, 0, 0, 0], recorder.failover_depth.counts)
+        self.assertEqual(1, recorder.schedule_time['round-robin'].count)
+
+
+class TestStatsdMetrics(unittest.TestCase):
+
+    def test_stats(self):
+        client = mock.Mock()
+        statsd_metrics = StatsdMetrics(client, prefix='auth')
+        statsd_metrics.record_attempt('dc1.example.com', REJECT, 0.02)
+        statsd_metrics.record_request(REJECT, 2, 0.05)
+        statsd_metrics.record_schedule('ewma', 0.001)
+        client.incr.assert_has_calls([mock.call('auth.server.dc1_example_com.attempts', 1),
+                                      mock.call('auth.server.dc1_example_com.rejects', 1),
+                                      mock.call('auth.requests.reject', 1),
+                                      mock.call('auth.failover_depth.2', 1)])
+        client.timing.assert_has_calls([mock.call('auth.server.dc1_example_com.latency', 20.0),
+                                        mock.call('auth.request_latency', 50.0),
+                                        mock.call('auth.schedule.ewma', 1.0)])
+
+
+class TestPrometheusMetrics(unittest.TestCase):
+
+    @mock.patch('client_of_redundant_servers.metrics.prometheus_client')
+    def test_metrics(self, mock_prometheus_client):
+        registry = object()
+        prometheus_metrics = PrometheusMetrics(namespace='auth', registry=registry)
+        for call in mock_prometheus_client.Counter.call_args_list + mock_prometheus_client.Histogram.call_args_list:
+            self.assertEqual('auth', call[1]['namespace'])
+            self.assertIs(registry, call[1]['registry'])
+
+        prometheus_metrics.record_attempt('a', TIMEOUT, 0.5)
+        prometheus_metrics.record_attempt('a', TIMEOUT, 0.5)
+        counter = mock_prometheus_client.Counter.return_value
+        counter.labels.assert_called_with('a', TIMEOUT)
+        self.assertEqual(2, counter.labels.return_value.inc.call_count)
+
+    @mock.patch('client_of_redundant_servers.metrics.prometheus_client', None)
+    def test_needs_prometheus_client(self):
+        self.assertRaises(ImportError, PrometheusMetrics)
+
+
+class TestClientMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = InMemoryMetrics()
+        self.server_dict = OrderedDict([('a', None), ('b', None), ('c', None)])
+
+    @staticmethod
+    def server_func(server, results):
+        result = results[server]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def test_failover_is_counted(self):
+        a_client = ClientOfRedundantServers(self.server_dict, schedule='fixed', metrics=self.recorder)
+        results = {'a': CurrentServerFailed(), 'b': CurrentServerTimedOut(), 'c': False}
+        self.assertEqual(False, a_client.request(self.server_func, results=results))
+        self.assertEqual(1, self.recorder.servers['a'].failures)
+        self.assertEqual(1, self.recorder.servers['b'].timeouts)
+        self.assertEqual(1, self.recorder.servers['c'].rejects)
+        self.assertEqual({REJECT: 1}, dict(self.recorder.requests))
+        self.assertEqual(1, self.recorder.failover_depth.counts[2])
+        self.assertEqual(1, self.recorder.schedule_time['fixed'].count)
+
+    def test_all_servers_failed_is_counted(self):
+        a_client = ClientOfRedundantServers(self.server_dict, metrics=self.recorder)
+        results = dict.fromkeys(self.server_dict, CurrentServerFailed())
+        self.assertRaises(AllAvailableServersFailed, a_client.request, self.server_func, results=results)
+        self.assertEqual({FAILURE: 1}, dict(self.recorder.requests))
+        self.assertEqual(3, sum(server_metrics.failures for server_metrics in self.recorder.servers.values()))
+
+    def test_request_timeout_is_counted(self):
+        a_client = ClientOfRedundantServers(self.server_dict, schedule='fixed', request_timeout=0.02,
+                                            metrics=self.recorder)
+
+        def slow_failing_func(server, time_budget):
+            time.sleep(0.03)
+            raise CurrentServerFailed
+
+        self.assertRaises(AllAvailableServersFailed, a_client.request, slow_failing_func)
+        self.assertEqual({TIMEOUT: 1}, dict(self.recorder.requests))
+        self.assertEqual(1, self.recorder.failover_depth.counts[0])
+
+    def test_hedged_request_timeout_is_counted(self):
+        # An executor which runs each attempt as it is submitted, so the failure is only seen after the deadline.
+        class InlineExecutor(Executor):
+            def submit(self, func, *args, **kwargs):
+                future = Future()
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+
+        a_client = ClientOfRedundantServers(self.server_dict, schedule='fixed', hedge_delay=1, request_timeout=0.02,
+                                            hedge_executor=InlineExecutor(), metrics=self.recorder)
+        calls = []
+
+        def slow_failing_func(server, time_budget):
+            calls.append(server)
+            time.sleep(0.03)
+            raise CurrentServerFailed
+
+        self.assertRaises(AllAvailableServersFailed, a_client.request, slow_failing_func)
+        self.assertEqual(['a'], calls)
+        self.assertEqual({TIMEOUT: 1}, dict(self.recorder.requests))
+        a_client.close()
+
+    def test_hedged_request_is_counted(self):
+        a_client = ClientOfRedundantServers(self.server_dict, schedule='fixed', hedge_delay=0.01,
+                                            metrics=self.recorder)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_first_func(server):
+            if server == 'a':
+                release.wait(5)
+            return True
+
+        self.assertEqual(True, a_client.request(slow_first_func))
+        self.assertEqual({SUCCESS: 1}, dict(self.recorder.requests))
+        self.assertEqual(1, self.recorder.failover_depth.counts[1])
+        self.assertEqual(1, self.recorder.servers['b'].successes)
+        release.set()
+        a_client.close()
+
+    def test_no_metrics(self):
+        a_client = ClientOfRedundantServers(self.server_dict)
+        self.assertEqual(True, a_client.request(self.server_func, results={'a': True}))
+
+
+class TestAsyncClientMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.recorder = InMemoryMetrics()
+        self.server_dict = OrderedDict([('a', None), ('b', None)])
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_attempt_timeout_is_counted(self):
+        a_client = AsyncClientOfRedundantServers(self.server_dict, schedule='fixed', request_timeout=0.1,
+                                                 metrics=self.recorder)
+
+        async def slow_first_func(server, time_budget):
+            if server == 'a':
+                await asyncio.sleep(5)
+            return True
+
+        self.assertEqual(True, self.loop.run_until_complete(a_client.request(slow_first_func)))
+        self.assertEqual(1, self.recorder.servers['a'].timeouts)
+        self.assertEqual(1, self.recorder.servers['b'].successes)
+        self.assertEqual({SUCCESS: 1}, dict(self.recorder.requests))
+
+    def test_hedged_loser_is_cancelled(self):
+        a_client = AsyncClientOfRedundantServers(self.server_dict, schedule='fixed', hedge_delay=0.01,
+                                                 metrics=self.recorder)
+
+        async def slow_first_func(server):
+            if server == 'a':
+                await asyncio.sleep(5)
+            return True
+
+        async def request():
+            result = await a_client.request(slow_first_func)
+            # Let the cancelled attempt finish.
+            await asyncio.sleep(0)
+            return result
+
+        self.assertEqual(True, self.loop.run_until_complete(request()))
+        self.assertEqual(1, self.recorder.servers['a'].cancelled)
+        self.assertEqual(1, self.recorder.servers['b'].successes)
+        self.assertEqual(1, self.recorder.failover_depth.counts[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
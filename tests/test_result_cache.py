@@ -0,0 +1,185 @@
+import unittest
+import logging
+from collections import OrderedDict
+
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers,\
+                                                                    CurrentServerFailed,\
+                                                                    AllAvailableServersFailed
+from client_of_redundant_servers.result_cache import ResultCache
+
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class ClientOfRedundantAuthServers(ClientOfRedundantServers):
+    _cache_secret_kwargs = ('password',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+
+    def _auth_func(self, server, user, password):
+        self.calls += 1
+        if password == 'broken':
+            raise CurrentServerFailed
+        return password == 'right'
+
+    def auth(self, user, password):
+        return self.request(self._auth_func, user=user, password=password)
+
+
+class TestResultCache(unittest.TestCase):
+    """Tests for `result_cache.py`."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResultCache(max_entries=3, accept_ttl=60, reject_ttl=5, clock=self.clock)
+
+    def put(self, user, password, result):
+        key, group = self.cache.make_keys({'user': user, 'password': password}, ('password',))
+        self.cache.put(key, group, result)
+        return key
+
+    def get(self, user, password):
+        return self.cache.get(self.cache.make_keys({'user': user, 'password': password}, ('password',))[0])
+
+    def test_bad_max_entries(self):
+        self.assertRaises(ValueError, ResultCache, max_entries=0)
+
+    def test_hit_and_miss_are_counted(self):
+        self.assertEqual((False, None), self.get('bob', 'right'))
+        self.put('bob', 'right', True)
+        self.assertEqual((True, True), self.get('bob', 'right'))
+        self.assertEqual((False, None), self.get('bob', 'wrong'))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(2, self.cache.misses)
+
+    def test_separate_ttls(self):
+        self.put('bob', 'right', True)
+        self.put('bob', 'wrong', False)
+        self.clock.now += 6
+        self.assertEqual((True, True), self.get('bob', 'right'))
+        self.assertEqual((False, None), self.get('bob', 'wrong'))
+        self.clock.now += 60
+        self.assertEqual((False, None), self.get('bob', 'right'))
+        self.assertEqual(0, len(self.cache))
+
+    def test_zero_ttl_is_not_cached(self):
+        self.cache.reject_ttl = 0
+        self.put('bob', 'wrong', False)
+        self.assertEqual(0, len(self.cache))
+
+    def test_least_recently_used_is_evicted(self):
+        self.put('a', 'right', True)
+        self.put('b', 'right', True)
+        self.put('c', 'right', True)
+        self.get('a', 'right')
+        self.put('d', 'right', True)
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual((False, None), self.get('b', 'right'))
+        self.assertEqual((True, True), self.get('a', 'right'))
+        self.assertNotIn(self.cache.make_keys({'user': 'b'})[1], self.cache._groups)
+
+    def test_invalidate(self):
+        key = self.put('bob', 'right', True)
+        self.put('bob', 'wrong', False)
+        self.cache.invalidate(key)
+        self.assertEqual((False, None), self.get('bob', 'right'))
+        self.assertEqual((True, False), self.get('bob', 'wrong'))
+
+    def test_invalidate_group(self):
+        self.put('bob', 'right', True)
+        self.put('bob', 'wrong', False)
+        self.put('eve', 'right', True)
+        self.cache.invalidate_group(self.cache.make_keys({'user': 'bob'})[1])
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual((True, True), self.get('eve', 'right'))
+
+    def test_no_plaintext_is_held(self):
+        self.put('bob', 'hunter2', True)
+        for key, entry in self.cache._entries.items():
+            self.assertNotIn(b'hunter2', key[1])
+            self.assertNotIn(b'hunter2', entry[2][1])
+
+    def test_keys_depend_on_function(self):
+        kwargs = {'user': 'bob', 'password': 'right'}
+        first_keys = self.cache.make_keys(kwargs, ('password',), len)
+        self.assertNotEqual(first_keys, self.cache.make_keys(kwargs, ('password',), abs))
+        self.assertEqual(first_keys, self.cache.make_keys(kwargs, ('password',), len))
+
+    def test_invalidate_any_function(self):
+        for func in (len, abs):
+            key, group = self.cache.make_keys({'user': 'bob', 'password': 'right'}, ('password',), func)
+            self.cache.put(key, group, True)
+        self.cache.invalidate(self.cache.make_keys({'user': 'bob', 'password': 'right'}, ('password',))[0])
+        self.assertEqual(0, len(self.cache))
+
+    def test_keys_are_salted(self):
+        other_cache = ResultCache()
+        kwargs = {'user': 'bob', 'password': 'right'}
+        self.assertNotEqual(self.cache.make_keys(kwargs), other_cache.make_keys(kwargs))
+
+
+class TestClientWithResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache()
+        self.client = ClientOfRedundantAuthServers(OrderedDict([('a', None), ('b', None)]), result_cache=self.cache)
+
+    def test_results_are_cached(self):
+        self.assertEqual(True, self.client.auth('bob', 'right'))
+        self.assertEqual(True, self.client.auth('bob', 'right'))
+        self.assertEqual(False, self.client.auth('bob', 'wrong'))
+        self.assertEqual(False, self.client.auth('bob', 'wrong'))
+        self.assertEqual(2, self.client.calls)
+        self.assertEqual(2, self.cache.hits)
+
+    def test_functions_do_not_share_results(self):
+        self.assertEqual('a', self.client.request(lambda server, x: 'a', x=1))
+        self.assertEqual('b', self.client.request(lambda server, x: 'b', x=1))
+        self.assertEqual(True, self.client.auth('bob', 'right'))
+        self.assertEqual(True, self.client.auth('bob', 'right'))
+        # Bound methods of the same client are the same function.
+        self.assertEqual(1, self.client.calls)
+        self.client.invalidate_cached(x=1)
+        self.assertEqual(1, len(self.cache))
+
+    def test_failures_are_not_cached(self):
+        self.assertRaises(AllAvailableServersFailed, self.client.auth, 'bob', 'broken')
+        self.assertRaises(AllAvailableServersFailed, self.client.auth, 'bob', 'broken')
+        self.assertEqual(4, self.client.calls)
+        self.assertEqual(0, len(self.cache))
+
+    def test_invalidate_cached_user(self):
+        self.client.auth('bob', 'right')
+        self.client.auth('bob', 'wrong')
+        self.client.auth('eve', 'right')
+        self.client.invalidate_cached(user='bob')
+        self.assertEqual(1, len(self.cache))
+
+    def test_invalidate_cached_request(self):
+        self.client.auth('bob', 'right')
+        self.client.auth('bob', 'wrong')
+        self.client.invalidate_cached(user='bob', password='wrong')
+        self.assertEqual(1, len(self.cache))
+        self.client.auth('bob', 'right')
+        self.assertEqual(2, self.client.calls)
+
+    def test_no_cache(self):
+        a_client = ClientOfRedundantAuthServers(OrderedDict([('a', None)]))
+        a_client.auth('bob', 'right')
+        a_client.auth('bob', 'right')
+        a_client.invalidate_cached(user='bob')
+        self.assertEqual(2, a_client.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
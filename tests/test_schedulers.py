@@ -0,0 +1,208 @@
+import unittest
+
+from client_of_redundant_servers.schedulers import Scheduler, register_scheduler, get_scheduler,\
+                                                   EwmaScheduler, LeastOutstandingScheduler, PowerOfTwoScheduler,\
+                                                   WeightedScheduler, ConsistentHashScheduler,\
+                                                   smooth_weighted_sequence
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed
+from client_of_redundant_servers.server_health import ServerHealth
+from collections import OrderedDict
+
+
+class ReversedScheduler(Scheduler):
+    def order(self, kwargs):
+        return list(reversed(self.server_list)), 0
+
+
+class TestSchedulers(unittest.TestCase):
+    """Tests for `schedulers.py`."""
+
+    def setUp(self):
+        self.server_list = ['a', 'b', 'c']
+        self.health = OrderedDict((server, ServerHealth()) for server in self.server_list)
+
+    def ordered(self, scheduler):
+        server_list, start = scheduler.order({})
+        return server_list[start:] + server_list[:start]
+
+    def test_unknown_schedule(self):
+        self.assertRaises(NotImplementedError, get_scheduler, 'bananas')
+
+    def test_register_scheduler(self):
+        register_scheduler('reversed', ReversedScheduler)
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='reversed')
+        self.assertEqual('b', a_client.request(lambda server: server))
+
+    def test_ewma_fastest_first(self):
+        self.health['a'].latency_ewma = 0.3
+        self.health['b'].latency_ewma = 0.1
+        self.health['c'].latency_ewma = 0.2
+        self.assertEqual(['b', 'c', 'a'], self.ordered(EwmaScheduler(self.server_list, self.health)))
+
+    def test_ewma_unmeasured_first(self):
+        self.health['a'].latency_ewma = 0.3
+        self.health['b'].latency_ewma = 0.1
+        self.assertEqual(['c', 'b', 'a'], self.ordered(EwmaScheduler(self.server_list, self.health)))
+
+    def test_ewma_learns_latency(self):
+        health = ServerHealth()
+        health.attempt_started()
+        self.assertEqual(1, health.outstanding)
+        health.attempt_finished(1.0)
+        self.assertEqual(0, health.outstanding)
+        self.assertEqual(1.0, health.latency_ewma)
+        health.attempt_started()
+        health.attempt_finished(2.0)
+        self.assertAlmostEqual(1.3, health.latency_ewma)
+        health.attempt_started()
+        health.attempt_finished(None)
+        self.assertEqual(0, health.outstanding)
+        self.assertAlmostEqual(1.3, health.latency_ewma)
+
+    def test_least_outstanding(self):
+        self.health['a'].outstanding = 2
+        self.health['b'].outstanding = 1
+        scheduler = LeastOutstandingScheduler(self.server_list, self.health)
+        self.assertEqual(['c', 'b', 'a'], self.ordered(scheduler))
+
+    def test_least_outstanding_ties_rotate(self):
+        scheduler = LeastOutstandingScheduler(self.server_list, self.health)
+        self.assertEqual(['a', 'b', 'c'], self.ordered(scheduler))
+        self.assertEqual(['b', 'c', 'a'], self.ordered(scheduler))
+
+    def test_power_of_two_picks_less_loaded(self):
+        self.health['a'].outstanding = 5
+        self.health['b'].outstanding = 5
+        scheduler = PowerOfTwoScheduler(self.server_list, self.health)
+        for _ in range(20):
+            order = self.ordered(scheduler)
+            self.assertEqual(sorted(self.server_list), sorted(order))
+            # 'c' is always the better choice when it is picked, and 'a' and 'b' are never picked over it.
+            if 'c' in order[:2]:
+                self.assertEqual('c', order[0])
+
+    def test_power_of_two_single_server(self):
+        scheduler = PowerOfTwoScheduler(['a'], OrderedDict([('a', ServerHealth())]))
+        self.assertEqual(['a'], self.ordered(scheduler))
+
+    def test_smooth_weighted_sequence(self):
+        self.assertEqual([0, 0, 1, 0, 2, 0, 0], smooth_weighted_sequence([5, 1, 1]))
+        self.assertEqual([0, 1, 0], smooth_weighted_sequence([4, 2]))
+        self.assertEqual([0, 1, 2], smooth_weighted_sequence([3, 3, 3]))
+
+    def test_weighted_shares(self):
+        options = {'a': {'weight': 3}, 'b': {'weight': 1}}
+        scheduler = WeightedScheduler(['a', 'b'], self.health, options)
+        firsts = [self.ordered(scheduler)[0] for _ in range(8)]
+        self.assertEqual(6, firsts.count('a'))
+        self.assertEqual(2, firsts.count('b'))
+        self.assertEqual(['a', 'a', 'b', 'a'] * 2, firsts)
+
+    def test_weighted_defaults_to_round_robin(self):
+        scheduler = WeightedScheduler(self.server_list, self.health)
+        self.assertEqual(['a', 'b', 'c'], self.ordered(scheduler))
+        self.assertEqual(['b', 'c', 'a'], self.ordered(scheduler))
+        self.assertEqual(['c', 'a', 'b'], self.ordered(scheduler))
+
+    def test_weighted_priority_tiers(self):
+        options = {'a': {'priority': 1}, 'b': {'priority': 0}, 'c': {'priority': 0}}
+        scheduler = WeightedScheduler(self.server_list, self.health, options)
+        self.assertEqual(['b', 'c', 'a'], self.ordered(scheduler))
+        self.assertEqual(['c', 'b', 'a'], self.ordered(scheduler))
+
+    def test_weighted_spills_to_next_tier(self):
+        options = {'a': {'priority': 0}, 'b': {'priority': 10}, 'c': {'priority': 10}}
+        self.health['a'] = ServerHealth(failure_threshold=1)
+        scheduler = WeightedScheduler(self.server_list, self.health, options)
+        self.assertEqual(['a', 'b', 'c'], self.ordered(scheduler))
+        self.health['a'].record_failure()
+        self.assertEqual(['b', 'c', 'a'], self.ordered(scheduler))
+        self.assertEqual(['c', 'b', 'a'], self.ordered(scheduler))
+
+    def test_weighted_invalid_weight(self):
+        for weight in (0, -1, 1.5, '2', True):
+            self.assertRaises(ValueError, WeightedScheduler, self.server_list, self.health, {'a': {'weight': weight}})
+
+    def test_client_weighted_schedule(self):
+        server_dict = OrderedDict([('backup', {'priority': 1}), ('big', {'weight': 2}), ('small', None)])
+        a_client = ClientOfRedundantServers(server_dict, schedule='weighted')
+        results = [a_client.request(lambda server: server) for _ in range(6)]
+        self.assertEqual(['big', 'small', 'big'] * 2, results)
+
+        def failing_func(server):
+            if server != 'backup':
+                raise CurrentServerFailed
+            return server
+
+        self.assertEqual('backup', a_client.request(failing_func))
+
+    def test_consistent_hash_same_key_same_server(self):
+        scheduler = ConsistentHashScheduler(self.server_list, self.health, key=lambda kwargs: kwargs.get('user'))
+        for user in ('alice', 'bob', 'carol'):
+            order = scheduler.order({'user': user})[0]
+            self.assertEqual(sorted(self.server_list), sorted(order))
+            self.assertEqual(order, scheduler.order({'user': user})[0])
+        firsts = set(scheduler.order({'user': 'user' + str(i)})[0][0] for i in range(100))
+        self.assertEqual(set(self.server_list), firsts)
+
+    def test_consistent_hash_remaps_few_keys(self):
+        key = lambda kwargs: kwargs['user']
+        before = ConsistentHashScheduler(self.server_list, self.health, key=key)
+        after = ConsistentHashScheduler(self.server_list + ['d'], self.health, key=key)
+        users = ['user' + str(i) for i in range(1000)]
+        moved = [user for user in users if before.order({'user': user})[0][0] != after.order({'user': user})[0][0]]
+        # About a quarter of the keys move, and all of them to the new server.
+        self.assertLess(len(moved), 400)
+        self.assertEqual(set(['d']), set(after.order({'user': user})[0][0] for user in moved))
+
+    def test_consistent_hash_without_key(self):
+        scheduler = ConsistentHashScheduler(self.server_list, self.health)
+        order = self.ordered(scheduler)
+        self.assertEqual(sorted(self.server_list), sorted(order))
+
+    def test_client_consistent_hash_schedule(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]),
+                                            schedule='consistent-hash', schedule_key='user')
+        first = a_client.request(lambda server, user: server, user='alice')
+        self.assertEqual([first] * 5, [a_client.request(lambda server, user: server, user='alice') for _ in range(5)])
+
+        def failing_func(server, user):
+            if server == first:
+                raise CurrentServerFailed
+            return server
+
+        second = a_client.request(failing_func, user='alice')
+        self.assertNotEqual(first, second)
+        self.assertEqual(second, a_client.request(failing_func, user='alice'))
+
+    def test_client_schedule_key_function(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None), ('c', None)]),
+                                            schedule='consistent-hash', schedule_key=lambda kwargs: 'same')
+        results = set(a_client.request(lambda server, user: server, user='user' + str(i)) for i in range(20))
+        self.assertEqual(1, len(results))
+
+    def test_client_tracks_latency_and_outstanding(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None), ('b', None)]), schedule='ewma')
+        outstanding = []
+
+        def func(server):
+            outstanding.append(a_client.server_health(server).outstanding)
+            return server
+
+        a_client.request(func)
+        self.assertEqual([1], outstanding)
+        self.assertEqual(0, a_client.server_health('a').outstanding)
+        self.assertIsNotNone(a_client.server_health('a').latency_ewma)
+
+    def test_client_outstanding_released_on_unexpected_exception(self):
+        a_client = ClientOfRedundantServers(OrderedDict([('a', None)]), schedule='least-outstanding')
+
+        def func(server):
+            raise KeyError
+
+        self.assertRaises(KeyError, a_client.request, func)
+        self.assertEqual(0, a_client.server_health('a').outstanding)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from client_of_redundant_servers.server_health import ServerHealth, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestServerHealth(unittest.TestCase):
+    """Tests for `server_health.py`."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.health = ServerHealth(failure_threshold=2, recovery_timeout=10, clock=self.clock)
+
+    def test_new_health_is_closed(self):
+        self.assertEqual(CLOSED, self.health.state)
+        self.assertEqual(0, self.health.consecutive_failures)
+        self.assertEqual(False, self.health.quarantined)
+        self.assertEqual(True, self.health.allow_request())
+
+    def test_opens_after_threshold(self):
+        self.health.record_failure()
+        self.assertEqual(CLOSED, self.health.state)
+        self.health.record_failure()
+        self.assertEqual(OPEN, self.health.state)
+        self.assertEqual(True, self.health.quarantined)
+        self.assertEqual(False, self.health.allow_request())
+
+    def test_available_does_not_claim_probe(self):
+        self.health.record_failure()
+        self.health.record_failure()
+        self.assertEqual(False, self.health.available)
+        self.clock.now += 10
+        self.assertEqual(True, self.health.available)
+        self.assertEqual(OPEN, self.health.state)
+        self.assertEqual(True, self.health.allow_request())
+        self.assertEqual(False, self.health.available)
+
+    def test_success_resets_failures(self):
+        self.health.record_failure()
+        self.health.record_success()
+        self.health.record_failure()
+        self.assertEqual(CLOSED, self.health.state)
+
+    def test_single_half_open_probe_after_cooldown(self):
+        self.health.record_failure()
+        self.health.record_failure()
+        self.clock.now += 10
+        self.assertEqual(True, self.health.allow_request())
+        self.assertEqual(HALF_OPEN, self.health.state)
+        # Only one caller gets to probe the server
+        self.assertEqual(False, self.health.allow_request())
+
+    def test_half_open_probe_success_closes(self):
+        self.health.record_failure()
+        self.health.record_failure()
+        self.clock.now += 10
+        self.health.allow_request()
+        self.health.record_success()
+        self.assertEqual(CLOSED, self.health.state)
+        self.assertEqual(True, self.health.allow_request())
+
+    def test_half_open_probe_failure_reopens(self):
+        self.health.record_failure()
+        self.health.record_failure()
+        self.clock.now += 10
+        self.health.allow_request()
+        self.health.record_failure()
+        self.assertEqual(OPEN, self.health.state)
+        self.clock.now += 9
+        self.assertEqual(False, self.health.allow_request())
+        self.clock.now += 1
+        self.assertEqual(True, self.health.allow_request())
+
+    def test_no_threshold_never_opens(self):
+        health = ServerHealth(failure_threshold=None, clock=self.clock)
+        for _ in range(100):
+            health.record_failure()
+        self.assertEqual(CLOSED, health.state)
+        self.assertEqual(True, health.allow_request())
+
+
+if __name__ == '__main__':
+    unittest.main()
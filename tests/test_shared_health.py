@@ -0,0 +1,185 @@
+import mock
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers, CurrentServerFailed
+from client_of_redundant_servers.server_health import CLOSED, OPEN, HALF_OPEN
+from client_of_redundant_servers.shared_health import SharedHealthFile
+from collections import OrderedDict
+
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def fail_server(path, name):
+    shared = SharedHealthFile(path)
+    health = shared.health(name, failure_threshold=2)
+    health.record_failure()
+    health.record_failure()
+    health.record_latency(0.25)
+    shared.close()
+
+
+class TestSharedHealthFile(unittest.TestCase):
+    """Tests for `shared_health.py`."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'health')
+        self.clock = FakeClock()
+
+    def open(self, slots=4, **kwargs):
+        shared = SharedHealthFile(self.path, slots=slots, **kwargs)
+        self.addCleanup(shared.close)
+        return shared
+
+    def test_new_health_is_closed(self):
+        health = self.open().health('a')
+        self.assertEqual(CLOSED, health.state)
+        self.assertEqual(0, health.consecutive_failures)
+        self.assertIsNone(health.latency_ewma)
+        self.assertTrue(health.allow_request())
+
+    def test_health_is_shared(self):
+        first = self.open().health('a', failure_threshold=2, clock=self.clock)
+        second = self.open().health('a', failure_threshold=2, clock=self.clock)
+        first.record_failure()
+        self.assertEqual(1, second.consecutive_failures)
+        first.record_failure()
+        self.assertEqual(OPEN, second.state)
+        self.assertFalse(second.allow_request())
+        second.record_latency(1.0)
+        first.record_latency(2.0)
+        self.assertAlmostEqual(1.3, second.latency_ewma)
+
+    def test_only_one_process_probes(self):
+        first = self.open().health('a', failure_threshold=1, recovery_timeout=10, clock=self.clock)
+        second = self.open().health('a', failure_threshold=1, recovery_timeout=10, clock=self.clock)
+        first.record_failure()
+        self.clock.now += 10
+        self.assertTrue(second.available)
+        self.assertTrue(second.allow_request())
+        self.assertEqual(HALF_OPEN, first.state)
+        self.assertFalse(first.allow_request())
+        second.record_success()
+        self.assertEqual(CLOSED, first.state)
+        self.assertTrue(first.allow_request())
+
+    def test_outstanding_is_per_process(self):
+        first = self.open().health('a')
+        second = self.open().health('a')
+        first.attempt_started()
+        self.assertEqual(1, first.outstanding)
+        self.assertEqual(0, second.outstanding)
+        first.attempt_finished(0.5)
+        self.assertEqual(0, first.outstanding)
+        self.assertEqual(0.5, second.latency_ewma)
+
+    def test_servers_have_their_own_slots(self):
+        shared = self.open(slots=2)
+        shared.health('a', failure_threshold=1).record_failure()
+        self.assertEqual(CLOSED, shared.health('b').state)
+        self.assertEqual(OPEN, shared.health('a').state)
+        self.assertRaises(ValueError, shared.health, 'c')
+
+    def test_stale_slots_are_reused(self):
+        shared = self.open(slots=2, stale_after=60, clock=self.clock)
+        a = shared.health('a', failure_threshold=1)
+        shared.health('b')
+        self.clock.now += 30
+        self.assertRaises(ValueError, shared.health, 'c')
+        a.record_failure()
+        self.clock.now += 31
+        # 'b' has not been used for over a minute, but 'a' has.
+        c = shared.health('c')
+        self.assertEqual(CLOSED, c.state)
+        self.assertEqual(OPEN, a.state)
+        self.assertRaises(ValueError, shared.health, 'd')
+
+    def test_reused_slot_is_not_written_by_its_old_server(self):
+        shared = self.open(slots=2, stale_after=60, clock=self.clock)
+        a = shared.health('a', failure_threshold=1)
+        shared.health('b')
+        self.clock.now += 61
+        c = shared.health('c')
+        a.record_failure()
+        # 'a' lost its slot to 'c', so it has taken the slot of 'b', which is stale too.
+        self.assertEqual(CLOSED, c.state)
+        self.assertEqual(0, c.consecutive_failures)
+        self.assertEqual(OPEN, a.state)
+        self.assertEqual(OPEN, shared.health('a').state)
+
+    def test_long_names(self):
+        shared = self.open(slots=2)
+        shared.health('x' * 100, failure_threshold=1).record_failure()
+        self.assertEqual(CLOSED, shared.health('x' * 99 + 'y').state)
+        self.assertEqual(OPEN, shared.health('x' * 100).state)
+
+    def test_existing_file_keeps_its_slots(self):
+        self.open(slots=2)
+        self.assertEqual(2, self.open(slots=8).slots)
+
+    def test_not_a_health_file(self):
+        with open(self.path, 'wb') as bad_file:
+            bad_file.write(b'not a health file at all, not even close' * 4)
+        self.assertRaises(ValueError, SharedHealthFile, self.path)
+
+    @mock.patch('client_of_redundant_servers.shared_health.fcntl', None)
+    def test_needs_fcntl(self):
+        self.assertRaises(ImportError, SharedHealthFile, self.path)
+
+    def test_health_is_shared_with_other_processes(self):
+        shared = self.open()
+        health = shared.health('a', failure_threshold=2)
+        worker = multiprocessing.get_context('fork').Process(target=fail_server, args=(self.path, 'a'))
+        worker.start()
+        worker.join(10)
+        self.assertEqual(0, worker.exitcode)
+        self.assertEqual(OPEN, health.state)
+        self.assertEqual(0.25, health.latency_ewma)
+
+    def test_clients_share_health(self):
+        server_dict = OrderedDict([('a', None), ('b', None)])
+        first = ClientOfRedundantServers(server_dict, schedule='fixed', failure_threshold=1,
+                                         shared_health=self.open())
+        second = ClientOfRedundantServers(server_dict, schedule='fixed', failure_threshold=1,
+                                          shared_health=self.open())
+
+        def failing_func(server):
+            if server == 'a':
+                raise CurrentServerFailed
+            return server
+
+        self.assertEqual('b', first.request(failing_func))
+        tried = []
+        self.assertEqual('b', second.request(lambda server: tried.append(server) or server))
+        self.assertEqual(['b'], tried)
+        self.assertTrue(second.server_health('a').quarantined)
+
+    def test_kinds_of_client_do_not_share_health(self):
+        class OtherClient(ClientOfRedundantServers):
+            pass
+
+        server_dict = OrderedDict([('a', None)])
+        first = ClientOfRedundantServers(server_dict, failure_threshold=1, shared_health=self.open())
+        second = OtherClient(server_dict, failure_threshold=1, shared_health=self.open())
+        first.server_health('a').record_failure()
+        self.assertTrue(first.server_health('a').quarantined)
+        self.assertFalse(second.server_health('a').quarantined)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import mock
+import unittest
+import logging
+import threading
+
+from client_of_redundant_servers.client_of_redundant_servers import ClientOfRedundantServers
+from client_of_redundant_servers.client_of_redundant_ad_ldap_servers import ClientOfRedundantAdLdapServers
+from client_of_redundant_servers.srv_discovery import SrvServerSource, DnspythonResolver, ServerDiscoveryFailed,\
+                                                      ad_ldap_srv_name
+
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubResolver(object):
+    """Answers from dicts of records, counting the lookups."""
+    def __init__(self, srv_records, addresses, ttl=60):
+        self.srv_records = srv_records
+        self.address_records = addresses
+        self.ttl = ttl
+        self.lookups = []
+
+    def srv(self, name):
+        self.lookups.append(name)
+        if name not in self.srv_records:
+            raise ServerDiscoveryFailed
+        return self.srv_records[name], self.ttl
+
+    def addresses(self, name):
+        self.lookups.append(name)
+        if name not in self.address_records:
+            raise ServerDiscoveryFailed
+        return self.address_records[name], self.ttl
+
+
+class TestSrvServerSource(unittest.TestCase):
+    """Tests for `srv_discovery.py`."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.srv_name = ad_ldap_srv_name('example.com')
+        self.resolver = StubResolver(
+            {self.srv_name: [(10, 0, 389, 'dc3.example.com'),
+                             (0, 50, 389, 'dc1.example.com'),
+                             (0, 100, 636, 'dc2.example.com')]},
+            {'dc1.example.com': ['192.0.2.1'],
+             'dc2.example.com': ['192.0.2.2', '2001:db8::2'],
+             'dc3.example.com': ['192.0.2.3']})
+        self.source = SrvServerSource(self.srv_name, lambda port: {'port': port, 'ssl': False, 'validate': False},
+                                      resolver=self.resolver, clock=self.clock)
+
+    def test_server_dict(self):
+        server_dict = self.source.server_dict()
+        self.assertEqual(['dc2.example.com', 'dc1.example.com', 'dc3.example.com'], list(server_dict))
+        self.assertEqual({'port': 636, 'ssl': False, 'validate': False, 'priority': 0, 'weight': 100,
+                          'address': '192.0.2.2'}, server_dict['dc2.example.com'])
+        self.assertEqual(1, server_dict['dc3.example.com']['weight'])
+
+    def test_records_are_cached_until_they_expire(self):
+        self.source.server_dict()
+        self.assertEqual(4, len(self.resolver.lookups))
+        self.assertEqual(160.0, self.source.expires())
+        self.clock.now += 59
+        self.source.server_dict()
+        self.assertEqual(4, len(self.resolver.lookups))
+        self.clock.now += 1
+        self.source.server_dict()
+        self.assertEqual(8, len(self.resolver.lookups))
+
+    def test_failed_lookups_keep_old_records(self):
+        first = self.source.server_dict()
+        self.resolver.srv_records.clear()
+        self.resolver.address_records.clear()
+        self.clock.now += 60
+        self.assertEqual(first, self.source.server_dict())
+        self.assertEqual(self.clock.now + self.source.min_ttl, self.source.expires())
+
+    def test_no_records(self):
+        self.resolver.srv_records.clear()
+        self.assertRaises(ServerDiscoveryFailed, self.source.server_dict)
+
+    def test_unresolved_server_has_no_address(self):
+        del self.resolver.address_records['dc1.example.com']
+        self.assertNotIn('address', self.source.server_dict()['dc1.example.com'])
+
+    def test_address_is_kept_while_still_valid(self):
+        self.source.server_dict()
+        self.resolver.address_records['dc2.example.com'] = ['192.0.2.9', '192.0.2.2']
+        self.clock.now += 60
+        self.assertEqual('192.0.2.2', self.source.server_dict()['dc2.example.com']['address'])
+
+    def test_refresh_updates_client(self):
+        a_client = ClientOfRedundantAdLdapServers(self.source.server_dict(), 'dc=example,dc=com', schedule='weighted')
+        self.assertEqual('192.0.2.2', a_client.server_list[0].ldap_server.host)
+        self.assertFalse(self.source.refresh(a_client))
+        self.resolver.srv_records[self.srv_name].pop()
+        self.clock.now += 60
+        self.assertTrue(self.source.refresh(a_client))
+        self.assertEqual(['dc1.example.com', 'dc3.example.com'], [server.name for server in a_client.server_list])
+
+    def test_start_watching(self):
+        self.source = SrvServerSource(self.srv_name, lambda port: {}, resolver=self.resolver, min_ttl=0.01)
+        self.resolver.ttl = 0.01
+        a_client = ClientOfRedundantServers(self.source.server_dict())
+        updated = threading.Event()
+        a_client.update_servers = lambda server_dict: updated.set()
+        self.resolver.srv_records[self.srv_name] = [(0, 1, 389, 'dc4.example.com')]
+        self.source.start(a_client)
+        self.addCleanup(self.source.stop)
+        self.assertRaises(RuntimeError, self.source.start, a_client)
+        self.assertTrue(updated.wait(5))
+
+
+class TestDnspythonResolver(unittest.TestCase):
+
+    @mock.patch('client_of_redundant_servers.srv_discovery.dns', None)
+    def test_needs_dnspython(self):
+        self.assertRaises(ImportError, DnspythonResolver)
+
+
+if __name__ == '__main__':
+    unittest.main()